@@ -0,0 +1,44 @@
+from typing import TYPE_CHECKING, Callable, Hashable, TypeVar
+from retrieval import ResultCache
+
+if TYPE_CHECKING:
+    from langchain.llms.openai import AzureOpenAI
+
+T = TypeVar("T")
+
+
+# Per-process registry of the LangChain objects the agent approaches need, built once per key (deployment, temperature,
+# prompt overrides, ...) and then shared by all requests. Only objects without per-request state belong here: callbacks
+# go through request_callback_manager to the handler of the current request, and tools that capture a RequestContext
+# are still built for every request. Prompt overrides come from clients, so the least recently used entries are dropped
+# beyond max_entries. LangChain and the OpenAI SDK are imported when the first object is built, not with this module.
+class AgentRegistry:
+    def __init__(self, max_entries: int = 64):
+        self.objects = ResultCache(max_entries, ttl=float("inf"))
+
+    # Two requests can race to build the same object, one of the two is kept
+    def get(self, key: Hashable, build: Callable[[], T]) -> T:
+        obj = self.objects.get(key)
+        if obj is None:
+            obj = build()
+            self.objects.put(key, obj)
+        return obj
+
+    # Calls go through the openai module, which always has the current API key (see app.ensure_openai_token)
+    def llm(self, deployment: str, temperature: float) -> "AzureOpenAI":
+        import openai
+        from langchain.llms.openai import AzureOpenAI
+        from langchainadapters import request_callback_manager
+
+        return self.get(
+            ("llm", deployment, temperature),
+            lambda: AzureOpenAI(
+                deployment_name=deployment,
+                temperature=temperature,
+                openai_api_key=openai.api_key,
+                callback_manager=request_callback_manager,
+            ),
+        )
+
+    def stats(self) -> dict:
+        return self.objects.stats()
@@ -0,0 +1,121 @@
+import re
+import threading
+import zlib
+from typing import Callable, Hashable, List, Optional
+import numpy as np
+import openai
+
+# An embedder turns a batch of texts into one vector per text (rows of a 2D array)
+Embedder = Callable[[List[str]], np.ndarray]
+
+
+class AzureOpenAIEmbedder:
+    def __init__(self, deployment: str):
+        self.deployment = deployment
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        r = openai.Embedding.create(engine=self.deployment, input=texts)
+        return np.array([d["embedding"] for d in r["data"]], dtype=np.float32)
+
+
+# Local embedder without any model, for tests and development: words and character trigrams are hashed into a fixed
+# number of buckets. Good enough to match paraphrases that share most of their wording.
+class HashingEmbedder:
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                h = zlib.crc32(feature.encode())
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return vectors
+
+    def features(self, text: str) -> List[str]:
+        features = []
+        for word in re.findall(r"\w+", text.casefold()):
+            features.append(word)
+            padded = f"#{word}#"
+            features.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+        return features
+
+
+# Answer cache keyed on the meaning of a question rather than its exact text. Question embeddings are kept normalized in
+# one preallocated float32 matrix, so a lookup is a single matrix-vector product. Entries are only matched within the
+# same scope (approach and overrides), and the least recently used entry is replaced once the matrix is full.
+class SemanticAnswerCache:
+    def __init__(
+        self, embed: Embedder, threshold: float = 0.95, max_entries: int = 1000
+    ):
+        self.embed_texts = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._occupied = np.zeros(max_entries, dtype=bool)
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._responses: List[Optional[dict]] = [None] * max_entries
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def embed(self, question: str) -> np.ndarray:
+        return self.embed_many([question])[0]
+
+    def embed_many(self, questions: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.embed_texts(questions), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def get(self, vector: np.ndarray, scope: Hashable) -> Optional[dict]:
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            similarities = self._vectors @ vector
+            similarities[~self._occupied | (self._scopes != hash(scope))] = -np.inf
+            i = int(np.argmax(similarities))
+            if similarities[i] < self.threshold:
+                self.misses += 1
+                return None
+            self._clock += 1
+            self._last_used[i] = self._clock
+            self.hits += 1
+            return self._responses[i]
+
+    def put(self, vector: np.ndarray, scope: Hashable, response: dict):
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.max_entries, vector.shape[0]), dtype=np.float32
+                )
+            # Free slots were never used, so they come before any occupied one
+            i = int(np.argmin(self._last_used))
+            if self._occupied[i]:
+                self.evictions += 1
+            self._clock += 1
+            self._vectors[i] = vector
+            self._scopes[i] = hash(scope)
+            self._occupied[i] = True
+            self._last_used[i] = self._clock
+            self._responses[i] = response
+
+    def invalidate(self):
+        with self._lock:
+            self._occupied[:] = False
+            self._last_used[:] = 0
+            self._responses = [None] * self.max_entries
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": int(self._occupied.sum()),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
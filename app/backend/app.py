@@ -1,9 +1,889 @@
+# Imports are timed for the startup report (see /startup), from here until app.py has been imported. The OpenAI and
+# Azure SDKs, numpy, tiktoken and LangChain are only imported once they are used (see configure_openai, search_client,
+# content_source and the approach factories), so they don't show up here unless warm-up is enabled.
+import startup
+
+startup.report.imports.install(__name__)
+
 import os
-import mimetypes
+import hmac
+import json
+import tempfile
 import time
 import logging
-import openai
+import threading
+from contextlib import contextmanager
+from typing import Optional
 import dotenv
-from flask import Flask, request, jsonify
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+import requests
+from flask import Flask, Response, request, jsonify
+from approaches.cachedapproach import CachedApproach
+from approaches.coalescingapproach import CoalescingApproach
+from approaches.lazyapproaches import LazyApproaches
+from retrieval import ResultCache, Retriever
+from tokenbudget import PromptBudget, TokenCounter
+from passages import PassageSelector
+from agentregistry import AgentRegistry
+from tracestore import TraceStore
+from contentstore import (
+    BlobContentSource,
+    ContentNotFound,
+    ContentStore,
+    DiskCache,
+    LocalContentSource,
+)
+from singleflight import SingleFlight
+from deadlines import DeadlineExceeded, bounded, deadline
+from upstream import CircuitBreakers, CircuitOpen, Hedge, LazyClient, UpstreamAdapter
+from quota import (
+    BATCH,
+    DEFAULT,
+    INTERACTIVE,
+    DeploymentQuota,
+    QuotaExceeded,
+    QuotaScheduler,
+    prioritized,
+    priority,
+)
+from profiler import SamplingProfiler
+import metrics
+import stages
+
+startup.report.mark("imports")
+
+dotenv.load_dotenv()
+
+# Replace these with your own values, either in environment variables or directly here
+AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT") or "mystorageaccount"
+AZURE_STORAGE_CONTAINER = os.environ.get("AZURE_STORAGE_CONTAINER") or "content"
+AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE") or "gptkb"
+AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX") or "gptkbindex"
+AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE") or "myopenai"
+AZURE_OPENAI_ENDPOINT = (
+    os.environ.get("AZURE_OPENAI_ENDPOINT")
+    or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+)
+AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "davinci"
+AZURE_OPENAI_CHATGPT_DEPLOYMENT = (
+    os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "chat"
+)
+
+# Size of the chat model's context window in tokens, the chat prompt is assembled to fit into it
+AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW = int(
+    os.environ.get("AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW") or 4096
+)
+
+KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
+KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
+KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
+
+# Set to an index file built with localsearch.py to search it in-process instead of using Cognitive Search, e.g. for small
+# document sets, development without Azure resources or load tests
+LOCAL_SEARCH_INDEX = os.environ.get("LOCAL_SEARCH_INDEX")
+
+# Search results are cached in-process for repeated questions, set SEARCH_CACHE_SIZE=0 to disable
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE") or 1024)
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL") or 300)
+
+# Content of each search result is reduced to the passages that best match the question, up to this many tokens per
+# source, set PASSAGE_TOKENS=0 to send whole documents (or the first characters where an approach limits them)
+PASSAGE_TOKENS = int(os.environ.get("PASSAGE_TOKENS") or 300)
+
+# Search results are read until this much content has been collected, by default about four characters per token of
+# the chat model's context window, set SEARCH_MAX_CONTENT_CHARS=0 to always read the top results
+SEARCH_MAX_CONTENT_CHARS = int(
+    os.environ.get("SEARCH_MAX_CONTENT_CHARS")
+    or 4 * AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW
+)
+
+# The search query for a chat turn is rewritten from the conversation by a completion, rewrites are cached by history,
+# set QUERY_REWRITE_CACHE_SIZE=0 to disable. The rewrite also translates the question into English search keywords, so
+# the first question of a conversation is rewritten as well. Set CHAT_REWRITE_FIRST_TURN=false to search it as asked
+# and save the completion, e.g. when questions are asked in the language of the documents.
+QUERY_REWRITE_CACHE_SIZE = int(os.environ.get("QUERY_REWRITE_CACHE_SIZE") or 1024)
+QUERY_REWRITE_CACHE_TTL = float(os.environ.get("QUERY_REWRITE_CACHE_TTL") or 3600)
+CHAT_REWRITE_FIRST_TURN = (
+    os.environ.get("CHAT_REWRITE_FIRST_TURN") or "true"
+).lower() == "true"
+
+# Set to search the last question as asked while its query is being rewritten, the results are used if the rewritten
+# query shares at least this fraction of its words with the question (e.g. 0.5), see rewrite_and_retrieve. The rewrite
+# prompt translates questions into English, so this only pays off when users ask in English (or with a query prompt
+# that keeps their language), otherwise nearly every speculative search is discarded, see
+# speculative_discarded in /chat/rewrites.
+CHAT_SPECULATIVE_OVERLAP = os.environ.get("CHAT_SPECULATIVE_OVERLAP")
+
+# Answers to paraphrased questions can be served from a semantic cache. It is enabled by setting an embedding deployment,
+# or ANSWER_CACHE_EMBEDDER=hashing to use a local embedder instead (e.g. for development)
+AZURE_OPENAI_EMB_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMB_DEPLOYMENT")
+ANSWER_CACHE_EMBEDDER = os.environ.get("ANSWER_CACHE_EMBEDDER") or (
+    "azure" if AZURE_OPENAI_EMB_DEPLOYMENT else None
+)
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD") or 0.95)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE") or 1000)
+
+# Thoughts are only rendered when a client fetches them from /thoughts/<trace_id> (or asks for them inline with the
+# include_thoughts override), this many recent traces are kept for that
+TRACE_STORE_SIZE = int(os.environ.get("TRACE_STORE_SIZE") or 1000)
+
+# Identical questions (same approach, history and overrides) that arrive while one of them is being answered share its
+# answer, set COALESCE_REQUESTS=false to answer every request separately
+COALESCE_REQUESTS = (os.environ.get("COALESCE_REQUESTS") or "true").lower() == "true"
+
+# Largest number of questions accepted by /ask/batch
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS") or 1000)
+
+# Set to a directory with the content files to serve citations from there instead of from blob storage, e.g. in tests
+LOCAL_CONTENT_DIR = os.environ.get("LOCAL_CONTENT_DIR")
+
+# Citation files are cached on local disk up to CONTENT_CACHE_SIZE bytes (0 to disable), and browsers may cache them for
+# CONTENT_MAX_AGE seconds, revalidating with their ETag after that
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "content-cache"
+)
+CONTENT_CACHE_SIZE = int(os.environ.get("CONTENT_CACHE_SIZE") or 1024 * 1024 * 1024)
+CONTENT_MAX_AGE = int(os.environ.get("CONTENT_MAX_AGE") or 86400)
+
+# Seconds a request to /ask or /chat may take in total, including all agent iterations and the streamed answer, before
+# it fails with 504. Every upstream call is limited to what remains of it. Set REQUEST_TIMEOUT=0 for no limit.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT") or 90)
+
+# Set to send a second search request when the first hasn't answered after this many seconds (e.g. 0.5, somewhat above
+# the usual search latency), whichever answers first is used
+SEARCH_HEDGE_AFTER = os.environ.get("SEARCH_HEDGE_AFTER")
+
+# Calls to an upstream host (OpenAI, Search, Storage) fail fast with 503 for CIRCUIT_BREAKER_RESET seconds after it
+# failed CIRCUIT_BREAKER_FAILURES times in a row, set CIRCUIT_BREAKER_FAILURES=0 to disable
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES") or 5)
+CIRCUIT_BREAKER_RESET = float(os.environ.get("CIRCUIT_BREAKER_RESET") or 30)
+
+# Tokens and requests per minute of the deployments' quotas, including the embedding deployment of the answer cache.
+# With them set, calls wait until the quota allows them instead of failing with 429, /ask and /chat ahead of
+# /ask/batch. A call that would wait longer than QUOTA_MAX_WAIT seconds (QUOTA_BATCH_MAX_WAIT for batches) fails with
+# 429 right away.
+AZURE_OPENAI_GPT_TPM = int(os.environ.get("AZURE_OPENAI_GPT_TPM") or 0)
+AZURE_OPENAI_GPT_RPM = int(os.environ.get("AZURE_OPENAI_GPT_RPM") or 0)
+AZURE_OPENAI_CHATGPT_TPM = int(os.environ.get("AZURE_OPENAI_CHATGPT_TPM") or 0)
+AZURE_OPENAI_CHATGPT_RPM = int(os.environ.get("AZURE_OPENAI_CHATGPT_RPM") or 0)
+AZURE_OPENAI_EMB_TPM = int(os.environ.get("AZURE_OPENAI_EMB_TPM") or 0)
+AZURE_OPENAI_EMB_RPM = int(os.environ.get("AZURE_OPENAI_EMB_RPM") or 0)
+QUOTA_MAX_WAIT = float(os.environ.get("QUOTA_MAX_WAIT") or 10)
+QUOTA_BATCH_MAX_WAIT = float(os.environ.get("QUOTA_BATCH_MAX_WAIT") or 120)
+
+# Set WARM_UP=true to load the approaches, build their prompts and agents and open connections to the upstream services
+# before /ready answers 200, so that the first requests to a new instance don't wait for that. Without it the work is
+# done by the first requests that need it, and /ready answers 200 right away.
+WARM_UP = (os.environ.get("WARM_UP") or "false").lower() == "true"
+
+# Token for the admin endpoints (/admin/profile), sent as "Authorization: Bearer <token>". They are disabled (404)
+# unless it's set.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Seconds between the stack samples taken of profiled requests, see /admin/profile
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL") or 0.005)
+
+# Connections kept open per host by the HTTP session shared by the Search, Storage and OpenAI clients, should be at least
+# the number of requests served concurrently by a process (see gunicorn.conf.py)
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE") or 32)
+
+# Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
+# just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate
+# AzureKeyCredential instances with the keys for each service. Created by the first client that needs it.
+azure_credential = None
+azure_credential_lock = threading.Lock()
+
+
+def get_azure_credential():
+    global azure_credential
+    if azure_credential is None:
+        with azure_credential_lock:
+            if azure_credential is None:
+                from azure.identity import DefaultAzureCredential
+
+                azure_credential = DefaultAzureCredential()
+    return azure_credential
+
+
+# One keep-alive connection pool for all outgoing requests, so that TLS handshakes are only paid once per connection.
+# Its adapter also applies the request deadline and the circuit breakers to every call.
+circuit_breakers = (
+    CircuitBreakers(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET)
+    if CIRCUIT_BREAKER_FAILURES > 0
+    else None
+)
+http_session = requests.Session()
+http_adapter = UpstreamAdapter(
+    circuit_breakers, pool_connections=8, pool_maxsize=HTTP_POOL_SIZE, max_retries=2
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+quota_max_wait = {
+    INTERACTIVE: QUOTA_MAX_WAIT,
+    DEFAULT: QUOTA_MAX_WAIT,
+    BATCH: QUOTA_BATCH_MAX_WAIT,
+}
+quota_scheduler = QuotaScheduler(
+    [
+        DeploymentQuota(deployment, tpm, rpm, quota_max_wait)
+        for deployment, tpm, rpm in [
+            (AZURE_OPENAI_GPT_DEPLOYMENT, AZURE_OPENAI_GPT_TPM, AZURE_OPENAI_GPT_RPM),
+            (
+                AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                AZURE_OPENAI_CHATGPT_TPM,
+                AZURE_OPENAI_CHATGPT_RPM,
+            ),
+            (AZURE_OPENAI_EMB_DEPLOYMENT, AZURE_OPENAI_EMB_TPM, AZURE_OPENAI_EMB_RPM),
+        ]
+        if deployment and tpm > 0 and rpm > 0
+    ]
+)
+
+# Latencies, token counts and errors are recorded for /metrics, see metrics.py
+stages.observers.append(metrics.observe_stage)
+
+# Requests can be profiled on demand, see /admin/profile
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+# Uses the identity above unless an API key is set in the OPENAI_API_KEY environment variable
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+openai_configured = False
+openai_configure_lock = threading.Lock()
+openai_token = None
+openai_token_lock = threading.Lock()
+
+
+# Imports and configures the OpenAI SDK, called by the first request (see ensure_openai_token) and by the approaches
+# before they're built. Its calls go through the shared session, the quota scheduler and the metrics hooks.
+def configure_openai():
+    global openai_configured
+    if openai_configured:
+        return
+    with openai_configure_lock:
+        if openai_configured:
+            return
+        import openai
+        import openai.api_requestor
+
+        # Used by the OpenAI SDK, which otherwise creates a session per thread
+        openai.api_requestor._make_session = lambda: http_session
+        openai.api_type = "azure" if OPENAI_API_KEY else "azure_ad"
+        openai.api_base = AZURE_OPENAI_ENDPOINT
+        openai.api_version = "2022-12-01"
+        if OPENAI_API_KEY:
+            openai.api_key = OPENAI_API_KEY
+        if quota_scheduler.quotas:
+            quota_scheduler.install()
+        metrics.install_openai_hooks()
+        openai_configured = True
+
+
+# Set up clients for Cognitive Search and Storage, each is built when it's first used
+def build_search_client():
+    if LOCAL_SEARCH_INDEX:
+        from localsearch import LocalSearchClient
+
+        return LocalSearchClient.load(LOCAL_SEARCH_INDEX)
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.search.documents import SearchClient
+
+    return SearchClient(
+        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+        index_name=AZURE_SEARCH_INDEX,
+        credential=get_azure_credential(),
+        transport=RequestsTransport(session=http_session, session_owner=False),
+    )
+
+
+def build_container_client():
+    from azure.core.pipeline.transport import RequestsTransport
+    from azure.storage.blob import BlobServiceClient
+
+    blob_client = BlobServiceClient(
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=get_azure_credential(),
+        transport=RequestsTransport(session=http_session, session_owner=False),
+    )
+    return blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+
+
+search_client = LazyClient(build_search_client)
+if LOCAL_CONTENT_DIR:
+    content_source = LocalContentSource(LOCAL_CONTENT_DIR)
+else:
+    content_source = BlobContentSource(LazyClient(build_container_client))
+content_store = ContentStore(
+    content_source,
+    DiskCache(CONTENT_CACHE_DIR, CONTENT_CACHE_SIZE)
+    if CONTENT_CACHE_SIZE > 0
+    else None,
+    max_age=CONTENT_MAX_AGE,
+)
+
+startup.report.mark("clients")
+
+# Prompt token counts are memoized per text, one counter is shared by everything that counts them
+token_counter = TokenCounter("cl100k_base")
+
+# One retriever (and result cache) is shared by all approaches so that a question asked through any of them
+# benefits from the others
+retriever = Retriever(
+    search_client,
+    KB_FIELDS_SOURCEPAGE,
+    KB_FIELDS_CONTENT,
+    cache=ResultCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+    if SEARCH_CACHE_SIZE > 0
+    else None,
+    selector=PassageSelector(token_counter, PASSAGE_TOKENS)
+    if PASSAGE_TOKENS > 0
+    else None,
+    max_content_chars=SEARCH_MAX_CONTENT_CHARS or None,
+    hedge=Hedge(float(SEARCH_HEDGE_AFTER), HTTP_POOL_SIZE)
+    if SEARCH_HEDGE_AFTER
+    else None,
+)
+
+# LLMs, prompts and agents are built once per deployment, temperature and prompt override and shared by the approaches
+agent_registry = AgentRegistry()
+
+
+# Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
+# or some derivative, here we include several for exploration purposes. Each is built (and its module imported) when
+# it's first used, see LazyApproaches.
+def retrieve_then_read():
+    configure_openai()
+    from approaches.retrievethenread import RetrieveThenReadApproach
+
+    return RetrieveThenReadApproach(
+        search_client,
+        AZURE_OPENAI_GPT_DEPLOYMENT,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        retriever,
+    )
+
+
+def read_retrieve_read():
+    configure_openai()
+    from approaches.readretrieveread import ReadRetrieveReadApproach
+
+    return ReadRetrieveReadApproach(
+        search_client,
+        AZURE_OPENAI_GPT_DEPLOYMENT,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        retriever,
+        agent_registry,
+    )
+
+
+def read_decompose_ask():
+    configure_openai()
+    from approaches.readdecomposeask import ReadDecomposeAsk
+
+    return ReadDecomposeAsk(
+        search_client,
+        AZURE_OPENAI_GPT_DEPLOYMENT,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        retriever,
+        agent_registry,
+    )
+
+
+ask_approaches = LazyApproaches(
+    {
+        "rtr": retrieve_then_read,
+        "rrr": read_retrieve_read,
+        "rda": read_decompose_ask,
+    }
+)
+
+# Created right away, it's reported on by /metrics before the chat approach has been built
+query_rewrite_cache = (
+    ResultCache(QUERY_REWRITE_CACHE_SIZE, QUERY_REWRITE_CACHE_TTL)
+    if QUERY_REWRITE_CACHE_SIZE > 0
+    else None
+)
+
+
+def chat_read_retrieve_read():
+    configure_openai()
+    from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+
+    return ChatReadRetrieveReadApproach(
+        search_client,
+        AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+        AZURE_OPENAI_GPT_DEPLOYMENT,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        retriever,
+        PromptBudget(
+            token_counter,
+            context_window=AZURE_OPENAI_CHATGPT_CONTEXT_WINDOW,
+        ),
+        query_rewrite_cache,
+        CHAT_REWRITE_FIRST_TURN,
+        float(CHAT_SPECULATIVE_OVERLAP) if CHAT_SPECULATIVE_OVERLAP else None,
+    )
+
+
+# Unwrapped, for the query rewrite counts of the chat approach (see rewrite_stats)
+chat_base_approaches = LazyApproaches({"rrr": chat_read_retrieve_read})
+chat_approaches = chat_base_approaches
+
+if ANSWER_CACHE_EMBEDDER:
+    from answercache import AzureOpenAIEmbedder, HashingEmbedder, SemanticAnswerCache
+
+    answer_cache = SemanticAnswerCache(
+        AzureOpenAIEmbedder(AZURE_OPENAI_EMB_DEPLOYMENT)
+        if ANSWER_CACHE_EMBEDDER == "azure"
+        else HashingEmbedder(),
+        ANSWER_CACHE_THRESHOLD,
+        ANSWER_CACHE_SIZE,
+    )
+    ask_approaches = ask_approaches.wrapped(
+        lambda name, impl: CachedApproach(name, impl, answer_cache)
+    )
+    # Only the first turn of a chat can be answered from the cache, later turns depend on the conversation
+    chat_approaches = chat_approaches.wrapped(
+        lambda name, impl: CachedApproach(
+            "chat-" + name,
+            impl,
+            answer_cache,
+            lambda history: history[-1]["user"] if len(history) == 1 else None,
+        )
+    )
+else:
+    answer_cache = None
+
+# In front of the answer cache, so that concurrent misses only look it up once
+if COALESCE_REQUESTS:
+    flights = SingleFlight()
+    ask_approaches = ask_approaches.wrapped(
+        lambda name, impl: CoalescingApproach(name, impl, flights)
+    )
+    chat_approaches = chat_approaches.wrapped(
+        lambda name, impl: CoalescingApproach("chat-" + name, impl, flights)
+    )
+else:
+    flights = None
+
+trace_store = TraceStore(TRACE_STORE_SIZE)
+
+startup.report.mark("approaches")
+
+# The approaches keep per-request state in a RequestContext, so one process can serve many requests from a thread pool.
+# The Docker image runs it under gunicorn with threaded workers, see gunicorn.conf.py.
+app = Flask(__name__)
+
+
+# Serve content files from blob storage from within the app to keep the example self-contained, see ContentStore.
+# *** NOTE *** this assumes that the content files are public, or at least that all users of the app
+# can access all the files.
+@app.route("/content/<path>")
+def content_file(path):
+    try:
+        status, headers, body = content_store.respond(path, request.headers)
+    except ContentNotFound:
+        return jsonify({"error": "not found"}), 404
+    return Response(body, status, headers, direct_passthrough=True)
+
+
+@app.route("/content/cache", methods=["GET"])
+def content_cache_stats():
+    return jsonify(content_store.stats())
+
+
+@app.route("/ask", methods=["POST"])
+def ask():
+    ensure_openai_token()
+    approach = request.json["approach"]
+    try:
+        impl = ask_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        overrides = request.json.get("overrides") or {}
+        if request.json.get("stream"):
+            chunks = serving_stream(
+                impl.run_stream(request.json["question"], overrides),
+                "ask",
+                approach,
+                profile=profile_requested(request.headers),
+            )
+            return ndjson_response(with_trace(c, overrides) for c in chunks)
+        with serving("ask", approach, profile=profile_requested(request.headers)):
+            r = impl.run(request.json["question"], overrides)
+        return jsonify(with_trace(r, overrides))
+    except Exception as e:
+        logging.exception("Exception in /ask")
+        return jsonify({"error": str(e)}), error_status(e)
+
+
+# Answers a list of questions with one approach and the same overrides, e.g. for evaluation or to warm the caches. The
+# response is streamed as newline delimited JSON with one line per question in input order, each with the index of its
+# question and either a response or an "error".
+@app.route("/ask/batch", methods=["POST"])
+def ask_batch():
+    ensure_openai_token()
+    approach = request.json["approach"]
+    impl = ask_approaches.get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    questions = request.json.get("questions") or []
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"at most {BATCH_MAX_QUESTIONS} questions"}), 400
+    overrides = request.json.get("overrides") or {}
+    responses = serving_stream(
+        impl.run_batch(questions, overrides), "ask_batch", approach, BATCH, None
+    )
+    return ndjson_response(
+        {"index": i, **with_trace(r, overrides)} for i, r in enumerate(responses)
+    )
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    ensure_openai_token()
+    approach = request.json["approach"]
+    try:
+        impl = chat_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        overrides = request.json.get("overrides") or {}
+        if request.json.get("stream"):
+            chunks = serving_stream(
+                impl.run_stream(request.json["history"], overrides),
+                "chat",
+                approach,
+                profile=profile_requested(request.headers),
+            )
+            return ndjson_response(with_trace(c, overrides) for c in chunks)
+        with serving("chat", approach, profile=profile_requested(request.headers)):
+            r = impl.run(request.json["history"], overrides)
+        return jsonify(with_trace(r, overrides))
+    except Exception as e:
+        logging.exception("Exception in /chat")
+        return jsonify({"error": str(e)}), error_status(e)
+
+
+@app.route("/thoughts/<trace_id>", methods=["GET"])
+def thoughts(trace_id):
+    t = trace_store.get(trace_id)
+    if t is None:
+        return jsonify({"error": "unknown or expired trace"}), 404
+    return jsonify({"thoughts": t})
+
+
+@app.route("/search/cache", methods=["GET"])
+def search_cache_stats():
+    if retriever.cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **retriever.cache.stats()})
+
+
+# Call after the search index has been refreshed so that no stale results are served until the TTL runs out. Cached
+# answers were built from the same results, so they are dropped as well.
+@app.route("/search/cache", methods=["DELETE"])
+def search_cache_invalidate():
+    retriever.invalidate()
+    if answer_cache is not None:
+        answer_cache.invalidate()
+    return "", 204
+
+
+@app.route("/chat/rewrites", methods=["GET"])
+def chat_rewrite_stats():
+    return jsonify(rewrite_stats())
+
+
+# How the chat approach got its search queries, only the cache counters until the approach has been built
+def rewrite_stats() -> dict:
+    impl = chat_base_approaches.approaches.get("rrr")
+    if impl is not None:
+        return impl.rewrite_stats()
+    if query_rewrite_cache is None:
+        return {}
+    return {"cache": query_rewrite_cache.stats()}
+
+
+@app.route("/answers/cache", methods=["GET"])
+def answer_cache_stats():
+    if answer_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **answer_cache.stats()})
+
+
+@app.route("/requests/coalesced", methods=["GET"])
+def coalescing_stats():
+    if flights is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **flights.stats()})
+
+
+@app.route("/upstreams", methods=["GET"])
+def upstream_stats():
+    return jsonify(upstream_status())
+
+
+@app.route("/openai/quota", methods=["GET"])
+def quota_stats():
+    return jsonify(quota_scheduler.stats())
+
+
+# Metrics of this process only, when running several worker processes (see gunicorn.conf.py) each scrape is answered
+# by one of them
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Readiness probe, answers 503 until the warm-up has run (see WARM_UP)
+@app.route("/ready", methods=["GET"])
+def ready():
+    if not warm_up.ready.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True})
+
+
+# Where the startup of this process went: phases, import time by package and the slowest modules, the warm-up steps
+# and the approaches loaded so far with the seconds it took to load each of them
+@app.route("/startup", methods=["GET"])
+def startup_stats():
+    return jsonify(startup_status())
+
+
+def startup_status() -> dict:
+    return {
+        **startup.report.report(),
+        "warm_up": warm_up.stats(),
+        "approaches": {
+            "ask": ask_approaches.stats(),
+            "chat": chat_approaches.stats(),
+        },
+    }
+
+
+# Profiles the next "requests" requests to /ask and /chat, or a fraction "rate" of them for "duration" seconds (60 by
+# default), e.g. {"requests": 20} or {"rate": 0.05, "duration": 300}. A single request is profiled by sending it with an
+# "X-Profile: <admin token>" header. Samples are added to the profile until it's cleared.
+@app.route("/admin/profile", methods=["POST"])
+def profile_arm():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    args = request.json or {}
+    profiler.arm(
+        int(args.get("requests") or 0),
+        float(args.get("rate") or 0),
+        float(args.get("duration") or 60),
+    )
+    return jsonify(profiler.stats())
+
+
+# The profile in collapsed stack format, for flamegraph.pl or speedscope, or its status with ?format=json
+@app.route("/admin/profile", methods=["GET"])
+def profile_read():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    if request.args.get("format") == "json":
+        return jsonify(profiler.stats())
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
+
+# Stops selecting requests and clears the profile
+@app.route("/admin/profile", methods=["DELETE"])
+def profile_clear():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    profiler.disarm()
+    profiler.clear()
+    return "", 204
+
+
+def is_admin(headers) -> bool:
+    return bool(ADMIN_TOKEN) and secret_matches(
+        headers.get("Authorization"), f"Bearer {ADMIN_TOKEN}"
+    )
+
+
+def profile_requested(headers) -> bool:
+    return bool(ADMIN_TOKEN) and secret_matches(headers.get("X-Profile"), ADMIN_TOKEN)
+
+
+# Compared as bytes, compare_digest refuses strings with non-ASCII characters
+def secret_matches(value: Optional[str], secret: str) -> bool:
+    return hmac.compare_digest((value or "").encode("utf-8"), secret.encode("utf-8"))
+
+
+# Counters of the caches, read when /metrics is scraped
+def cache_stats() -> dict:
+    stats = {"content_info": content_store.infos.stats()}
+    if retriever.cache is not None:
+        stats["search"] = retriever.cache.stats()
+    if answer_cache is not None:
+        stats["answer"] = answer_cache.stats()
+    if query_rewrite_cache is not None:
+        stats["query_rewrite"] = query_rewrite_cache.stats()
+    if content_store.cache is not None:
+        stats["content_file"] = content_store.cache.stats()
+    return stats
+
+
+for counter in ("hits", "misses", "evictions"):
+    metrics.registry.collect(
+        f"app_cache_{counter}_total",
+        f"Cache {counter}",
+        "counter",
+        ("cache",),
+        lambda counter=counter: [
+            ((name,), s[counter]) for name, s in cache_stats().items()
+        ],
+    )
+metrics.registry.collect(
+    "app_openai_waiting",
+    "Calls waiting for their deployment's quota",
+    "gauge",
+    ("deployment",),
+    lambda: [((d,), s["waiting"]) for d, s in quota_scheduler.stats().items()],
+)
+
+
+# Requests to /ask and /chat run under their deadline and priority, and record their metrics with the endpoint and
+# approach as labels. Selected requests are profiled, tagged with the endpoint and approach.
+@contextmanager
+def serving(endpoint: str, approach: str, p: int = INTERACTIVE, profile: bool = False):
+    with metrics.tracking(endpoint, approach), deadline(REQUEST_TIMEOUT), priority(p):
+        if profiler.select(profile):
+            with profiler.profiling(f"{endpoint}/{approach}"):
+                yield
+        else:
+            yield
+
+
+# Same for streamed responses, which are produced after the request handler has returned
+def serving_stream(
+    chunks,
+    endpoint: str,
+    approach: str,
+    p: int = INTERACTIVE,
+    timeout=REQUEST_TIMEOUT,
+    profile: bool = False,
+):
+    if profiler.select(profile):
+        chunks = profiler.profiled_stream(chunks, f"{endpoint}/{approach}")
+    return metrics.tracked(bounded(prioritized(chunks, p), timeout), endpoint, approach)
+
+
+def upstream_status() -> dict:
+    return {
+        "request_timeout": REQUEST_TIMEOUT or None,
+        "breakers": circuit_breakers.stats() if circuit_breakers is not None else None,
+        "search_hedge": retriever.hedge.stats()
+        if retriever.hedge is not None
+        else None,
+    }
+
+
+def error_status(e: Exception) -> int:
+    if isinstance(e, DeadlineExceeded):
+        return 504
+    if isinstance(e, CircuitOpen):
+        return 503
+    if isinstance(e, QuotaExceeded):
+        return 429
+    return 500
+
+
+# Replaces the thoughts of a response (or streamed chunk) with the ID they are kept under in the trace store, or renders
+# them inline if the client asked for that. Returns a copy, responses may be shared through the answer cache.
+def with_trace(r: dict, overrides: dict) -> dict:
+    if "thoughts" not in r:
+        return r
+    r = dict(r)
+    if overrides.get("include_thoughts"):
+        r["thoughts"] = r["thoughts"]()
+    else:
+        r["trace_id"] = trace_store.put(r.pop("thoughts"))
+    return r
+
+
+# Streamed responses are newline delimited JSON, one partial response per line (see Approach.run_stream). Errors after
+# the response has started can only be reported in-band, as a final line with an "error" field.
+def ndjson_response(chunks) -> Response:
+    def generate():
+        try:
+            for chunk in chunks:
+                yield json.dumps(chunk) + "\n"
+        except Exception as e:
+            logging.exception("Exception while streaming")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def openai_token_stale() -> bool:
+    if not openai_configured:
+        return True
+    if OPENAI_API_KEY:
+        return False
+    return openai_token is None or openai_token.expires_on < int(time.time()) + 60
+
+
+# Request threads share the token, only one of them refreshes it. The first call also configures the OpenAI SDK.
+def ensure_openai_token():
+    global openai_token
+    if openai_token_stale():
+        configure_openai()
+        with openai_token_lock:
+            if openai_token_stale():
+                import openai
+
+                token = get_azure_credential().get_token(
+                    "https://cognitiveservices.azure.com/.default"
+                )
+                openai.api_key = token.token
+                openai_token = token
+
+
+# Any HTTP response will do, it leaves a kept-alive connection in the pool of the shared session
+def open_connections():
+    urls = [AZURE_OPENAI_ENDPOINT]
+    if not LOCAL_SEARCH_INDEX:
+        urls.append(f"https://{AZURE_SEARCH_SERVICE}.search.windows.net")
+    if not LOCAL_CONTENT_DIR:
+        urls.append(f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net")
+    for url in urls:
+        http_session.head(url, timeout=10)
+
+
+warm_up = startup.WarmUp(
+    [
+        ("openai_token", ensure_openai_token),
+        ("connections", open_connections),
+        ("search_client", lambda: search_client.client),
+        ("tokenizer", lambda: token_counter.count("")),
+        *[
+            (f"ask:{name}", lambda name=name: ask_approaches[name].warm_up())
+            for name in ask_approaches
+        ],
+        *[
+            (f"chat:{name}", lambda name=name: chat_approaches[name].warm_up())
+            for name in chat_approaches
+        ],
+    ]
+)
+if WARM_UP:
+    warm_up.start()
+else:
+    warm_up.ready.set()
+
+startup.report.imports.uninstall()
+startup.report.mark("app")
+startup.report.log()
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8000)
@@ -1,3 +1,49 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+
+# What one run of an approach collects along the way. Approach instances are shared by all requests and threads, so
+# anything specific to a request lives here and is passed to the tools instead of being kept on the approach.
+@dataclass
+class RequestContext:
+    overrides: dict
+    # Results of the last search, returned as the data points of the answer
+    results: List[str] = field(default_factory=list)
+    # Tool outputs by (tool, normalized query), so repeated queries within the run are answered without a search
+    observations: Dict[tuple, Any] = field(default_factory=dict)
+
+
 class Approach:
     def run(self, q: str, use_summaries: bool) -> any:
         raise NotImplementedError
+
+    # Builds what the approach would otherwise build on its first request (e.g. prompts and agents for the default
+    # overrides), called ahead of serving when warming up (see app.warm_up)
+    def warm_up(self):
+        pass
+
+    # Async counterpart of run() used by the ASGI app. Approaches without a native async implementation (e.g. the
+    # LangChain agents) run their sync version on a worker thread so the event loop is never blocked.
+    async def arun(self, q: str, overrides: dict) -> any:
+        return await asyncio.to_thread(self.run, q, overrides)
+
+    # Streaming variants yield partial responses that the client merges in order: data_points and thoughts replace
+    # earlier values, answer is appended. Approaches that can't stream send their whole response as a single chunk.
+    # In both forms "thoughts" is a function that renders them, the app decides whether to render them inline or keep
+    # them in its trace store until a client asks for them.
+    def run_stream(self, q: str, overrides: dict) -> Iterator[dict]:
+        yield self.run(q, overrides)
+
+    async def arun_stream(self, q: str, overrides: dict) -> AsyncIterator[dict]:
+        yield await self.arun(q, overrides)
+
+    # Answers many questions with the same overrides, yielding one response per question in input order. A question that
+    # fails yields {"error": ...} instead of stopping the batch. Approaches that can share work between questions (e.g.
+    # one completion call for several prompts) override this.
+    def run_batch(self, questions: List[str], overrides: dict) -> Iterator[dict]:
+        for q in questions:
+            try:
+                yield self.run(q, overrides)
+            except Exception as e:
+                yield {"error": str(e)}
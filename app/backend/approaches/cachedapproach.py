@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Iterator, List, Optional
+from approaches.approach import Approach
+from stages import stage
+
+if TYPE_CHECKING:
+    import numpy as np
+    from answercache import SemanticAnswerCache
+
+
+def merge_chunk(response: dict, chunk: dict):
+    for key, value in chunk.items():
+        if key == "answer":
+            response["answer"] = response.get("answer", "") + value
+        else:
+            response[key] = value
+
+
+# Puts a SemanticAnswerCache in front of another approach. question_of extracts the text to match from the approach
+# input and may return None to bypass the cache, e.g. for chat turns that depend on earlier history.
+class CachedApproach(Approach):
+    embed_batch_size = 16
+
+    def __init__(
+        self,
+        name: str,
+        approach: Approach,
+        cache: "SemanticAnswerCache",
+        question_of: Callable[[Any], Optional[str]] = lambda q: q,
+    ):
+        self.name = name
+        self.approach = approach
+        self.cache = cache
+        self.question_of = question_of
+
+    def warm_up(self):
+        self.approach.warm_up()
+
+    def run(self, q: Any, overrides: dict) -> any:
+        question = self.question_of(q)
+        if question is None:
+            return self.approach.run(q, overrides)
+        scope = self.scope(overrides)
+        vector = self.embed(question)
+        r = self.cache.get(vector, scope)
+        if r is None:
+            r = self.approach.run(q, overrides)
+            self.cache.put(vector, scope, r)
+        return r
+
+    async def arun(self, q: Any, overrides: dict) -> any:
+        question = self.question_of(q)
+        if question is None:
+            return await self.approach.arun(q, overrides)
+        scope = self.scope(overrides)
+        vector = await self.aembed(question)
+        r = self.cache.get(vector, scope)
+        if r is None:
+            r = await self.approach.arun(q, overrides)
+            self.cache.put(vector, scope, r)
+        return r
+
+    def run_stream(self, q: Any, overrides: dict) -> Iterator[dict]:
+        question = self.question_of(q)
+        if question is None:
+            yield from self.approach.run_stream(q, overrides)
+            return
+        scope = self.scope(overrides)
+        vector = self.embed(question)
+        r = self.cache.get(vector, scope)
+        if r is not None:
+            yield r
+            return
+        response = {}
+        for chunk in self.approach.run_stream(q, overrides):
+            merge_chunk(response, chunk)
+            yield chunk
+        self.cache.put(vector, scope, response)
+
+    async def arun_stream(self, q: Any, overrides: dict) -> AsyncIterator[dict]:
+        question = self.question_of(q)
+        if question is None:
+            async for chunk in self.approach.arun_stream(q, overrides):
+                yield chunk
+            return
+        scope = self.scope(overrides)
+        vector = await self.aembed(question)
+        r = self.cache.get(vector, scope)
+        if r is not None:
+            yield r
+            return
+        response = {}
+        async for chunk in self.approach.arun_stream(q, overrides):
+            merge_chunk(response, chunk)
+            yield chunk
+        self.cache.put(vector, scope, response)
+
+    # Questions are embedded embed_batch_size at a time (embedding deployments limit the inputs per call), only the ones
+    # not answered from the cache are passed on as a batch. Questions whose embedding failed bypass the cache.
+    def run_batch(self, questions: List[Any], overrides: dict) -> Iterator[dict]:
+        scope = self.scope(overrides)
+        cacheable = [
+            (i, question)
+            for i, question in enumerate(map(self.question_of, questions))
+            if question is not None
+        ]
+        vectors = [None] * len(questions)
+        cached = [None] * len(questions)
+        for start in range(0, len(cacheable), self.embed_batch_size):
+            chunk = cacheable[start : start + self.embed_batch_size]
+            try:
+                with stage("embed"):
+                    embedded = self.cache.embed_many([q for _, q in chunk])
+            except Exception:
+                logging.exception("Embedding failed, answering without the cache")
+                continue
+            for (i, _), vector in zip(chunk, embedded):
+                vectors[i] = vector
+                cached[i] = self.cache.get(vector, scope)
+        misses = [q for q, r in zip(questions, cached) if r is None]
+        answered = self.approach.run_batch(misses, overrides)
+        for vector, r in zip(vectors, cached):
+            if r is None:
+                r = next(answered)
+                if vector is not None and "error" not in r:
+                    self.cache.put(vector, scope, r)
+            yield r
+
+    def embed(self, question: str) -> "np.ndarray":
+        with stage("embed"):
+            return self.cache.embed(question)
+
+    # The embedding call blocks, it's made on a worker thread
+    async def aembed(self, question: str) -> "np.ndarray":
+        with stage("embed"):
+            return await asyncio.to_thread(self.cache.embed, question)
+
+    def scope(self, overrides: dict) -> str:
+        return self.name + ":" + json.dumps(overrides, sort_keys=True)
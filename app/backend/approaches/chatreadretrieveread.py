@@ -1,8 +1,25 @@
+import asyncio
+import hashlib
+import json
 import openai
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
 from approaches.approach import Approach
-from text import nonewlines
+from retrieval import ResultCache, Retriever, normalize_query
+from stages import stage
+import deadlines
+from tokenbudget import PromptBudget, TokenCounter
+
+# Shared by all requests, runs the speculative searches of the sync code paths (in the context of their request, which
+# carries its deadline). Discarded searches are cancelled, see deadlines.cancellable.
+speculative_executor = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="chat-speculative"
+)
 
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
@@ -49,31 +66,220 @@ class ChatReadRetrieveReadApproach(Approach):
         gpt_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        retriever: Retriever = None,
+        budget: PromptBudget = None,
+        rewrite_cache: ResultCache = None,
+        rewrite_first_turn: bool = True,
+        speculative_overlap: Optional[float] = None,
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
-
-    def run(self, history: list[dict], overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = (
-            "category ne '{}'".format(exclude_category.replace("'", "''"))
-            if exclude_category
-            else None
+        self.retriever = retriever or Retriever(
+            search_client, sourcepage_field, content_field
         )
+        self.budget = budget or PromptBudget(TokenCounter())
+        self.rewrite_cache = rewrite_cache
+        self.rewrite_first_turn = rewrite_first_turn
+        self.speculative_overlap = speculative_overlap
+        self.rewrites = {
+            "skipped": 0,
+            "cached": 0,
+            "completed": 0,
+            "speculative_used": 0,
+            "speculative_discarded": 0,
+        }
+        self._rewrites_lock = threading.Lock()
 
+    def run(self, history: list[dict], overrides: dict) -> any:
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        q, results = self.rewrite_and_retrieve(history, overrides)
+
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        prompt = self.get_prompt(history, results, overrides)
+        with stage("completion"):
+            completion = openai.Completion.create(
+                **self.completion_args(prompt, overrides)
+            )
+
+        return self.get_response(q, results, prompt, completion)
+
+    async def arun(self, history: list[dict], overrides: dict) -> any:
+        q, results = await self.arewrite_and_retrieve(history, overrides)
+
+        prompt = self.get_prompt(history, results, overrides)
+        with stage("completion"):
+            completion = await openai.Completion.acreate(
+                **self.completion_args(prompt, overrides)
+            )
+
+        return self.get_response(q, results, prompt, completion)
+
+    def run_stream(self, history: list[dict], overrides: dict) -> Iterator[dict]:
+        q, results = self.rewrite_and_retrieve(history, overrides)
+
+        prompt = self.get_prompt(history, results, overrides)
+        yield {
+            "data_points": results,
+            "thoughts": partial(self.get_thoughts, q, prompt),
+        }
+        with stage("completion"):
+            for chunk in openai.Completion.create(
+                stream=True, **self.completion_args(prompt, overrides)
+            ):
+                if chunk.choices:
+                    yield {"answer": chunk.choices[0].text}
+
+    async def arun_stream(
+        self, history: list[dict], overrides: dict
+    ) -> AsyncIterator[dict]:
+        q, results = await self.arewrite_and_retrieve(history, overrides)
+
+        prompt = self.get_prompt(history, results, overrides)
+        yield {
+            "data_points": results,
+            "thoughts": partial(self.get_thoughts, q, prompt),
+        }
+        with stage("completion"):
+            async for chunk in await openai.Completion.acreate(
+                stream=True, **self.completion_args(prompt, overrides)
+            ):
+                if chunk.choices:
+                    yield {"answer": chunk.choices[0].text}
+
+    # With speculative_overlap set, the last question is searched as asked while its query is being rewritten. The
+    # speculative results are used if the rewritten query shares at least that fraction of its words with the question
+    # (Jaccard similarity), otherwise the rewritten query is searched after all. Returns the query whose results are
+    # returned, which is the question as asked when the speculative results are used.
+    def rewrite_and_retrieve(
+        self, history: list[dict], overrides: dict
+    ) -> Tuple[str, List[str]]:
+        q, key = self.known_query(history)
+        if q is not None:
+            return q, self.retriever.retrieve(q, overrides)
+
+        question = history[-1]["user"]
+        speculative = None
+        cancel = threading.Event()
+        if self.speculative_overlap is not None:
+            speculative = speculative_executor.submit(
+                copy_context().run,
+                deadlines.cancellable,
+                cancel,
+                self.retriever.retrieve,
+                question,
+                overrides,
+            )
+        try:
+            with stage("query_rewrite"):
+                completion = openai.Completion.create(
+                    **self.query_completion_args(history)
+                )
+            q = self.remember_query(key, completion.choices[0].text)
+
+            if speculative is not None and self.use_speculative(question, q):
+                try:
+                    return question, speculative.result()
+                except Exception:
+                    pass
+        finally:
+            # A discarded search gives up its executor slot if it hasn't started yet, and otherwise stops before its
+            # next upstream call
+            if speculative is not None:
+                speculative.cancel()
+                cancel.set()
+        return q, self.retriever.retrieve(q, overrides)
+
+    async def arewrite_and_retrieve(
+        self, history: list[dict], overrides: dict
+    ) -> Tuple[str, List[str]]:
+        q, key = self.known_query(history)
+        if q is not None:
+            return q, await self.retriever.aretrieve(q, overrides)
+
+        question = history[-1]["user"]
+        speculative = None
+        if self.speculative_overlap is not None:
+            speculative = asyncio.ensure_future(
+                self.retriever.aretrieve(question, overrides)
+            )
+        try:
+            with stage("query_rewrite"):
+                completion = await openai.Completion.acreate(
+                    **self.query_completion_args(history)
+                )
+            q = self.remember_query(key, completion.choices[0].text)
+
+            if speculative is not None and self.use_speculative(question, q):
+                try:
+                    return question, await speculative
+                except Exception:
+                    pass
+        finally:
+            if speculative is not None:
+                speculative.cancel()
+        return q, await self.retriever.aretrieve(q, overrides)
+
+    # Words are compared as they are, a rewrite into another language (query_prompt_template translates into English)
+    # shares next to none with the question and is never close enough
+    def use_speculative(self, question: str, q: str) -> bool:
+        asked = set(re.findall(r"\w+", normalize_query(question)))
+        rewritten = set(re.findall(r"\w+", normalize_query(q)))
+        union = asked | rewritten
+        overlap = len(asked & rewritten) / len(union) if union else 1.0
+        used = overlap >= self.speculative_overlap
+        self.count_rewrite("speculative_used" if used else "speculative_discarded")
+        return used
+
+    # Returns the search query for a conversation if it is known without a completion, and the key the rewritten query
+    # is cached under. The first question of a conversation has no history to condense, with rewrite_first_turn unset it
+    # is searched as asked (skipping the translation into English keywords). Counts how often each of these paths is
+    # taken, completed rewrites are counted once they have succeeded (see remember_query).
+    def known_query(self, history: list[dict]) -> Tuple[Optional[str], Optional[str]]:
+        if len(history) == 1 and not self.rewrite_first_turn:
+            self.count_rewrite("skipped")
+            return history[-1]["user"], None
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    [normalize_query(h["user"]), normalize_query(h.get("bot") or "")]
+                    for h in history
+                ]
+            ).encode()
+        ).hexdigest()
+        q = self.rewrite_cache.get(key) if self.rewrite_cache is not None else None
+        if q is not None:
+            self.count_rewrite("cached")
+        return q, key
+
+    def remember_query(self, key: str, q: str) -> str:
+        self.count_rewrite("completed")
+        if self.rewrite_cache is not None:
+            self.rewrite_cache.put(key, q)
+        return q
+
+    def count_rewrite(self, path: str):
+        with self._rewrites_lock:
+            self.rewrites[path] += 1
+
+    def rewrite_stats(self) -> dict:
+        with self._rewrites_lock:
+            stats = dict(self.rewrites)
+        if self.rewrite_cache is not None:
+            stats["cache"] = self.rewrite_cache.stats()
+        return stats
+
+    def query_completion_args(self, history: list[dict]) -> dict:
         prompt = self.query_prompt_template.format(
             chat_history=self.get_chat_history_as_text(
                 history, include_last_turn=False
             ),
             question=history[-1]["user"],
         )
-        completion = openai.Completion.create(
+        return dict(
             engine=self.gpt_deployment,
             prompt=prompt,
             temperature=0.0,
@@ -81,38 +287,10 @@ class ChatReadRetrieveReadApproach(Approach):
             n=1,
             stop=["\n"],
         )
-        q = completion.choices[0].text
-
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
-                q,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="de-de",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
-            )
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field]
-                + ": "
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
-                for doc in r
-            ]
-        content = "\n".join(results)
 
+    def get_prompt(
+        self, history: list[dict], results: list[str], overrides: dict
+    ) -> str:
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content
             if overrides.get("suggest_followup_questions")
@@ -122,61 +300,64 @@ class ChatReadRetrieveReadApproach(Approach):
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
         if prompt_override is None:
-            prompt = self.prompt_prefix.format(
-                injected_prompt="",
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
-                follow_up_questions_prompt=follow_up_questions_prompt,
-            )
+            template, injected_prompt = self.prompt_prefix, ""
         elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(
-                injected_prompt=prompt_override[3:] + "\n",
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
-                follow_up_questions_prompt=follow_up_questions_prompt,
-            )
+            template, injected_prompt = self.prompt_prefix, prompt_override[3:] + "\n"
         else:
-            prompt = prompt_override.format(
-                sources=content,
-                chat_history=self.get_chat_history_as_text(history),
+            template, injected_prompt = prompt_override, ""
+
+        def format_prompt(sources: str, chat_history: str) -> str:
+            return template.format(
+                injected_prompt=injected_prompt,
+                sources=sources,
+                chat_history=chat_history,
                 follow_up_questions_prompt=follow_up_questions_prompt,
             )
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = openai.Completion.create(
+        # Fit sources and history into what the context window leaves next to the template and the completion
+        sources, chat_history = self.budget.fit(
+            format_prompt("", ""), results, self.get_chat_turns(history)
+        )
+        return format_prompt(sources, chat_history)
+
+    def completion_args(self, prompt: str, overrides: dict) -> dict:
+        return dict(
             engine=self.chatgpt_deployment,
             prompt=prompt,
             temperature=overrides.get("temperature") or 0.7,
-            max_tokens=1024,
+            max_tokens=self.budget.completion_tokens,
             n=1,
             stop=["<|im_end|>", "<|im_start|>"],
         )
 
+    def get_response(self, q: str, results: list[str], prompt: str, completion) -> dict:
         return {
             "data_points": results,
             "answer": completion.choices[0].text,
-            "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>"
-            + prompt.replace("\n", "<br>"),
+            "thoughts": partial(self.get_thoughts, q, prompt),
         }
 
+    def get_thoughts(self, q: str, prompt: str) -> str:
+        return f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
+
     def get_chat_history_as_text(
         self, history, include_last_turn=True, approx_max_tokens=1000
     ) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = (
-                """<|im_start|>user"""
-                + "\n"
-                + h["user"]
-                + "\n"
-                + """<|im_end|>"""
-                + "\n"
-                + """<|im_start|>assistant"""
-                + "\n"
-                + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "")
-                + "\n"
-                + history_text
-            )
-            if len(history_text) > approx_max_tokens * 4:
-                break
-        return history_text
+        turns = self.get_chat_turns(history if include_last_turn else history[:-1])
+        kept, _ = self.budget.history(turns, approx_max_tokens)
+        return "".join(kept)
+
+    def get_chat_turns(self, history: list[dict]) -> list[str]:
+        return [
+            """<|im_start|>user"""
+            + "\n"
+            + h["user"]
+            + "\n"
+            + """<|im_end|>"""
+            + "\n"
+            + """<|im_start|>assistant"""
+            + "\n"
+            + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "")
+            + "\n"
+            for h in history
+        ]
@@ -0,0 +1,56 @@
+import json
+from typing import Any, AsyncIterator, Iterator, List
+from approaches.approach import Approach
+from retrieval import normalize_query
+from singleflight import SingleFlight
+
+
+# Normalizes the text in a question or chat history, the same way as search queries
+def normalized(value: Any) -> Any:
+    if isinstance(value, str):
+        return normalize_query(value)
+    if isinstance(value, list):
+        return [normalized(v) for v in value]
+    if isinstance(value, dict):
+        return {k: normalized(v) for k, v in value.items()}
+    return value
+
+
+# Puts a SingleFlight in front of another approach, so that identical requests (same approach, normalized question or
+# chat history and overrides) that arrive while one of them is in flight share its execution
+class CoalescingApproach(Approach):
+    def __init__(self, name: str, approach: Approach, flights: SingleFlight):
+        self.name = name
+        self.approach = approach
+        self.flights = flights
+
+    def warm_up(self):
+        self.approach.warm_up()
+
+    def run(self, q: Any, overrides: dict) -> any:
+        return self.flights.run(
+            self.key(q, overrides), lambda: self.approach.run(q, overrides)
+        )
+
+    async def arun(self, q: Any, overrides: dict) -> any:
+        return await self.flights.arun(
+            self.key(q, overrides), lambda: self.approach.arun(q, overrides)
+        )
+
+    def run_stream(self, q: Any, overrides: dict) -> Iterator[dict]:
+        yield from self.flights.stream(
+            self.key(q, overrides), lambda: self.approach.run_stream(q, overrides)
+        )
+
+    async def arun_stream(self, q: Any, overrides: dict) -> AsyncIterator[dict]:
+        async for chunk in self.flights.astream(
+            self.key(q, overrides), lambda: self.approach.arun_stream(q, overrides)
+        ):
+            yield chunk
+
+    # Batches come from offline jobs, they are passed on as they are
+    def run_batch(self, questions: List[Any], overrides: dict) -> Iterator[dict]:
+        return self.approach.run_batch(questions, overrides)
+
+    def key(self, q: Any, overrides: dict) -> str:
+        return json.dumps([self.name, normalized(q), overrides], sort_keys=True)
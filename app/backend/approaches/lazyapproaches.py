@@ -0,0 +1,61 @@
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator
+from approaches.approach import Approach
+
+
+# Raised instead of the factory's error, which could be a KeyError and would then read as an unknown approach
+class ApproachLoadError(Exception):
+    pass
+
+
+# Approaches by name, each built by its factory when it's first asked for. Factories import the approach's module
+# themselves, so the LangChain machinery of the agent approaches is only loaded by processes that use them (or warm
+# them up, see app.warm_up). Iterating over the values builds all of them. Each approach has its own lock, a slow one
+# being built doesn't hold up the first requests for the others.
+class LazyApproaches(Mapping):
+    def __init__(self, factories: Dict[str, Callable[[], Approach]]):
+        self.factories = factories
+        self.approaches: Dict[str, Approach] = {}
+        self.load_seconds: Dict[str, float] = {}
+        self._locks = {name: threading.Lock() for name in factories}
+
+    def __getitem__(self, name: str) -> Approach:
+        approach = self.approaches.get(name)
+        if approach is not None:
+            return approach
+        factory = self.factories[name]
+        with self._locks[name]:
+            approach = self.approaches.get(name)
+            if approach is None:
+                start = time.perf_counter()
+                try:
+                    approach = factory()
+                except ApproachLoadError:
+                    raise
+                except Exception as e:
+                    raise ApproachLoadError(
+                        f"approach {name} failed to load: {e}"
+                    ) from e
+                self.load_seconds[name] = time.perf_counter() - start
+                self.approaches[name] = approach
+        return approach
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.factories)
+
+    def __len__(self) -> int:
+        return len(self.factories)
+
+    # The same names with every approach wrapped (e.g. in a CachedApproach) once it's built
+    def wrapped(self, wrap: Callable[[str, Approach], Approach]) -> "LazyApproaches":
+        return LazyApproaches(
+            {name: lambda name=name: wrap(name, self[name]) for name in self.factories}
+        )
+
+    def stats(self) -> dict:
+        return {
+            name: self.load_seconds.get(name) if name in self.approaches else None
+            for name in self.factories
+        }
@@ -1,15 +1,25 @@
-import openai
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import PromptTemplate, BasePromptTemplate
-from langchain.callbacks.base import CallbackManager
+from langchain.prompts import PromptTemplate
+from langchain.chains import LLMChain
 from langchain.agents import Tool, AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
-from text import nonewlines
-from typing import List
+from agentregistry import AgentRegistry
+from langchainadapters import TraceCollector, handling, request_callback_manager
+from retrieval import Retriever, normalize_query
+from stages import stage
+from typing import Any, Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+# Shared by all requests, bounds the number of concurrent sub-queries of multi-query actions. Sub-queries run in the
+# context of their request, which carries its deadline.
+fanout_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rda-fanout")
+
+# Separates the independent queries of one Search or Lookup action (see PREFIX). A single semicolon can be part of a
+# query, two in a row aren't.
+QUERY_SEPARATOR = ";;"
 
 
 class ReadDecomposeAsk(Approach):
@@ -19,121 +29,141 @@ class ReadDecomposeAsk(Approach):
         openai_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        retriever: Retriever = None,
+        registry: AgentRegistry = None,
     ):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retriever = retriever or Retriever(
+            search_client, sourcepage_field, content_field
+        )
+        self.registry = registry or AgentRegistry()
 
-    def search(self, q: str, overrides: dict) -> str:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = (
-            "category ne '{}'".format(exclude_category.replace("'", "''"))
-            if exclude_category
-            else None
+    # Independent queries can be combined into one Search or Lookup action, separated by QUERY_SEPARATOR. They are sent
+    # concurrently, and queries already answered earlier in the same run are served from the context's observations.
+    def search(self, q: str, context: RequestContext) -> str:
+        results = self.fan_out(
+            "Search",
+            q,
+            lambda sq: self.retriever.retrieve(
+                sq, context.overrides, separator=":", max_chars=500
+            ),
+            context.observations,
         )
+        context.results = [r for sub_results in results for r in sub_results]
+        return "\n".join(context.results)
 
-        if overrides.get("semantic_ranker"):
+    def lookup(self, q: str, context: RequestContext) -> Optional[str]:
+        answers = [
+            a
+            for a in self.fan_out("Lookup", q, self.lookup_one, context.observations)
+            if a
+        ]
+        return "\n".join(answers) if answers else None
+
+    def lookup_one(self, q: str) -> Optional[str]:
+        with stage("search"):
             r = self.search_client.search(
                 q,
-                filter=filter,
+                top=1,
+                include_total_count=True,
                 query_type=QueryType.SEMANTIC,
                 query_language="de-de",
                 query_speller="lexicon",
                 semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
+                query_answer="extractive|count-1",
+                query_caption="extractive|highlight-false",
+                select=[self.content_field],
             )
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [
-                doc[self.sourcepage_field]
-                + ":"
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            self.results = [
-                doc[self.sourcepage_field]
-                + ":"
-                + nonewlines(doc[self.content_field][:500])
-                for doc in r
-            ]
-        return "\n".join(self.results)
-
-    def lookup(self, q: str) -> str:
-        r = self.search_client.search(
-            q,
-            top=1,
-            include_total_count=True,
-            query_type=QueryType.SEMANTIC,
-            query_language="de-de",
-            query_speller="lexicon",
-            semantic_configuration_name="default",
-            query_answer="extractive|count-1",
-            query_caption="extractive|highlight-false",
+
+            answers = r.get_answers()
+            if answers and len(answers) > 0:
+                return answers[0].text
+            if r.get_count() > 0:
+                return "\n".join(
+                    self.retriever.select(q, d[self.content_field]) for d in r
+                )
+            return None
+
+    def fan_out(
+        self, tool: str, q: str, func: Callable[[str], Any], observations: dict = None
+    ) -> List[Any]:
+        observations = {} if observations is None else observations
+        queries = [sq.strip() for sq in q.split(QUERY_SEPARATOR) if sq.strip()] or [q]
+        keys = [(tool, normalize_query(sq)) for sq in queries]
+        pending = {}
+        for key, sq in zip(keys, queries):
+            if key not in observations and key not in pending:
+                pending[key] = sq
+        if len(pending) == 1:
+            key, sq = pending.popitem()
+            observations[key] = func(sq)
+        elif pending:
+            futures = {
+                key: fanout_executor.submit(copy_context().run, func, sq)
+                for key, sq in pending.items()
+            }
+            for key, future in futures.items():
+                observations[key] = future.result()
+        return [observations[key] for key in keys]
+
+    def llm_chain(self, overrides: dict) -> LLMChain:
+        temperature = overrides.get("temperature") or 0.3
+        prompt_prefix = overrides.get("prompt_template")
+        return self.registry.get(
+            ("rda", self.openai_deployment, temperature, prompt_prefix),
+            lambda: LLMChain(
+                llm=self.registry.llm(self.openai_deployment, temperature),
+                prompt=PromptTemplate.from_examples(
+                    EXAMPLES,
+                    SUFFIX,
+                    ["input", "agent_scratchpad"],
+                    prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX,
+                ),
+            ),
         )
 
-        answers = r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d["content"] for d in r)
-        return None
+    # Builds the prompted chain for the default overrides
+    def warm_up(self):
+        self.llm_chain({})
 
     def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+        context = RequestContext(overrides)
 
         # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        cb_handler = TraceCollector()
 
-        llm = AzureOpenAI(
-            deployment_name=self.openai_deployment,
-            temperature=overrides.get("temperature") or 0.3,
-            openai_api_key=openai.api_key,
-        )
         tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides)),
-            Tool(name="Lookup", func=self.lookup),
+            Tool(name="Search", func=lambda q: self.search(q, context)),
+            Tool(name="Lookup", func=lambda q: self.lookup(q, context)),
         ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
-        prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES,
-            SUFFIX,
-            ["input", "agent_scratchpad"],
-            prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX,
-        )
-
-        agent = ReAct.from_llm_and_tools(llm, tools)
+        agent = ReAct.from_chain_and_tools(self.llm_chain(overrides), tools)
         chain = AgentExecutor.from_agent_and_tools(
-            agent, tools, verbose=True, callback_manager=cb_manager
+            agent, tools, verbose=True, callback_manager=request_callback_manager
         )
-        result = chain.run(q)
+        with handling(cb_handler), stage("agent"):
+            result = chain.run(q)
 
         # Fix up references to they look like what the frontend expects ([] instead of ()), need a better citation format since parentheses are so common
         result = result.replace("(", "[").replace(")", "]")
 
         return {
-            "data_points": self.results or [],
+            "data_points": context.results,
             "answer": result,
-            "thoughts": cb_handler.get_and_reset_log(),
+            "thoughts": cb_handler.render_html,
         }
 
 
+# The prompt depends on the overrides of the request, so the agent is built around a prompted chain (see AgentRegistry)
+# instead of getting its prompt from create_prompt(). The agent counts its steps, so it can't be shared between requests.
 class ReAct(ReActDocstoreAgent):
     @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
+    def from_chain_and_tools(cls, llm_chain: LLMChain, tools: List[Tool]) -> "ReAct":
+        cls._validate_tools(tools)
+        return cls(llm_chain=llm_chain, allowed_tools=[tool.name for tool in tools])
 
 
 # Modifizierte Version des ReAct-Prompts von langchain, der Anweisungen und Beispiele für die Zitierung von Informationsquellen enthält
@@ -246,5 +276,6 @@ SUFFIX = """\nFrage: {input}
 PREFIX = (
     "Beantworten Sie Fragen wie in den folgenden Beispielen gezeigt, indem Sie die Frage in einzelne Such- oder Nachschlageaktionen aufteilen, um Fakten zu finden, bis Sie die Frage beantworten können. "
     "Beobachtungen werden durch ihren Quellennamen in eckigen Klammern gekennzeichnet, Quellennamen MÜSSEN in den Antworten bei den Aktionen enthalten sein."
-    "Beantworten Sie die Fragen nur mit Informationen aus Beobachtungen, spekulieren Sie nicht."
+    "Beantworten Sie die Fragen nur mit Informationen aus Beobachtungen, spekulieren Sie nicht. "
+    f"Unabhängige Suchen können in einer Aktion zusammengefasst werden, getrennt durch {QUERY_SEPARATOR}, z.B. Suche[Nicholas Ray {QUERY_SEPARATOR} Elia Kazan]."
 )
@@ -1,15 +1,13 @@
-import openai
-from approaches.approach import Approach
+from approaches.approach import Approach, RequestContext
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.callbacks.base import CallbackManager
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchain.llms.openai import AzureOpenAI
-from langchainadapters import HtmlCallbackHandler
-from text import nonewlines
+from agentregistry import AgentRegistry
+from langchainadapters import TraceCollector, handling, request_callback_manager
+from retrieval import Retriever
+from stages import stage
 from lookuptool import CsvLookupTool
+from typing import List
 
 
 # Attempt to answer questions by iteratively evaluating the question to see what information is missing, and once all information
@@ -46,97 +44,89 @@ class ReadRetrieveReadApproach(Approach):
         openai_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        retriever: Retriever = None,
+        registry: AgentRegistry = None,
     ):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
-
-    def retrieve(self, q: str, overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = (
-            "category ne '{}'".format(exclude_category.replace("'", "''"))
-            if exclude_category
-            else None
+        self.retriever = retriever or Retriever(
+            search_client, sourcepage_field, content_field
         )
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
-                q,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="de-de",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
-            )
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [
-                doc[self.sourcepage_field]
-                + ":"
-                + nonewlines(" -.- ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            self.results = [
-                doc[self.sourcepage_field]
-                + ":"
-                + nonewlines(doc[self.content_field][:250])
-                for doc in r
-            ]
-        content = "\n".join(self.results)
+        self.registry = registry or AgentRegistry()
+
+    def retrieve(self, q: str, context: RequestContext) -> any:
+        context.results = self.retriever.retrieve(
+            q,
+            context.overrides,
+            separator=":",
+            caption_separator=" -.- ",
+            max_chars=250,
+        )
+        content = "\n".join(context.results)
         return content
 
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-
+    def tools(self, context: RequestContext) -> List[Tool]:
         acs_tool = Tool(
             name="CognitiveSearch",
-            func=lambda q: self.retrieve(q, overrides),
+            func=lambda q: self.retrieve(q, context),
             description=self.CognitiveSearchToolDescription,
         )
-        employee_tool = EmployeeInfoTool("Employee1")
-        tools = [acs_tool, employee_tool]
-
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables=["input", "agent_scratchpad"],
+        employee_tool = self.registry.get(
+            ("employee", "Employee1"), lambda: EmployeeInfoTool("Employee1")
         )
-        llm = AzureOpenAI(
-            deployment_name=self.openai_deployment,
-            temperature=overrides.get("temperature") or 0.3,
-            openai_api_key=openai.api_key,
+        return [acs_tool, employee_tool]
+
+    # The agent only knows the names of the tools, the ones that do the work for a request are passed to its executor
+    def agent(self, tools: List[Tool], overrides: dict) -> ZeroShotAgent:
+        temperature = overrides.get("temperature") or 0.3
+        prefix = overrides.get("prompt_template_prefix") or self.template_prefix
+        suffix = overrides.get("prompt_template_suffix") or self.template_suffix
+        return self.registry.get(
+            ("rrr", self.openai_deployment, temperature, prefix, suffix),
+            lambda: ZeroShotAgent(
+                llm_chain=LLMChain(
+                    llm=self.registry.llm(self.openai_deployment, temperature),
+                    prompt=ZeroShotAgent.create_prompt(
+                        tools=tools,
+                        prefix=prefix,
+                        suffix=suffix,
+                        input_variables=["input", "agent_scratchpad"],
+                    ),
+                ),
+                allowed_tools=[tool.name for tool in tools],
+            ),
         )
-        chain = LLMChain(llm=llm, prompt=prompt)
+
+    # Builds the agent for the default overrides and reads the employee table
+    def warm_up(self):
+        self.agent(self.tools(RequestContext({})), {})
+
+    def run(self, q: str, overrides: dict) -> any:
+        context = RequestContext(overrides)
+
+        # Use to capture thought process during iterations
+        cb_handler = TraceCollector()
+
+        tools = self.tools(context)
+        agent = self.agent(tools, overrides)
         agent_exec = AgentExecutor.from_agent_and_tools(
-            agent=ZeroShotAgent(llm_chain=chain, tools=tools),
+            agent=agent,
             tools=tools,
             verbose=True,
-            callback_manager=cb_manager,
+            callback_manager=request_callback_manager,
         )
-        result = agent_exec.run(q)
+        with handling(cb_handler), stage("agent"):
+            result = agent_exec.run(q)
 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
         return {
-            "data_points": self.results or [],
+            "data_points": context.results,
             "answer": result,
-            "thoughts": cb_handler.get_and_reset_log(),
+            "thoughts": cb_handler.render_html,
         }
 
 
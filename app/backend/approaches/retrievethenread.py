@@ -1,8 +1,16 @@
 import openai
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from typing import AsyncIterator, Iterator, List, Union
 from approaches.approach import Approach
 from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from text import nonewlines
+from retrieval import Retriever
+from stages import stage
+
+# Shared by all batches, bounds the number of concurrent searches. Searches run in the context of their request, which
+# carries its deadline, priority and metrics labels.
+batch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rtr-batch")
 
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
@@ -40,61 +48,133 @@ Antwort:
 """
     )
 
+    # Prompts sent with one completion call in run_batch()
+    completion_batch_size = 20
+
     def __init__(
         self,
         search_client: SearchClient,
         openai_deployment: str,
         sourcepage_field: str,
         content_field: str,
+        retriever: Retriever = None,
     ):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.retriever = retriever or Retriever(
+            search_client, sourcepage_field, content_field
+        )
 
     def run(self, q: str, overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = (
-            "category ne '{}'".format(exclude_category.replace("'", "''"))
-            if exclude_category
-            else None
-        )
+        results = self.retriever.retrieve(q, overrides)
+        prompt = self.get_prompt(q, results, overrides)
+        with stage("completion"):
+            completion = openai.Completion.create(
+                **self.completion_args(prompt, overrides)
+            )
+        return self.get_response(q, results, prompt, completion)
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(
-                q,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language="de-de",
-                query_speller="lexicon",
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false"
-                if use_semantic_captions
-                else None,
+    async def arun(self, q: str, overrides: dict) -> any:
+        results = await self.retriever.aretrieve(q, overrides)
+        prompt = self.get_prompt(q, results, overrides)
+        with stage("completion"):
+            completion = await openai.Completion.acreate(
+                **self.completion_args(prompt, overrides)
             )
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field]
-                + ": "
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                for doc in r
-            ]
-        else:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
-                for doc in r
-            ]
-        content = "\n".join(results)
+        return self.get_response(q, results, prompt, completion)
+
+    # Searches for all questions concurrently and sends the prompts in groups of completion_batch_size, the completions
+    # API takes a list of prompts and returns a choice for each
+    def run_batch(self, questions: List[str], overrides: dict) -> Iterator[dict]:
+        searches = [
+            batch_executor.submit(
+                copy_context().run, self.retriever.retrieve, q, overrides
+            )
+            for q in questions
+        ]
+        for start in range(0, len(questions), self.completion_batch_size):
+            group = range(
+                start, min(start + self.completion_batch_size, len(questions))
+            )
+            responses = {}
+            prompts = {}
+            for i in group:
+                try:
+                    results = searches[i].result()
+                    prompts[i] = (
+                        results,
+                        self.get_prompt(questions[i], results, overrides),
+                    )
+                except Exception as e:
+                    responses[i] = {"error": str(e)}
+
+            if prompts:
+                try:
+                    with stage("completion"):
+                        completion = openai.Completion.create(
+                            **self.completion_args(
+                                [prompt for _, prompt in prompts.values()], overrides
+                            )
+                        )
+                    # Choices refer to their prompt by position, a prompt can be left without one (e.g. when its
+                    # choice was filtered)
+                    texts = {c.index: c.text for c in completion.choices}
+                    for n, (i, (results, prompt)) in enumerate(prompts.items()):
+                        if n not in texts:
+                            responses[i] = {"error": "no completion for this question"}
+                            continue
+                        responses[i] = {
+                            "data_points": results,
+                            "answer": texts[n],
+                            "thoughts": partial(
+                                self.get_thoughts, questions[i], prompt
+                            ),
+                        }
+                except Exception as e:
+                    for i in prompts:
+                        responses[i] = {"error": str(e)}
 
-        prompt = (overrides.get("prompt_template") or self.template).format(
+            for i in group:
+                yield responses[i]
+
+    def run_stream(self, q: str, overrides: dict) -> Iterator[dict]:
+        results = self.retriever.retrieve(q, overrides)
+        prompt = self.get_prompt(q, results, overrides)
+        yield {
+            "data_points": results,
+            "thoughts": partial(self.get_thoughts, q, prompt),
+        }
+        with stage("completion"):
+            for chunk in openai.Completion.create(
+                stream=True, **self.completion_args(prompt, overrides)
+            ):
+                if chunk.choices:
+                    yield {"answer": chunk.choices[0].text}
+
+    async def arun_stream(self, q: str, overrides: dict) -> AsyncIterator[dict]:
+        results = await self.retriever.aretrieve(q, overrides)
+        prompt = self.get_prompt(q, results, overrides)
+        yield {
+            "data_points": results,
+            "thoughts": partial(self.get_thoughts, q, prompt),
+        }
+        with stage("completion"):
+            async for chunk in await openai.Completion.acreate(
+                stream=True, **self.completion_args(prompt, overrides)
+            ):
+                if chunk.choices:
+                    yield {"answer": chunk.choices[0].text}
+
+    def get_prompt(self, q: str, results: list[str], overrides: dict) -> str:
+        content = "\n".join(results)
+        return (overrides.get("prompt_template") or self.template).format(
             q=q, retrieved=content
         )
-        completion = openai.Completion.create(
+
+    def completion_args(self, prompt: Union[str, List[str]], overrides: dict) -> dict:
+        return dict(
             engine=self.openai_deployment,
             prompt=prompt,
             temperature=overrides.get("temperature") or 0.3,
@@ -103,9 +183,12 @@ Antwort:
             stop=["\n"],
         )
 
+    def get_response(self, q: str, results: list[str], prompt: str, completion) -> dict:
         return {
             "data_points": results,
             "answer": completion.choices[0].text,
-            "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>"
-            + prompt.replace("\n", "<br>"),
+            "thoughts": partial(self.get_thoughts, q, prompt),
         }
+
+    def get_thoughts(self, q: str, prompt: str) -> str:
+        return f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace("\n", "<br>")
@@ -0,0 +1,344 @@
+import asyncio
+import json
+import logging
+import aiohttp
+import openai
+from quart import Quart, Response, request, jsonify
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from contentstore import ContentNotFound
+from deadlines import abounded, awithin
+from upstream import upstream_trace_config
+from quota import BATCH, INTERACTIVE, aprioritized
+import metrics
+from app import (
+    AZURE_SEARCH_SERVICE,
+    AZURE_SEARCH_INDEX,
+    BATCH_MAX_QUESTIONS,
+    HTTP_POOL_SIZE,
+    LOCAL_SEARCH_INDEX,
+    REQUEST_TIMEOUT,
+    quota_scheduler,
+    answer_cache,
+    ask_approaches,
+    chat_approaches,
+    circuit_breakers,
+    content_store,
+    ensure_openai_token,
+    openai_token_stale,
+    error_status,
+    flights,
+    retriever,
+    serving,
+    serving_stream,
+    is_admin,
+    startup_status,
+    warm_up,
+    profile_requested,
+    profiler,
+    rewrite_stats,
+    trace_store,
+    upstream_status,
+    with_trace,
+)
+
+# Async serving mode: the same approaches as app.py, but requests are handled on an event loop so that one process can
+# hold many in-flight questions while they wait on Cognitive Search and OpenAI. Run it under an ASGI server, e.g.
+#   uvicorn asgi:app --host 0.0.0.0 --port 8000
+# Approaches without a native async implementation run on a worker thread (see Approach.arun).
+
+app = Quart(__name__)
+
+http_session: aiohttp.ClientSession = None
+azure_credential: AsyncDefaultAzureCredential = None
+
+
+@app.before_serving
+async def create_clients():
+    global http_session, azure_credential
+    # Shared by the OpenAI and Search clients, like app.http_session, and with the same circuit breakers
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit_per_host=HTTP_POOL_SIZE, ttl_dns_cache=300
+        ),
+        trace_configs=[upstream_trace_config(circuit_breakers)],
+    )
+    azure_credential = AsyncDefaultAzureCredential()
+    # The local index is searched in-process, on a worker thread (see Retriever.asearch)
+    if not LOCAL_SEARCH_INDEX:
+        retriever.async_search_client = AsyncSearchClient(
+            endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            index_name=AZURE_SEARCH_INDEX,
+            credential=azure_credential,
+            transport=AioHttpTransport(session=http_session, session_owner=False),
+        )
+
+
+@app.after_serving
+async def close_clients():
+    if retriever.async_search_client is not None:
+        await retriever.async_search_client.close()
+        retriever.async_search_client = None
+    await azure_credential.close()
+    await http_session.close()
+
+
+@app.before_request
+async def use_openai_session():
+    # openai keeps its aiohttp session in a context variable, which has to be set in the task serving the request
+    openai.aiosession.set(http_session)
+
+
+# Blob downloads and the disk cache are sync, keep them off the event loop
+@app.route("/content/<path>")
+async def content_file(path):
+    try:
+        status, headers, body = await asyncio.to_thread(
+            content_store.respond, path, request.headers
+        )
+    except ContentNotFound:
+        return jsonify({"error": "not found"}), 404
+
+    async def chunks():
+        it = iter(body)
+        while (chunk := await asyncio.to_thread(next, it, None)) is not None:
+            yield chunk
+
+    return Response(chunks(), status, headers)
+
+
+@app.route("/content/cache", methods=["GET"])
+async def content_cache_stats():
+    return jsonify(content_store.stats())
+
+
+# Getting a token from the credential blocks, a refresh is made on a worker thread so that the event loop keeps serving
+# other requests meanwhile
+async def aensure_openai_token():
+    if openai_token_stale():
+        await asyncio.to_thread(ensure_openai_token)
+
+
+@app.route("/ask", methods=["POST"])
+async def ask():
+    await aensure_openai_token()
+    body = await request.get_json()
+    approach = body["approach"]
+    try:
+        impl = ask_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        overrides = body.get("overrides") or {}
+        if body.get("stream"):
+            chunks = aserving_stream(
+                impl.arun_stream(body["question"], overrides),
+                "ask",
+                approach,
+                profile=profile_requested(request.headers),
+            )
+            return ndjson_response(with_traces(chunks, overrides))
+        with serving("ask", approach, profile=profile_requested(request.headers)):
+            r = await awithin(impl.arun(body["question"], overrides))
+        return jsonify(await with_async_trace(r, overrides))
+    except Exception as e:
+        logging.exception("Exception in /ask")
+        return jsonify({"error": str(e)}), error_status(e)
+
+
+# Same as app.ask_batch. Batches share work between their questions on worker threads (see Approach.run_batch), the
+# event loop only waits for the next response.
+@app.route("/ask/batch", methods=["POST"])
+async def ask_batch():
+    await aensure_openai_token()
+    body = await request.get_json()
+    approach = body["approach"]
+    impl = ask_approaches.get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    questions = body.get("questions") or []
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"at most {BATCH_MAX_QUESTIONS} questions"}), 400
+    overrides = body.get("overrides") or {}
+
+    async def responses():
+        it = serving_stream(
+            impl.run_batch(questions, overrides), "ask_batch", approach, BATCH, None
+        )
+        i = 0
+        while (r := await asyncio.to_thread(next, it, None)) is not None:
+            yield {"index": i, **await with_async_trace(r, overrides)}
+            i += 1
+
+    return ndjson_response(responses())
+
+
+@app.route("/chat", methods=["POST"])
+async def chat():
+    await aensure_openai_token()
+    body = await request.get_json()
+    approach = body["approach"]
+    try:
+        impl = chat_approaches.get(approach)
+        if not impl:
+            return jsonify({"error": "unknown approach"}), 400
+        overrides = body.get("overrides") or {}
+        if body.get("stream"):
+            chunks = aserving_stream(
+                impl.arun_stream(body["history"], overrides),
+                "chat",
+                approach,
+                profile=profile_requested(request.headers),
+            )
+            return ndjson_response(with_traces(chunks, overrides))
+        with serving("chat", approach, profile=profile_requested(request.headers)):
+            r = await awithin(impl.arun(body["history"], overrides))
+        return jsonify(await with_async_trace(r, overrides))
+    except Exception as e:
+        logging.exception("Exception in /chat")
+        return jsonify({"error": str(e)}), error_status(e)
+
+
+# Rendering the agent traces can take a while, keep it off the event loop
+@app.route("/thoughts/<trace_id>", methods=["GET"])
+async def thoughts(trace_id):
+    t = await asyncio.to_thread(trace_store.get, trace_id)
+    if t is None:
+        return jsonify({"error": "unknown or expired trace"}), 404
+    return jsonify({"thoughts": t})
+
+
+@app.route("/search/cache", methods=["GET"])
+async def search_cache_stats():
+    if retriever.cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **retriever.cache.stats()})
+
+
+@app.route("/search/cache", methods=["DELETE"])
+async def search_cache_invalidate():
+    retriever.invalidate()
+    if answer_cache is not None:
+        answer_cache.invalidate()
+    return "", 204
+
+
+@app.route("/chat/rewrites", methods=["GET"])
+async def chat_rewrite_stats():
+    return jsonify(rewrite_stats())
+
+
+@app.route("/answers/cache", methods=["GET"])
+async def answer_cache_stats():
+    if answer_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **answer_cache.stats()})
+
+
+@app.route("/requests/coalesced", methods=["GET"])
+async def coalescing_stats():
+    if flights is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **flights.stats()})
+
+
+@app.route("/upstreams", methods=["GET"])
+async def upstream_stats():
+    return jsonify(upstream_status())
+
+
+@app.route("/openai/quota", methods=["GET"])
+async def quota_stats():
+    return jsonify(quota_scheduler.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/ready", methods=["GET"])
+async def ready():
+    if not warm_up.ready.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True})
+
+
+@app.route("/startup", methods=["GET"])
+async def startup_stats():
+    return jsonify(startup_status())
+
+
+@app.route("/admin/profile", methods=["POST"])
+async def profile_arm():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    args = await request.get_json() or {}
+    profiler.arm(
+        int(args.get("requests") or 0),
+        float(args.get("rate") or 0),
+        float(args.get("duration") or 60),
+    )
+    return jsonify(profiler.stats())
+
+
+@app.route("/admin/profile", methods=["GET"])
+async def profile_read():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    if request.args.get("format") == "json":
+        return jsonify(profiler.stats())
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
+
+@app.route("/admin/profile", methods=["DELETE"])
+async def profile_clear():
+    if not is_admin(request.headers):
+        return jsonify({"error": "not found"}), 404
+    profiler.disarm()
+    profiler.clear()
+    return "", 204
+
+
+# Same as app.serving_stream for async streams
+def aserving_stream(
+    chunks, endpoint: str, approach: str, p: int = INTERACTIVE, profile: bool = False
+):
+    if profiler.select(profile):
+        chunks = profiler.aprofiled_stream(chunks, f"{endpoint}/{approach}")
+    return metrics.atracked(
+        abounded(aprioritized(chunks, p), REQUEST_TIMEOUT), endpoint, approach
+    )
+
+
+# Same as app.with_trace, inline thoughts are rendered on a worker thread
+async def with_async_trace(r: dict, overrides: dict) -> dict:
+    if overrides.get("include_thoughts"):
+        return await asyncio.to_thread(with_trace, r, overrides)
+    return with_trace(r, overrides)
+
+
+async def with_traces(chunks, overrides: dict):
+    async for chunk in chunks:
+        yield await with_async_trace(chunk, overrides)
+
+
+# Same wire format as app.ndjson_response
+def ndjson_response(chunks) -> Response:
+    async def generate():
+        try:
+            async for chunk in chunks:
+                yield (json.dumps(chunk) + "\n").encode()
+        except Exception as e:
+            logging.exception("Exception while streaming")
+            yield (json.dumps({"error": str(e)}) + "\n").encode()
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from aiohttp import web
+import stages
+from localsearch import LocalSearchClient
+
+# Load and latency benchmark for /ask and /chat. The app is driven in-process through the Flask test client, with
+# Cognitive Search replaced by a LocalSearchClient over a synthetic corpus and Azure OpenAI by a local HTTP server that
+# answers completions (including the agents' ReAct steps) after a configurable delay. Both delays are drawn from latency
+# distributions, completions are additionally paced at a fixed token rate. For every scenario (endpoint and approach)
+# the report lists throughput and p50/p95/p99 latency of whole requests and of each pipeline stage (see stages.py), and
+# the process' peak memory. E.g.
+#   python benchmark.py --requests 200 --concurrency 8 --output baseline.json
+#   python benchmark.py --requests 200 --concurrency 8 --baseline baseline.json
+# The second run exits with status 1 if a p95 latency got worse than the baseline by more than --tolerance, if more
+# requests failed than in the baseline, or if a stage of the baseline didn't run. Latencies are those of the requests
+# that succeeded, failing fast doesn't make a run look faster.
+
+SCENARIOS = ["ask:rtr", "ask:rrr", "ask:rda", "chat:rrr"]
+
+WORDS = (
+    "gesundheitsplan zahnbehandlung brille vorsorge krankenhaus rezept apotheke urlaub elternzeit rente "
+    "gehalt bonus homeoffice reisekosten weiterbildung versicherung selbstbeteiligung notfall therapie "
+    "arbeitszeit überstunden kündigung probezeit dienstwagen fahrrad kantine sport impfung physiotherapie"
+).split()
+
+
+# Delay distribution given as "fixed:<seconds>", "uniform:<min>,<max>" or "lognormal:<median>,<sigma>"
+class Latency:
+    def __init__(self, spec: str, seed: Optional[int] = None):
+        kind, _, params = spec.partition(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        self.rng = random.Random(seed)
+        if (kind, len(self.params)) not in (
+            ("fixed", 1),
+            ("uniform", 2),
+            ("lognormal", 2),
+        ):
+            raise ValueError(f"Unsupported latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        median, sigma = self.params
+        return self.rng.lognormvariate(math.log(median), sigma)
+
+
+# Stand-in for the Cognitive Search SearchClient, delays every query before searching the local index
+class FakeSearchClient:
+    def __init__(self, index: LocalSearchClient, latency: Latency):
+        self.index = index
+        self.latency = latency
+
+    def search(self, search_text: str, **kwargs):
+        time.sleep(self.latency.sample())
+        return self.index.search(search_text, **kwargs)
+
+
+# Stand-in for the Azure OpenAI completions API, served on a local port from its own event loop thread so that any
+# number of requests can wait concurrently. Completions start after a delay drawn from latency (time to first token)
+# and are produced at tokens_per_second, one word per token. Agent prompts are recognized by their format and answered
+# with agent_steps tool actions before the final answer.
+class FakeOpenAI:
+    def __init__(
+        self,
+        latency: Latency,
+        tokens_per_second: float,
+        answer_tokens: int,
+        agent_steps: int,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.agent_steps = agent_steps
+        self.rng = random.Random(seed)
+        self.endpoint: str = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._runner: web.AppRunner = None
+
+    def start(self) -> str:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self.endpoint
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post(
+            "/openai/deployments/{deployment}/completions", self.completions
+        )
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.endpoint = f"http://{host}:{port}"
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompts = (
+            body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        )
+        max_tokens = body.get("max_tokens") or 16
+        replies = [self.reply(p, max_tokens) for p in prompts]
+        tokens = [r.split(" ") for r in replies]
+        model = request.match_info["deployment"]
+        await asyncio.sleep(self.latency.sample())
+
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i, token in enumerate(tokens[0]):
+                chunk = self.completion(model, [(" " if i else "") + token], None)
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(1 / self.tokens_per_second)
+            chunk = self.completion(model, [""], "stop")
+            await response.write(
+                f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode()
+            )
+            await response.write_eof()
+            return response
+
+        await asyncio.sleep(max(map(len, tokens)) / self.tokens_per_second)
+        r = self.completion(model, replies, "stop")
+        r["usage"] = {
+            "prompt_tokens": sum(len(p.split()) for p in prompts),
+            "completion_tokens": sum(map(len, tokens)),
+            "total_tokens": sum(len(p.split()) for p in prompts)
+            + sum(map(len, tokens)),
+        }
+        return web.json_response(r)
+
+    def completion(self, model: str, texts: List[str], finish_reason: str) -> dict:
+        return {
+            "id": "cmpl-benchmark",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "text": text,
+                    "index": i,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+                for i, text in enumerate(texts)
+            ],
+        }
+
+    def reply(self, prompt: str, max_tokens: int) -> str:
+        questions = re.findall(r"Frage: *(.*)", prompt)
+        query = questions[-1].strip() if questions else self.words(3)
+        answer = self.words(min(max_tokens, self.answer_tokens)) + " [doc0.pdf]"
+
+        # ReadDecomposeAsk (ReAct docstore agent), its examples are in German but the scratchpad isn't
+        if "\nBeobachtung 1: " in prompt:
+            step = len(re.findall(r"\nObservation \d+: ", prompt)) + 1
+            if step <= self.agent_steps:
+                return f" {self.words(8)}\nAction {step}: Search[{query}]"
+            return f" {self.words(8)}\nAction {step}: Finish[{answer}]"
+        # ReadRetrieveRead (MRKL agent), the format instructions contain one Observation line themselves
+        if "\nAction Input: " in prompt:
+            step = prompt.count("\nObservation: ")
+            if step <= self.agent_steps:
+                return (
+                    f" {self.words(8)}\nAction: CognitiveSearch\nAction Input: {query}"
+                )
+            return f" I now know the final answer\nFinal Answer: {answer}"
+        return answer
+
+    def words(self, n: int) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(max(n, 1)))
+
+
+# Thread-safe sink for stage timings, registered with stages.observers
+class StageRecorder:
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, seconds: float):
+        with self._lock:
+            self.durations.setdefault(name, []).append(seconds)
+
+    def reset(self) -> Dict[str, List[float]]:
+        with self._lock:
+            durations, self.durations = self.durations, {}
+            return durations
+
+
+def make_corpus(n: int, words_per_doc: int, rng: random.Random) -> List[dict]:
+    return [
+        {
+            "id": str(i),
+            "sourcepage": f"doc{i}.pdf",
+            "category": rng.choice(["handbook", "benefits", "plan"]),
+            "content": ". ".join(
+                " ".join(rng.choice(WORDS) for _ in range(12))
+                for _ in range(max(words_per_doc // 12, 1))
+            )
+            + ".",
+        }
+        for i in range(n)
+    ]
+
+
+def make_request(
+    endpoint: str, approach: str, rng: random.Random, chat_turns: int, stream: bool
+) -> dict:
+    question = " ".join(rng.choice(WORDS) for _ in range(4)) + "?"
+    body = {"approach": approach, "overrides": {"top": 3}, "stream": stream}
+    if endpoint == "ask":
+        body["question"] = question
+    else:
+        body["history"] = [
+            {
+                "user": " ".join(rng.choice(WORDS) for _ in range(6)) + "?",
+                "bot": " ".join(rng.choice(WORDS) for _ in range(40)) + " [doc1.pdf]",
+            }
+            for _ in range(chat_turns)
+        ] + [{"user": question}]
+    return body
+
+
+# Sends one request, returns its latency, time to first byte and whether it failed
+def send(client, endpoint: str, body: dict) -> Tuple[float, float, bool]:
+    start = time.perf_counter()
+    response = client.post("/" + endpoint, json=body, buffered=False)
+    first_byte, parts = None, []
+    try:
+        for part in response.response:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            parts.append(part.encode() if isinstance(part, str) else part)
+    finally:
+        response.close()
+    data = b"".join(parts)
+    lines = data.splitlines() if body["stream"] else [data]
+    failed = response.status_code != 200 or any(
+        "error" in json.loads(line) for line in lines if line.strip()
+    )
+    return time.perf_counter() - start, first_byte, failed
+
+
+def summarize(values: List[float], seconds: float) -> dict:
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(values),
+        "throughput": len(values) / seconds,
+        "mean": float(np.mean(values)),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+    }
+
+
+def run_scenario(
+    flask_app, scenario: str, args, recorder: StageRecorder, rng: random.Random
+) -> dict:
+    endpoint, approach = scenario.split(":")
+    bodies = [
+        make_request(endpoint, approach, rng, args.chat_turns, args.stream)
+        for _ in range(args.warmup + args.requests)
+    ]
+    local = threading.local()
+
+    def task(body: dict) -> Tuple[float, float, bool]:
+        if not hasattr(local, "client"):
+            local.client = flask_app.test_client()
+        return send(local.client, endpoint, body)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(task, bodies[: args.warmup]))
+        recorder.reset()
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        results = list(pool.map(task, bodies[args.warmup :]))
+        seconds = time.perf_counter() - start
+        if args.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    durations = recorder.reset()
+    succeeded = [r for r in results if not r[2]]
+    report = {
+        "requests": len(results),
+        "errors": sum(1 for _, _, failed in results if failed),
+        "seconds": seconds,
+        "latency": summarize([r[0] for r in succeeded], seconds),
+        "stages": {
+            name: summarize(values, seconds)
+            for name, values in sorted(durations.items())
+        },
+        "memory": {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+    }
+    if args.stream:
+        report["first_byte"] = summarize(
+            [r[1] for r in succeeded if r[1] is not None], seconds
+        )
+    if args.trace_memory:
+        report["memory"]["traced_peak_bytes"] = peak
+    return report
+
+
+# Returns a message for every request or stage p95 latency that is slower than in the baseline by more than tolerance,
+# for every scenario with more errors than in the baseline and for every stage of the baseline that didn't run
+def regressions(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    for scenario, result in report["scenarios"].items():
+        base = baseline["scenarios"].get(scenario)
+        if base is None:
+            continue
+        if result["errors"] > base["errors"]:
+            found.append(
+                f"{scenario}: {result['errors']} errors, baseline {base['errors']}"
+            )
+        for name, base_stats in base["stages"].items():
+            stats = result["stages"].get(name)
+            if base_stats["count"] and (stats is None or not stats["count"]):
+                found.append(
+                    f"{scenario} {name}: didn't run, baseline n={base_stats['count']}"
+                )
+        pairs = [("request", result["latency"], base["latency"])] + [
+            (name, stats, base["stages"][name])
+            for name, stats in result["stages"].items()
+            if name in base["stages"]
+        ]
+        for name, stats, base_stats in pairs:
+            if "p95" in stats and "p95" in base_stats:
+                if stats["p95"] > base_stats["p95"] * (1 + tolerance):
+                    found.append(
+                        f"{scenario} {name}: p95 {stats['p95'] * 1000:.1f}ms, "
+                        f"baseline {base_stats['p95'] * 1000:.1f}ms"
+                    )
+    return found
+
+
+def print_report(report: dict):
+    for scenario, result in report["scenarios"].items():
+        print(
+            f"{scenario}: {result['requests']} requests, {result['errors']} errors, "
+            f"{result['latency'].get('throughput', 0):.1f} req/s, "
+            f"max RSS {result['memory']['max_rss_kb'] / 1024:.0f} MB"
+        )
+        rows = [("request", result["latency"])]
+        if "first_byte" in result:
+            rows.append(("first_byte", result["first_byte"]))
+        rows += list(result["stages"].items())
+        for name, stats in rows:
+            if stats["count"]:
+                print(
+                    f"  {name:<14} n={stats['count']:<6} {stats['throughput']:8.1f}/s "
+                    f"p50 {stats['p50'] * 1000:8.1f}ms  p95 {stats['p95'] * 1000:8.1f}ms  "
+                    f"p99 {stats['p99'] * 1000:8.1f}ms"
+                )
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--search-latency", default="lognormal:0.05,0.3")
+    parser.add_argument("--openai-latency", default="lognormal:0.3,0.4")
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--agent-steps", type=int, default=1)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--document-words", type=int, default=300)
+    parser.add_argument("--chat-turns", type=int, default=3)
+    parser.add_argument("--search-cache", action="store_true")
+    parser.add_argument("--answer-cache", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the report as JSON, e.g. as a baseline")
+    parser.add_argument("--baseline", help="compare with a report saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    cwd = os.getcwd()
+
+    rng = random.Random(args.seed)
+    fake_openai = FakeOpenAI(
+        Latency(args.openai_latency, args.seed),
+        args.tokens_per_second,
+        args.answer_tokens,
+        args.agent_steps,
+        args.seed,
+    )
+    endpoint = fake_openai.start()
+
+    # The app reads its configuration and builds its clients on import. It runs in a scratch directory that has the
+    # data files the approaches expect.
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    os.mkdir("data")
+    with open("data/employeeinfo.csv", "w", encoding="utf-8") as f:
+        f.write("name,title,plan,vacation_days\nEmployee1,Engineer,Plus,30\n")
+    index_file = os.path.join(workdir.name, "index.json.gz")
+    LocalSearchClient.build(make_corpus(args.documents, args.document_words, rng)).save(
+        index_file
+    )
+    os.environ.update(
+        AZURE_OPENAI_ENDPOINT=endpoint,
+        OPENAI_API_KEY="benchmark",
+        LOCAL_SEARCH_INDEX=index_file,
+        SEARCH_CACHE_SIZE="1024" if args.search_cache else "0",
+        AZURE_OPENAI_EMB_DEPLOYMENT="",
+        ANSWER_CACHE_EMBEDDER="hashing" if args.answer_cache else "",
+    )
+    import app
+
+    search_client = FakeSearchClient(
+        app.search_client, Latency(args.search_latency, args.seed)
+    )
+    app.retriever.search_client = search_client
+    for impl in [*app.ask_approaches.values(), *app.chat_approaches.values()]:
+        # Behind the coalescing and answer cache wrappers
+        while hasattr(impl, "approach"):
+            impl = impl.approach
+        impl.search_client = search_client
+
+    recorder = StageRecorder()
+    stages.observers.append(recorder)
+    report = {
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("output", "baseline")
+        },
+        "python": platform.python_version(),
+        "scenarios": {},
+    }
+    try:
+        for scenario in args.scenarios.split(","):
+            report["scenarios"][scenario] = run_scenario(
+                app.app, scenario, args, recorder, rng
+            )
+    finally:
+        stages.observers.remove(recorder)
+        fake_openai.stop()
+        os.chdir(cwd)
+        workdir.cleanup()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for message in found:
+            print("REGRESSION " + message)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Iterable,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from urllib.parse import quote
+from azure.core.exceptions import ResourceNotFoundError
+from werkzeug.http import parse_etags, parse_range_header, quote_etag, unquote_etag
+from werkzeug.security import safe_join
+from retrieval import ResultCache
+from singleflight import SingleFlight
+
+# The blob storage SDK is only loaded by app.py when content is served from blob storage
+if TYPE_CHECKING:
+    from azure.storage.blob import ContainerClient
+
+
+class ContentNotFound(Exception):
+    pass
+
+
+class ContentInfo(NamedTuple):
+    etag: str
+    size: int
+    content_type: str
+
+
+def guess_content_type(path: str, content_type: Optional[str] = None) -> str:
+    if content_type and content_type != "application/octet-stream":
+        return content_type
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+# Content files in a blob storage container, as uploaded by the document preparation
+# Content-Disposition of a served file with its name quoted. A name that isn't plain ASCII is also given as an RFC 5987
+# filename*, the plain filename being its closest ASCII spelling for clients that don't support it.
+def content_disposition(filename: str) -> str:
+    fallback = "".join(
+        c for c in unicodedata.normalize("NFKD", filename) if " " <= c < "\x7f"
+    )
+    escaped = fallback.replace("\\", "\\\\").replace('"', '\\"')
+    value = f'inline; filename="{escaped}"'
+    if fallback != filename:
+        value += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return value
+
+
+class BlobContentSource:
+    def __init__(self, container: "ContainerClient"):
+        self.container = container
+
+    def info(self, path: str) -> ContentInfo:
+        try:
+            props = self.container.get_blob_client(path).get_blob_properties()
+        except ResourceNotFoundError:
+            raise ContentNotFound(path)
+        return ContentInfo(
+            unquote_etag(props.etag)[0],
+            props.size,
+            guess_content_type(path, props.content_settings.content_type),
+        )
+
+    def read(self, path: str, start: int, end: int) -> Iterator[bytes]:
+        if end <= start:
+            return iter(())
+        try:
+            download = self.container.get_blob_client(path).download_blob(
+                offset=start, length=end - start
+            )
+        except ResourceNotFoundError:
+            raise ContentNotFound(path)
+        return download.chunks()
+
+
+# Content files in a local directory, e.g. for development and tests without a storage account
+class LocalContentSource:
+    def __init__(self, directory: str, chunk_size: int = 256 * 1024):
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def file(self, path: str) -> str:
+        filename = safe_join(self.directory, path)
+        if filename is None or not os.path.isfile(filename):
+            raise ContentNotFound(path)
+        return filename
+
+    def info(self, path: str) -> ContentInfo:
+        stat = os.stat(self.file(path))
+        return ContentInfo(
+            f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+            stat.st_size,
+            guess_content_type(path),
+        )
+
+    def read(self, path: str, start: int, end: int) -> Iterator[bytes]:
+        return read_file(open(self.file(path), "rb"), start, end, self.chunk_size)
+
+
+def read_file(f: IO[bytes], start: int, end: int, chunk_size: int) -> Iterator[bytes]:
+    with f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+# Size-bounded cache of whole files in a local directory, the least recently used files are deleted first. Files larger
+# than max_file_bytes are not cached, so a few big ones can't push out everything else. Files are named after the
+# content path and ETag, so a changed file is a new entry and the old one ages out.
+#
+# Worker processes can share the directory: a file written by another process is picked up on first use, though each
+# process only counts (and evicts) the files it knows about. A file evicted while it is being read stays readable
+# until it is closed.
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int, max_file_bytes: int = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes or max_bytes // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def name(path: str, etag: str) -> str:
+        return hashlib.sha256(f"{path}\0{etag}".encode()).hexdigest()
+
+    def open(self, name: str) -> Optional[IO[bytes]]:
+        try:
+            f = open(os.path.join(self.directory, name), "rb")
+        except FileNotFoundError:
+            # Never cached, or deleted by another process
+            with self._lock:
+                self.size -= self._entries.pop(name, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            if name not in self._entries:
+                size = os.fstat(f.fileno()).st_size
+                self._entries[name] = size
+                self.size += size
+            self._entries.move_to_end(name)
+            self.hits += 1
+        return f
+
+    def put(self, name: str, chunks: Iterable[bytes]):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp, os.path.join(self.directory, name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        with self._lock:
+            self.size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+                "max_file_bytes": self.max_file_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Serves content files (citations) from a source, with HTTP range requests, ETags and client side caching. File infos
+# are cached for info_ttl seconds and files that fit are kept in a DiskCache, so the source is only asked again when
+# both have expired. Files are always streamed in chunks, never read into memory as a whole.
+class ContentStore:
+    def __init__(
+        self,
+        source,
+        cache: Optional[DiskCache] = None,
+        info_ttl: float = 60,
+        max_age: int = 86400,
+        chunk_size: int = 256 * 1024,
+    ):
+        self.source = source
+        self.cache = cache
+        self.infos = ResultCache(4096, info_ttl)
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self._downloads = SingleFlight()
+
+    def info(self, path: str) -> ContentInfo:
+        info = self.infos.get(path)
+        if info is None:
+            info = self.source.info(path)
+            self.infos.put(path, info)
+        return info
+
+    def read(
+        self, path: str, info: ContentInfo, start: int, end: int
+    ) -> Iterator[bytes]:
+        if self.cache is None or info.size > self.cache.max_file_bytes:
+            return self.source.read(path, start, end)
+        name = DiskCache.name(path, info.etag)
+        f = self.cache.open(name)
+        if f is None:
+            # Concurrent requests for the same file wait for one download
+            self._downloads.run(
+                name,
+                lambda: self.cache.put(name, self.source.read(path, 0, info.size)),
+            )
+            f = self.cache.open(name)
+            if f is None:
+                return self.source.read(path, start, end)
+        return read_file(f, start, end, self.chunk_size)
+
+    # Returns the status, headers and body for a GET of path with the given request headers. Only single ranges are
+    # supported, which is what browsers and PDF viewers ask for.
+    def respond(
+        self, path: str, request_headers: Mapping[str, str]
+    ) -> Tuple[int, dict, Iterable[bytes]]:
+        info = self.info(path)
+        headers = {
+            "Content-Type": info.content_type,
+            "Content-Disposition": content_disposition(os.path.basename(path)),
+            "ETag": quote_etag(info.etag),
+            "Cache-Control": f"private, max-age={self.max_age}",
+            "Accept-Ranges": "bytes",
+        }
+        if parse_etags(request_headers.get("If-None-Match")).contains(info.etag):
+            return 304, headers, []
+
+        status, start, end = 200, 0, info.size
+        if_range = request_headers.get("If-Range")
+        # Multiple ranges aren't supported, they are answered with the whole file like a Range header that isn't valid
+        byte_range = parse_range_header(request_headers.get("Range"))
+        if (
+            byte_range is not None
+            and len(byte_range.ranges) == 1
+            and (if_range is None or unquote_etag(if_range)[0] == info.etag)
+        ):
+            bounds = byte_range.range_for_length(info.size)
+            if bounds is None:
+                headers["Content-Range"] = f"bytes */{info.size}"
+                return 416, headers, []
+            status, (start, end) = 206, bounds
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{info.size}"
+        headers["Content-Length"] = str(end - start)
+        return status, headers, self.read(path, info, start, end)
+
+    def stats(self) -> dict:
+        return {
+            "infos": self.infos.stats(),
+            "files": self.cache.stats() if self.cache is not None else None,
+        }
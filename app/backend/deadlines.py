@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Monotonic time by which the request being served on the current thread (or task) has to be answered. Every pipeline
+# stage, agent step and upstream call checks it before it starts, and upstream calls get at most the remaining time as
+# their timeout (see upstream.py). Thread pools don't carry context variables, work submitted to them is run with
+# contextvars.copy_context().run to keep the deadline.
+current_deadline: ContextVar[Optional[float]] = ContextVar(
+    "current_deadline", default=None
+)
+
+
+# Set once the result of the work running with it is no longer wanted (e.g. a discarded speculative search), which then
+# stops at its next check instead of making more upstream calls. Threads can't be interrupted, a call in progress runs
+# to its end.
+current_cancel: ContextVar[Optional[threading.Event]] = ContextVar(
+    "current_cancel", default=None
+)
+
+
+def cancellable(cancel: threading.Event, func: Callable[..., T], *args) -> T:
+    token = current_cancel.set(cancel)
+    try:
+        return func(*args)
+    finally:
+        current_cancel.reset(token)
+
+
+def cancelled() -> bool:
+    cancel = current_cancel.get()
+    return cancel is not None and cancel.is_set()
+
+
+def remaining() -> Optional[float]:
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check():
+    deadline = current_deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExceeded("request deadline exceeded")
+    if cancelled():
+        raise Cancelled("no longer needed")
+
+
+# Limits what runs inside to the given number of seconds from now, or less if an enclosing deadline ends earlier. Errors
+# raised once the deadline has passed (e.g. a read timeout that was shortened to it) are reported as DeadlineExceeded.
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    if not seconds:
+        yield
+        return
+    with deadline_at(time.monotonic() + seconds):
+        yield
+
+
+@contextmanager
+def deadline_at(at: float) -> Iterator[None]:
+    enclosing = current_deadline.get()
+    token = current_deadline.set(at if enclosing is None else min(at, enclosing))
+    try:
+        yield
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if time.monotonic() >= current_deadline.get():
+            raise DeadlineExceeded("request deadline exceeded") from e
+        raise
+    finally:
+        current_deadline.reset(token)
+
+
+# Streamed responses are produced after the request handler has returned, each chunk is produced under the deadline of
+# the whole stream and the stream ends with DeadlineExceeded once it has passed
+def bounded(chunks: Iterator[T], seconds: Optional[float]) -> Iterator[T]:
+    if not seconds:
+        yield from chunks
+        return
+    at = time.monotonic() + seconds
+    it = iter(chunks)
+    while True:
+        with deadline_at(at):
+            check()
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+        yield chunk
+
+
+async def abounded(
+    chunks: AsyncIterator[T], seconds: Optional[float]
+) -> AsyncIterator[T]:
+    if not seconds:
+        async for chunk in chunks:
+            yield chunk
+        return
+    at = time.monotonic() + seconds
+    it = chunks.__aiter__()
+    while True:
+        with deadline_at(at):
+            try:
+                chunk = await awithin(it.__anext__())
+            except StopAsyncIteration:
+                return
+        yield chunk
+
+
+# Awaits an awaitable for at most the remaining time of the current deadline
+async def awithin(aw):
+    timeout = remaining()
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, max(timeout, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("request deadline exceeded")
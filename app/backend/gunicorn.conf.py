@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# Multi-threaded serving mode for app.py, e.g.
+#   gunicorn -c gunicorn.conf.py app:app
+# Each worker process handles up to WEB_THREADS requests at a time on one set of approach instances and caches, so a few
+# workers with many threads go further than many single-threaded ones. Requests spend most of their time waiting on
+# Cognitive Search and OpenAI, which releases the GIL.
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_WORKERS") or min(multiprocessing.cpu_count(), 4))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS") or 16)
+# Agent runs can take a while, more so when streaming
+timeout = int(os.environ.get("WEB_TIMEOUT") or 230)
@@ -1,6 +1,12 @@
-from typing import Any, Dict, List, Optional
-from langchain.callbacks.base import BaseCallbackHandler
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+from langchain.callbacks.base import BaseCallbackHandler, CallbackManager
 from langchain.schema import AgentAction, AgentFinish, LLMResult
+import deadlines
+import stages
 
 
 def ch(text: str) -> str:
@@ -13,40 +19,68 @@ def ch(text: str) -> str:
     )
 
 
-class HtmlCallbackHandler(BaseCallbackHandler):
-    html: str = ""
+@dataclass
+class TraceEvent:
+    kind: str  # llm, chain, tool, text or agent
+    phase: str  # start, end, error, or event for the ones without a duration
+    t: float  # seconds since the collector was created
+    # For end and error, seconds since the matching start
+    duration: Optional[float] = None
+    data: Dict[str, Any] = field(default_factory=dict)
 
-    def get_and_reset_log(self) -> str:
-        result = self.html
-        self.html = ""
-        return result
+
+# Records what happens during an agent run as typed events with monotonic timestamps. Recording only appends to a list
+# and keeps references to the payloads, everything is formatted later by one of the renderers, and only if someone
+# asks for it (see TraceStore).
+class TraceCollector(BaseCallbackHandler):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.events: List[TraceEvent] = []
+        self._open: Dict[str, List[float]] = {}
+
+    # Agents and chains only pass events on to handlers if they were built with verbose=True, traces are always wanted
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def start(self, kind: str, **data: Any):
+        t = time.monotonic() - self.started
+        self._open.setdefault(kind, []).append(t)
+        self.events.append(TraceEvent(kind, "start", t, data=data))
+
+    def end(self, kind: str, phase: str = "end", **data: Any):
+        t = time.monotonic() - self.started
+        starts = self._open.get(kind)
+        duration = t - starts.pop() if starts else None
+        self.events.append(TraceEvent(kind, phase, t, duration, data))
+        if duration is not None and kind in ("llm", "tool"):
+            stages.observe("agent_" + kind, duration)
+
+    def event(self, kind: str, **data: Any):
+        t = time.monotonic() - self.started
+        self.events.append(TraceEvent(kind, "event", t, data=data))
 
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
-        """Print out the prompts."""
-        self.html += f"LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>"
+        self.start("llm", prompts=prompts)
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        """Do nothing."""
-        pass
+        self.end("llm", token_usage=(response.llm_output or {}).get("token_usage"))
 
     def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
+        self.end("llm", "error", error=error)
 
     def on_chain_start(
         self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
     ) -> None:
-        """Print out that we are entering a chain."""
-        class_name = serialized["name"]
-        self.html += f"Entering chain: {ch(class_name)}<br>"
+        self.start("chain", name=serialized["name"])
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
-        """Print out that we finished a chain."""
-        self.html += f"Finished chain<br>"
+        self.end("chain")
 
     def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
+        self.end("chain", "error", error=error)
 
     def on_tool_start(
         self,
@@ -55,8 +89,7 @@ class HtmlCallbackHandler(BaseCallbackHandler):
         color: Optional[str] = None,
         **kwargs: Any,
     ) -> None:
-        """Print out the log in specified color."""
-        self.html += f"<span style='color:{color}'>{ch(action.log)}</span><br>"
+        self.start("tool", action=action, color=color)
 
     def on_tool_end(
         self,
@@ -66,11 +99,16 @@ class HtmlCallbackHandler(BaseCallbackHandler):
         llm_prefix: Optional[str] = None,
         **kwargs: Any,
     ) -> None:
-        """If not the final action, print out observation."""
-        self.html += f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>"
+        self.end(
+            "tool",
+            output=output,
+            color=color,
+            observation_prefix=observation_prefix,
+            llm_prefix=llm_prefix,
+        )
 
     def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Tool error: {ch(error)}</span><br>"
+        self.end("tool", "error", error=error)
 
     def on_text(
         self,
@@ -79,11 +117,190 @@ class HtmlCallbackHandler(BaseCallbackHandler):
         end: str = "",
         **kwargs: Optional[str],
     ) -> None:
-        """Run when agent ends."""
-        self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
+        self.event("text", text=text, color=color)
 
     def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
-        """Run on agent end."""
-        self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+        self.event("agent", log=finish.log, color=color)
+
+    def metrics(self) -> dict:
+        m = {
+            "duration": (self.events[-1].t if self.events else 0.0),
+            "llm_calls": 0,
+            "llm_time": 0.0,
+            "tool_calls": 0,
+            "tool_time": 0.0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
+        for e in self.events:
+            if e.phase == "error":
+                m["errors"] += 1
+            if e.phase not in ("end", "error") or e.kind not in ("llm", "tool"):
+                continue
+            m[e.kind + "_calls"] += 1
+            m[e.kind + "_time"] += e.duration or 0.0
+            for key, value in (e.data.get("token_usage") or {}).items():
+                if key in m:
+                    m[key] += value
+        return m
+
+    def to_json(self) -> dict:
+        events = []
+        for e in self.events:
+            data = {}
+            for key, value in e.data.items():
+                if isinstance(value, AgentAction):
+                    value = {
+                        "tool": value.tool,
+                        "tool_input": value.tool_input,
+                        "log": value.log,
+                    }
+                elif isinstance(value, Exception):
+                    value = str(value)
+                data[key] = value
+            events.append(
+                {
+                    "kind": e.kind,
+                    "phase": e.phase,
+                    "t": e.t,
+                    "duration": e.duration,
+                    "data": data,
+                }
+            )
+        return {"events": events, "metrics": self.metrics()}
+
+    def render_html(self) -> str:
+        parts = []
+        for e in self.events:
+            d = e.data
+            took = f" <i>({e.duration:.2f}s)</i>" if e.duration is not None else ""
+            if e.phase == "error":
+                parts.append(
+                    f"<span style='color:red'>{e.kind.capitalize()} error: {ch(d['error'])}</span>{took}<br>"
+                )
+            elif e.kind == "llm" and e.phase == "start":
+                parts.append(
+                    "LLM prompts:<br>" + "<br>".join(map(ch, d["prompts"])) + "<br>"
+                )
+            elif e.kind == "llm":
+                usage = d.get("token_usage") or {}
+                tokens = (
+                    f", {usage['total_tokens']} tokens"
+                    if "total_tokens" in usage
+                    else ""
+                )
+                parts.append(f"<i>LLM call finished{tokens}</i>{took}<br>")
+            elif e.kind == "chain" and e.phase == "start":
+                parts.append(f"Entering chain: {ch(d['name'])}<br>")
+            elif e.kind == "chain":
+                parts.append(f"Finished chain{took}<br>")
+            elif e.kind == "tool" and e.phase == "start":
+                parts.append(
+                    f"<span style='color:{d['color']}'>{ch(d['action'].log)}</span><br>"
+                )
+            elif e.kind == "tool":
+                parts.append(
+                    f"{ch(d['observation_prefix'])}{took}<br><span style='color:{d['color']}'>{ch(d['output'])}</span><br>{ch(d['llm_prefix'])}<br>"
+                )
+            elif e.kind == "text":
+                parts.append(
+                    f"<span style='color:{d['color']}'>{ch(d['text'])}</span><br>"
+                )
+            else:
+                parts.append(
+                    f"<span style='color:{d['color']}'>{ch(d['log'])}</span><br>"
+                )
+        m = self.metrics()
+        parts.append(
+            f"<br><i>{m['duration']:.2f}s in total, {m['llm_calls']} LLM calls ({m['llm_time']:.2f}s, "
+            f"{m['total_tokens']} tokens), {m['tool_calls']} tool calls ({m['tool_time']:.2f}s)</i><br>"
+        )
+        return "".join(parts)
+
+
+# Handler of the request being served on the current thread (or task), see RequestCallbackHandler
+current_handler: ContextVar[Optional[BaseCallbackHandler]] = ContextVar(
+    "current_handler", default=None
+)
+
+
+@contextmanager
+def handling(handler: BaseCallbackHandler) -> Iterator[None]:
+    token = current_handler.set(handler)
+    try:
+        yield
+    finally:
+        current_handler.reset(token)
+
+
+# LangChain objects get their callback manager when they are built, so objects shared by all requests (see
+# AgentRegistry) are built with this handler, which passes every callback on to the handler of the current request.
+# It also ends agent runs whose request deadline has passed before their next LLM call or tool use.
+class RequestCallbackHandler(BaseCallbackHandler):
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        deadlines.check()
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_llm_start(*args, **kwargs)
+
+    def on_llm_end(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_llm_end(*args, **kwargs)
+
+    def on_llm_error(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_llm_error(*args, **kwargs)
+
+    def on_chain_start(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_chain_start(*args, **kwargs)
+
+    def on_chain_end(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_chain_end(*args, **kwargs)
+
+    def on_chain_error(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_chain_error(*args, **kwargs)
+
+    def on_tool_start(self, *args: Any, **kwargs: Any) -> None:
+        deadlines.check()
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_tool_start(*args, **kwargs)
+
+    def on_tool_end(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_tool_end(*args, **kwargs)
+
+    def on_tool_error(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_tool_error(*args, **kwargs)
+
+    def on_text(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_text(*args, **kwargs)
+
+    def on_agent_finish(self, *args: Any, **kwargs: Any) -> None:
+        handler = current_handler.get()
+        if handler is not None:
+            handler.on_agent_finish(*args, **kwargs)
+
+
+request_callback_manager = CallbackManager(handlers=[RequestCallbackHandler()])
@@ -0,0 +1,223 @@
+import gzip
+import json
+import math
+import re
+import sys
+from collections import Counter
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+import numpy as np
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.casefold())
+
+
+class LocalCaption(NamedTuple):
+    text: str
+    highlights: Optional[str] = None
+
+
+class LocalAnswer(NamedTuple):
+    key: str
+    text: str
+    score: float
+    highlights: Optional[str] = None
+
+
+# Iterable over the matching documents, with the paging-independent parts of the Cognitive Search results API
+class LocalSearchResults:
+    def __init__(
+        self,
+        docs: List[dict],
+        count: Optional[int] = None,
+        answers: Optional[List[LocalAnswer]] = None,
+    ):
+        self.docs = docs
+        self.count = count
+        self.answers = answers
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.docs)
+
+    def get_count(self) -> Optional[int]:
+        return self.count
+
+    def get_answers(self) -> Optional[List[LocalAnswer]]:
+        return self.answers
+
+
+# In-process full-text search over a small document set, usable in place of the Cognitive Search SearchClient (only the
+# subset of search() the approaches use). Documents are ranked with BM25 over an inverted index of one text field;
+# filters of the form "<field> eq|ne '<value>'" are supported, semantic ranking options are accepted and ignored. When
+# captions are requested the sentence sharing most terms with the query is extracted from each document, and it is
+# returned as an answer when it contains all of them.
+#
+# The index is persisted as gzipped JSON with delta-encoded postings, see build() and load().
+class LocalSearchClient:
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(
+        self,
+        fields: List[str],
+        docs: List[list],
+        postings: Dict[str, list],
+        key_field: str = "id",
+        content_field: str = "content",
+    ):
+        self.fields = fields
+        self.docs = docs
+        self.key_field = key_field
+        self.content_field = content_field
+        self._field_index = {f: i for i, f in enumerate(fields)}
+        self._content = self._field_index[content_field]
+        self.lengths = np.zeros(len(docs), dtype=np.float32)
+        self.postings: Dict[str, tuple] = {}
+        for term, (deltas, tfs) in postings.items():
+            ids = np.cumsum(np.array(deltas, dtype=np.int32))
+            tfs = np.array(tfs, dtype=np.float32)
+            self.postings[term] = (ids, tfs)
+            np.add.at(self.lengths, ids, tfs)
+        self.avg_length = float(self.lengths.mean()) if len(docs) else 0.0
+
+    @classmethod
+    def build(
+        cls,
+        documents: List[dict],
+        key_field: str = "id",
+        content_field: str = "content",
+    ) -> "LocalSearchClient":
+        fields = sorted({f for doc in documents for f in doc})
+        docs = [[doc.get(f) for f in fields] for doc in documents]
+        ids: Dict[str, List[int]] = {}
+        tfs: Dict[str, List[int]] = {}
+        for i, doc in enumerate(documents):
+            for term, tf in Counter(tokenize(doc.get(content_field) or "")).items():
+                ids.setdefault(term, []).append(i)
+                tfs.setdefault(term, []).append(tf)
+        postings = {
+            term: (np.diff(doc_ids, prepend=0).tolist(), tfs[term])
+            for term, doc_ids in ids.items()
+        }
+        return cls(fields, docs, postings, key_field, content_field)
+
+    @classmethod
+    def load(cls, filename: str) -> "LocalSearchClient":
+        with gzip.open(filename, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            data["fields"],
+            data["docs"],
+            data["postings"],
+            data["key_field"],
+            data["content_field"],
+        )
+
+    def save(self, filename: str):
+        postings = {
+            term: (np.diff(ids, prepend=0).tolist(), tfs.astype(int).tolist())
+            for term, (ids, tfs) in self.postings.items()
+        }
+        with gzip.open(filename, "wt", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "fields": self.fields,
+                    "docs": self.docs,
+                    "postings": postings,
+                    "key_field": self.key_field,
+                    "content_field": self.content_field,
+                },
+                f,
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+
+    def search(
+        self,
+        search_text: str,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        include_total_count: bool = False,
+        query_caption: Optional[str] = None,
+        query_answer: Optional[str] = None,
+        select: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> LocalSearchResults:
+        terms = list(dict.fromkeys(tokenize(search_text)))
+        if search_text.strip() == "*":
+            scores = np.ones(len(self.docs), dtype=np.float32)
+        else:
+            scores = self.score(terms)
+        mask = scores > 0
+        if filter:
+            mask &= self.filter_mask(filter)
+        matches = np.flatnonzero(mask)
+        top = top or 50
+        if len(matches) > top:
+            matches = matches[np.argpartition(-scores[matches], top - 1)[:top]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+
+        docs = []
+        answers = []
+        for i in matches:
+            doc = dict(zip(self.fields, self.docs[i]))
+            if select:
+                doc = {field: doc.get(field) for field in select}
+            doc["@search.score"] = float(scores[i])
+            doc["@search.captions"] = None
+            if query_caption:
+                caption, matched = self.caption(self.docs[i][self._content], terms)
+                doc["@search.captions"] = [LocalCaption(caption)]
+                if query_answer and not answers and terms and matched == len(terms):
+                    answers.append(
+                        LocalAnswer(
+                            str(doc.get(self.key_field)), caption, float(scores[i])
+                        )
+                    )
+            docs.append(doc)
+        return LocalSearchResults(
+            docs,
+            int(mask.sum()) if include_total_count else None,
+            answers if query_answer else None,
+        )
+
+    def score(self, terms: List[str]) -> np.ndarray:
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / (self.avg_length or 1))
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            idf = math.log(1 + (len(self.docs) - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm[ids])
+        return scores
+
+    def filter_mask(self, filter: str) -> np.ndarray:
+        m = re.fullmatch(r"\s*(\w+)\s+(eq|ne)\s+'((?:[^']|'')*)'\s*", filter)
+        if not m or m.group(1) not in self._field_index:
+            raise ValueError(f"Unsupported filter: {filter}")
+        field = self._field_index[m.group(1)]
+        value = m.group(3).replace("''", "'")
+        equal = np.fromiter(
+            (doc[field] == value for doc in self.docs), dtype=bool, count=len(self.docs)
+        )
+        return equal if m.group(2) == "eq" else ~equal
+
+    def caption(self, content: str, terms: List[str]) -> tuple:
+        best, best_matched = "", -1
+        wanted = set(terms)
+        for sentence in re.split(r"(?<=[.!?])\s+|\n+", content or ""):
+            matched = len(wanted.intersection(tokenize(sentence)))
+            if matched > best_matched:
+                best, best_matched = sentence.strip(), matched
+        return best, best_matched
+
+
+# Builds an index file from documents in JSON lines format, one object per document with the same fields as the
+# Cognitive Search index, e.g.
+#   python localsearch.py documents.jsonl index.json.gz
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as f:
+        documents = [json.loads(line) for line in f if line.strip()]
+    LocalSearchClient.build(documents).save(sys.argv[2])
@@ -1,7 +1,171 @@
 from os import path
+import bisect
 import csv
+import hashlib
+import heapq
+import io
+import logging
+import os
+import sys
+import threading
+import time
 from langchain.agents import Tool
-from typing import Optional
+from typing import IO, Dict, List, Optional, Tuple
+
+
+# Snapshot of a CSV file: values are kept as interned strings in one tuple per row, the index maps each key to the row
+# it was last seen in, and the sorted keys allow prefix lookups. Readers use whatever snapshot is current while a reload
+# builds the next one. Appended rows extend the rows and index of the current snapshot in place (rows are only ever
+# added, so its keys still address the same rows), only the list of keys is new.
+class CsvTable:
+    def __init__(
+        self,
+        fields: Tuple[str, ...],
+        rows: List[Tuple[str, ...]],
+        index: Dict[str, int],
+        keys: List[str],
+    ):
+        self.fields = fields
+        self.rows = rows
+        self.index = index
+        self.keys = keys
+
+    def format(self, row: int) -> str:
+        return "\n".join(f"{f}:{v}" for f, v in zip(self.fields, self.rows[row]))
+
+
+# Lookup store for a CSV file, shared by all tools in the process that use the same file and key (see shared()). The
+# file is checked for changes at most every check_interval seconds. If it only grew since the last load, the last load
+# ended with a complete line and a hash of the bytes before the old end is unchanged, only the appended lines are
+# parsed; any other change reloads the whole file. While the file is missing (e.g. during an atomic replace) the rows
+# last loaded are served.
+class CsvLookupStore:
+    _shared: Dict[Tuple[str, str], "CsvLookupStore"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, filename: str, key_field: str, check_interval: float = 1.0):
+        self.filename = filename
+        self.key_field = key_field
+        self.check_interval = check_interval
+        self.table: CsvTable = None
+        self._mtime = None
+        # Bytes parsed so far, their hash, and whether they end with a complete line
+        self._offset = 0
+        self._hash = hashlib.sha256()
+        self._appendable = False
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+
+    @classmethod
+    def shared(cls, filename: str, key_field: str) -> "CsvLookupStore":
+        key = (path.abspath(filename), key_field)
+        with cls._shared_lock:
+            store = cls._shared.get(key)
+            if store is None:
+                store = cls._shared[key] = cls(filename, key_field)
+            return store
+
+    def current(self) -> CsvTable:
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            self._checked = now
+            try:
+                if os.stat(self.filename).st_mtime_ns != self._mtime:
+                    self.reload()
+            except OSError as e:
+                logging.warning("Keeping %s as last loaded: %s", self.filename, e)
+        return self.table
+
+    def reload(self):
+        with self._lock:
+            stat = os.stat(self.filename)
+            if self.table is not None and stat.st_mtime_ns == self._mtime:
+                return
+            with open(self.filename, "rb") as f:
+                if (
+                    self.table is not None
+                    and self._appendable
+                    and stat.st_size > self._offset
+                    and self.unchanged(f)
+                ):
+                    self.table = self.append(f.read(), self.table)
+                    self._mtime = stat.st_mtime_ns
+                    return
+                f.seek(0)
+                self._offset = 0
+                self._hash = hashlib.sha256()
+                self.table = self.parse(f.read())
+                self._mtime = stat.st_mtime_ns
+
+    # Whether the first self._offset bytes of the file hash the same as when they were parsed, leaves f positioned
+    # after them
+    def unchanged(self, f: IO[bytes], chunk_size: int = 1 << 20) -> bool:
+        h = hashlib.sha256()
+        remaining = self._offset
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                return False
+            h.update(data)
+            remaining -= len(data)
+        return h.digest() == self._hash.digest()
+
+    def consumed(self, data: bytes):
+        self._hash.update(data)
+        self._offset += len(data)
+        self._appendable = not data or data.endswith(b"\n")
+
+    # Parses the whole file, including a last line without a newline
+    def parse(self, data: bytes) -> CsvTable:
+        reader = csv.reader(io.StringIO(data.decode("utf-8-sig"), newline=""))
+        fields = tuple(next(reader, ()))
+        key_column = fields.index(self.key_field)
+        rows, index = [], {}
+        for values in reader:
+            if not values:
+                continue
+            index[values[key_column]] = len(rows)
+            rows.append(tuple(sys.intern(v) for v in values))
+        self.consumed(data)
+        return CsvTable(fields, rows, index, sorted(index))
+
+    # Parses the complete lines appended to the file into the given table, a line still being written is left for the
+    # next reload
+    def append(self, data: bytes, table: CsvTable) -> CsvTable:
+        data = data[: data.rfind(b"\n") + 1]
+        reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+        key_column = table.fields.index(self.key_field)
+        rows, index = table.rows, table.index
+        new_keys = set()
+        for values in reader:
+            if not values:
+                continue
+            key = values[key_column]
+            if key not in index:
+                new_keys.add(key)
+            rows.append(tuple(sys.intern(v) for v in values))
+            index[key] = len(rows) - 1
+        self.consumed(data)
+        keys = table.keys
+        if new_keys:
+            keys = list(heapq.merge(keys, sorted(new_keys)))
+        return CsvTable(table.fields, rows, index, keys)
+
+    def lookup(self, key: str) -> str:
+        table = self.current()
+        row = table.index.get(key)
+        return table.format(row) if row is not None else ""
+
+    def lookup_prefix(self, prefix: str, limit: int = 10) -> List[str]:
+        table = self.current()
+        start = bisect.bisect_left(table.keys, prefix)
+        matches = []
+        for key in table.keys[start : start + limit]:
+            if not key.startswith(prefix):
+                break
+            matches.append(table.format(table.index[key]))
+        return matches
 
 
 class CsvLookupTool(Tool):
@@ -13,11 +177,15 @@ class CsvLookupTool(Tool):
         description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
     ):
         super().__init__(name, self.lookup, description)
-        self.data = {}
-        with open(filename, newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] = "\n".join([f"{i}:{row[i]}" for i in row])
+        self.store = CsvLookupStore.shared(filename, key_field)
 
+    # Several keys can be looked up at once separated by semicolons, and a key ending in * matches all keys starting
+    # with the text before it
     def lookup(self, key: str) -> Optional[str]:
-        return self.data.get(key, "")
+        results = []
+        for k in (k.strip() for k in key.split(";")):
+            if k.endswith("*"):
+                results.extend(self.store.lookup_prefix(k[:-1]))
+            else:
+                results.append(self.store.lookup(k))
+        return "\n\n".join(r for r in results if r)
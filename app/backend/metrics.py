@@ -0,0 +1,367 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+# Endpoint and approach of the request being served on the current thread (or task), the labels of everything it records
+current_labels: ContextVar[Tuple[str, str]] = ContextVar(
+    "current_labels", default=("", "")
+)
+
+
+# Values recorded by one thread, keyed by metric and label values. A thread only ever writes to its own shard, so
+# recording takes no lock; /metrics adds the shards up. Shards of finished threads are folded into one when scraped.
+class Shards:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def merged(self) -> dict:
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    add(self._retired, shard)
+            self._shards = alive
+            total = {}
+            add(total, self._retired)
+            for _, shard in alive:
+                add(total, shard)
+        return total
+
+
+def add(total: dict, shard: dict):
+    # Copied first, the owning thread may add keys meanwhile
+    for key, values in list(shard.items()):
+        into = total.get(key)
+        if into is None:
+            total[key] = list(values)
+        else:
+            for i, v in enumerate(values):
+                into[i] += v
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, registry: "Registry", name: str, help: str, labels: Tuple[str]):
+        self.shards = registry.shards
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.metrics.append(self)
+
+    def _values(self, label_values: tuple, size: int) -> list:
+        shard = self.shards.get()
+        values = shard.get((self, label_values))
+        if values is None:
+            values = shard[(self, label_values)] = [0] * size
+        return values
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values(label_values, 1)[0] += amount
+
+    def samples(self, values: list) -> Iterator[Tuple[str, dict, float]]:
+        yield self.name, {}, values[0]
+
+
+# Summed over threads, so it's fine for one thread to increase it and another to decrease it
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self._values(label_values, 1)[0] -= amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        registry: "Registry",
+        name: str,
+        help: str,
+        labels: Tuple[str],
+        buckets: Tuple[float],
+    ):
+        super().__init__(registry, name, help, labels)
+        self.buckets = buckets
+
+    # Values are the count per bucket (the last one for values above all buckets), the sum and the count
+    def observe(self, value: float, *label_values: str):
+        values = self._values(label_values, len(self.buckets) + 3)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def samples(self, values: list) -> Iterator[Tuple[str, dict, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, values):
+            cumulative += count
+            yield self.name + "_bucket", {"le": repr(float(bound))}, cumulative
+        yield self.name + "_bucket", {"le": "+Inf"}, values[-1]
+        yield self.name + "_sum", {}, values[-2]
+        yield self.name + "_count", {}, values[-1]
+
+
+# Values that are already counted elsewhere (e.g. cache hits) are read when scraped, by a function returning the label
+# values and value of each series
+Collect = Callable[[], Iterable[Tuple[tuple, float]]]
+
+
+class Registry:
+    def __init__(self):
+        self.shards = Shards()
+        self.metrics: List[Metric] = []
+        self.collectors: List[Tuple[str, str, str, Tuple[str], Collect]] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str] = ()) -> Counter:
+        return Counter(self, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Tuple[str] = ()) -> Gauge:
+        return Gauge(self, name, help, labels)
+
+    def histogram(
+        self, name: str, help: str, labels: Tuple[str], buckets: Tuple[float]
+    ) -> Histogram:
+        return Histogram(self, name, help, labels, buckets)
+
+    def collect(
+        self, name: str, help: str, kind: str, labels: Tuple[str], func: Collect
+    ):
+        self.collectors.append((name, help, kind, labels, func))
+
+    # Prometheus text exposition format
+    def render(self) -> str:
+        merged = self.merged_by_metric()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for label_values, values in sorted(merged.get(metric, {}).items()):
+                labels = dict(zip(metric.labels, label_values))
+                for name, extra, value in metric.samples(values):
+                    lines.append(sample(name, {**labels, **extra}, value))
+        for name, help, kind, label_names, func in self.collectors:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for label_values, value in func():
+                lines.append(sample(name, dict(zip(label_names, label_values)), value))
+        return "\n".join(lines) + "\n"
+
+    def merged_by_metric(self) -> Dict[Metric, Dict[tuple, list]]:
+        by_metric = {}
+        for (metric, label_values), values in self.shards.merged().items():
+            by_metric.setdefault(metric, {})[label_values] = values
+        return by_metric
+
+
+def sample(name: str, labels: dict, value: float) -> str:
+    if labels:
+        rendered = ",".join(f'{k}="{escape(str(v))}"' for k, v in labels.items())
+        name = f"{name}{{{rendered}}}"
+    return f"{name} {value}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+requests_in_flight = registry.gauge(
+    "app_requests_in_flight", "Requests being answered", ("endpoint",)
+)
+request_duration = registry.histogram(
+    "app_request_duration_seconds",
+    "Time to answer a request, until the last chunk for streamed ones",
+    ("endpoint", "approach"),
+    LATENCY_BUCKETS,
+)
+request_errors = registry.counter(
+    "app_request_errors_total",
+    "Requests that failed, by error type",
+    ("endpoint", "approach", "error"),
+)
+stage_duration = registry.histogram(
+    "app_stage_duration_seconds",
+    "Duration of pipeline stages (embed, query_rewrite, search, select, completion, agent, and agent_llm and agent_tool "
+    "for each agent iteration)",
+    ("endpoint", "approach", "stage"),
+    LATENCY_BUCKETS,
+)
+openai_tokens = registry.histogram(
+    "app_openai_tokens",
+    "Tokens per OpenAI call as reported by the service (streamed calls report none), the _sum is the total",
+    ("endpoint", "approach", "deployment", "kind"),
+    TOKEN_BUCKETS,
+)
+openai_errors = registry.counter(
+    "app_openai_errors_total",
+    "OpenAI calls that failed, by error type",
+    ("endpoint", "approach", "deployment", "error"),
+)
+search_results = registry.histogram(
+    "app_search_results",
+    "Documents returned per search (not counting cached results)",
+    ("endpoint", "approach"),
+    COUNT_BUCKETS,
+)
+
+
+# Stage timings arrive through stages.observers
+def observe_stage(name: str, seconds: float):
+    stage_duration.observe(seconds, *current_labels.get(), name)
+
+
+@contextmanager
+def tracking(endpoint: str, approach: str) -> Iterator[None]:
+    token = current_labels.set((endpoint, approach))
+    requests_in_flight.inc(endpoint)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        request_errors.inc(endpoint, approach, type(e).__name__)
+        raise
+    finally:
+        request_duration.observe(time.perf_counter() - start, endpoint, approach)
+        requests_in_flight.dec(endpoint)
+        current_labels.reset(token)
+
+
+# Same for streamed responses, each chunk is produced with the request's labels. The request is in flight until the
+# stream has ended or was abandoned by the client.
+def tracked(chunks: Iterator[T], endpoint: str, approach: str) -> Iterator[T]:
+    requests_in_flight.inc(endpoint)
+    start = time.perf_counter()
+    it = iter(chunks)
+    try:
+        while True:
+            token = current_labels.set((endpoint, approach))
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+            except Exception as e:
+                request_errors.inc(endpoint, approach, type(e).__name__)
+                raise
+            finally:
+                current_labels.reset(token)
+            yield chunk
+    finally:
+        request_duration.observe(time.perf_counter() - start, endpoint, approach)
+        requests_in_flight.dec(endpoint)
+
+
+async def atracked(
+    chunks: AsyncIterator[T], endpoint: str, approach: str
+) -> AsyncIterator[T]:
+    requests_in_flight.inc(endpoint)
+    start = time.perf_counter()
+    it = chunks.__aiter__()
+    try:
+        while True:
+            token = current_labels.set((endpoint, approach))
+            try:
+                chunk = await it.__anext__()
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                request_errors.inc(endpoint, approach, type(e).__name__)
+                raise
+            finally:
+                current_labels.reset(token)
+            yield chunk
+    finally:
+        request_duration.observe(time.perf_counter() - start, endpoint, approach)
+        requests_in_flight.dec(endpoint)
+
+
+def record_search(results: int):
+    search_results.observe(results, *current_labels.get())
+
+
+def record_openai(deployment: str, usage: Optional[dict]):
+    if usage:
+        labels = current_labels.get()
+        for kind in ("prompt", "completion"):
+            tokens = usage.get(kind + "_tokens")
+            if tokens is not None:
+                openai_tokens.observe(tokens, *labels, deployment, kind)
+
+
+def record_openai_error(deployment: str, e: Exception):
+    openai_errors.inc(*current_labels.get(), deployment, type(e).__name__)
+
+
+# Records the token usage and errors of every call made through the OpenAI SDK, including LangChain's
+def install_openai_hooks():
+    import openai.api_requestor
+    from quota import DEPLOYMENT_URL
+
+    request = openai.api_requestor.APIRequestor.request
+    arequest = openai.api_requestor.APIRequestor.arequest
+
+    def deployment(url: str) -> str:
+        m = DEPLOYMENT_URL.search(url)
+        return m.group(1) if m else ""
+
+    def usage(result) -> Optional[dict]:
+        response, got_stream, _ = result
+        return None if got_stream else (response.data or {}).get("usage")
+
+    def recorded_request(self, method, url, *args, **kwargs):
+        try:
+            result = request(self, method, url, *args, **kwargs)
+        except Exception as e:
+            record_openai_error(deployment(url), e)
+            raise
+        record_openai(deployment(url), usage(result))
+        return result
+
+    async def recorded_arequest(self, method, url, *args, **kwargs):
+        try:
+            result = await arequest(self, method, url, *args, **kwargs)
+        except Exception as e:
+            record_openai_error(deployment(url), e)
+            raise
+        record_openai(deployment(url), usage(result))
+        return result
+
+    openai.api_requestor.APIRequestor.request = recorded_request
+    openai.api_requestor.APIRequestor.arequest = recorded_arequest
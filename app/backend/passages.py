@@ -0,0 +1,95 @@
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Tuple
+from tokenbudget import TokenCounter
+
+# numpy is imported by the first selection, not with the app
+if TYPE_CHECKING:
+    import numpy as np
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n\s*\n")
+WORD = re.compile(r"\w+")
+
+
+# Picks the passages of a retrieved document that best match the query, instead of cutting its content after a fixed
+# number of characters. Content is split into sentences, which are merged into passages of up to passage_tokens and
+# scored against the query with BM25, using the passages of the document as the corpus. The best passages are packed
+# into the token budget and returned in document order, gaps are marked with an ellipsis. Content that fits the budget
+# is returned unchanged, and when no passage shares a word with the query the leading passages are kept.
+class PassageSelector:
+    def __init__(
+        self,
+        counter: TokenCounter,
+        max_tokens: int = 300,
+        passage_tokens: int = 60,
+        k1: float = 1.2,
+        b: float = 0.75,
+        cache_size: int = 1024,
+    ):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.passage_tokens = passage_tokens
+        self.k1 = k1
+        self.b = b
+        self.passages = lru_cache(maxsize=cache_size)(self._passages)
+
+    def _passages(self, content: str) -> Tuple[List[str], "np.ndarray"]:
+        import numpy as np
+
+        passages = []
+        sizes = []
+        for sentence in SENTENCE_END.split(content):
+            sentence = " ".join(sentence.split())
+            if not sentence:
+                continue
+            tokens = self.counter.count(sentence)
+            if passages and sizes[-1] + tokens <= self.passage_tokens:
+                passages[-1] += " " + sentence
+                sizes[-1] += tokens
+            else:
+                passages.append(sentence)
+                sizes.append(tokens)
+        return passages, np.array(sizes, dtype=np.int64)
+
+    def scores(self, q: str, passages: List[str]) -> "np.ndarray":
+        import numpy as np
+
+        terms = {t: i for i, t in enumerate(dict.fromkeys(WORD.findall(q.casefold())))}
+        words = [WORD.findall(p.casefold()) for p in passages]
+        lengths = np.array([len(w) for w in words], dtype=np.float64)
+        rows = [(i, terms[w]) for i, ws in enumerate(words) for w in ws if w in terms]
+        tf = np.zeros((len(passages), len(terms)))
+        if rows:
+            rows = np.array(rows)
+            np.add.at(tf, (rows[:, 0], rows[:, 1]), 1)
+        df = np.count_nonzero(tf, axis=0)
+        idf = np.log1p((len(passages) - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1))
+        return (tf * (self.k1 + 1) / (tf + norm[:, None])) @ idf
+
+    def select(self, q: str, content: str, max_tokens: int = None) -> str:
+        import numpy as np
+
+        max_tokens = max_tokens or self.max_tokens
+        if self.counter.count(content) <= max_tokens:
+            return content
+        passages, sizes = self.passages(content)
+        if not passages:
+            return content
+        scores = self.scores(q, passages)
+        # Best first, ties (and content without any query word) in document order
+        order = np.lexsort((np.arange(len(passages)), -scores))
+        chosen = []
+        remaining = max_tokens
+        for i in order:
+            if sizes[i] <= remaining:
+                chosen.append(i)
+                remaining -= sizes[i]
+        if not chosen:
+            return self.counter.truncate(passages[order[0]], max_tokens)
+
+        chosen.sort()
+        parts = [passages[chosen[0]]]
+        for prev, i in zip(chosen, chosen[1:]):
+            parts.append(passages[i] if i == prev + 1 else "… " + passages[i])
+        return " ".join(parts)
@@ -0,0 +1,189 @@
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, TypeVar
+import stages
+
+T = TypeVar("T")
+
+
+# Samples the stacks of the threads serving selected requests every interval seconds and counts them in collapsed
+# format, "tag;stage;module:function;... count" per line, ready for flamegraph.pl or speedscope. The tag is the endpoint
+# and approach of the request and the stage the pipeline stage it was in (see stages.stage), or "request" between
+# stages (e.g. while the prompt is built). Work that requests hand off to thread pools (fan-out, hedged and speculative
+# searches) is sampled while it runs a stage.
+#
+# Requests are selected after arm(): the next `requests` of them, or a fraction `rate` of them for `duration` seconds,
+# and any request that asks for it (see app.profile_requested). Unless armed, checking costs one attribute lookup per
+# request, and there is no sampler thread. Under the ASGI app the event loop thread is shared, samples taken there may
+# include work for other requests.
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, max_stacks: int = 10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.armed = False
+        self.requests = 0
+        self.rate = 0.0
+        self.until = 0.0
+        self.profiled = 0
+        self.samples = 0
+        self.dropped = 0
+        self.stacks: Counter = Counter()
+        self._threads: Dict[int, List[str]] = {}
+        self._sampler: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def arm(self, requests: int = 0, rate: float = 0.0, duration: float = 60):
+        with self._lock:
+            self.requests = requests
+            self.rate = rate
+            self.until = time.monotonic() + duration if rate > 0 else 0.0
+            self.armed = requests > 0 or rate > 0
+
+    def disarm(self):
+        with self._lock:
+            self.requests = 0
+            self.rate = 0.0
+            self.armed = False
+
+    # Decides whether the request that is starting is profiled
+    def select(self, requested: bool = False) -> bool:
+        if not self.armed and not requested:
+            return False
+        with self._lock:
+            if requested:
+                pass
+            elif self.requests > 0:
+                self.requests -= 1
+            elif self.rate > 0 and time.monotonic() < self.until:
+                if random.random() >= self.rate:
+                    return False
+            else:
+                return False
+            self.armed = self.requests > 0 or (
+                self.rate > 0 and time.monotonic() < self.until
+            )
+            self.profiled += 1
+            return True
+
+    @contextmanager
+    def profiling(self, tag: str) -> Iterator[None]:
+        ident = threading.get_ident()
+        token = stages.current_tag.set(tag)
+        with self._lock:
+            self._threads.setdefault(ident, []).append(tag)
+            if stages.profiling is None:
+                stages.profiling = {}
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample, name="profiler", daemon=True
+                )
+                self._sampler.start()
+        try:
+            yield
+        finally:
+            stages.current_tag.reset(token)
+            with self._lock:
+                tags = self._threads[ident]
+                tags.remove(tag)
+                if not tags:
+                    del self._threads[ident]
+
+    # Streamed responses are produced after the request handler has returned, each chunk is produced under profiling
+    def profiled_stream(self, chunks: Iterator[T], tag: str) -> Iterator[T]:
+        it = iter(chunks)
+        while True:
+            with self.profiling(tag):
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    return
+            yield chunk
+
+    async def aprofiled_stream(
+        self, chunks: AsyncIterator[T], tag: str
+    ) -> AsyncIterator[T]:
+        it = chunks.__aiter__()
+        while True:
+            with self.profiling(tag):
+                try:
+                    chunk = await it.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield chunk
+
+    def _sample(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                stage_stacks = stages.profiling or {}
+                targets = {}
+                for ident, tags in self._threads.items():
+                    targets[ident] = tags[-1]
+                for ident, entries in list(stage_stacks.items()):
+                    if entries and ident not in targets:
+                        targets[ident] = entries[-1][0]
+                if not self._threads:
+                    # Stops when no profiled request is left, stage stacks are no longer kept from here on
+                    stages.profiling = None
+                    self._sampler = None
+                    return
+            frames = sys._current_frames()
+            for ident, tag in targets.items():
+                frame = frames.get(ident)
+                if frame is None or ident == me:
+                    continue
+                entries = stage_stacks.get(ident)
+                stage = entries[-1][1] if entries else "request"
+                self._count(";".join([tag, stage] + collapse(frame)))
+
+    def _count(self, stack: str):
+        with self._lock:
+            self.samples += 1
+            if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                self.stacks[stack] += 1
+            else:
+                self.dropped += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {n}\n" for stack, n in self.stacks.items())
+
+    def clear(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+            self.dropped = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "armed": self.armed,
+                "requests": self.requests,
+                "rate": self.rate,
+                "seconds_left": max(self.until - time.monotonic(), 0)
+                if self.rate > 0
+                else 0,
+                "interval": self.interval,
+                "profiled": self.profiled,
+                "in_flight": sum(len(tags) for tags in self._threads.values()),
+                "samples": self.samples,
+                "stacks": len(self.stacks),
+                "dropped": self.dropped,
+            }
+
+
+# Frames from the outermost to the innermost, as module:function
+def collapse(frame) -> List[str]:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        names.append(f"{module}:{code.co_name}".replace(";", ":").replace(" ", "_"))
+        frame = frame.f_back
+    names.reverse()
+    return names
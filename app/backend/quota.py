@@ -0,0 +1,346 @@
+import asyncio
+import heapq
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+import deadlines
+
+# The OpenAI SDK is imported when the scheduler is installed, see app.configure_openai
+if TYPE_CHECKING:
+    import openai.error
+
+T = TypeVar("T")
+
+# Calls are admitted in this order when a deployment is at its quota
+INTERACTIVE, DEFAULT, BATCH = 0, 1, 2
+
+current_priority: ContextVar[int] = ContextVar("current_priority", default=DEFAULT)
+
+
+@contextmanager
+def priority(p: int) -> Iterator[None]:
+    token = current_priority.set(p)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+# Streamed and batched responses are produced after the request handler has returned, each step runs at the priority
+# of the request
+def prioritized(chunks: Iterator[T], p: int) -> Iterator[T]:
+    it = iter(chunks)
+    while True:
+        with priority(p):
+            try:
+                chunk = next(it)
+            except StopIteration:
+                return
+        yield chunk
+
+
+async def aprioritized(chunks: AsyncIterator[T], p: int) -> AsyncIterator[T]:
+    it = chunks.__aiter__()
+    while True:
+        with priority(p):
+            try:
+                chunk = await it.__anext__()
+            except StopAsyncIteration:
+                return
+        yield chunk
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, deployment: str, retry_after: float):
+        super().__init__(
+            f"The {deployment} deployment is at its quota, try again in {retry_after:.0f} seconds"
+        )
+        self.retry_after = retry_after
+
+
+# Allows per_minute units per minute, in bursts of up to burst_seconds worth of them. Amounts larger than a burst cost
+# a full bucket.
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def cost(self, amount: float) -> float:
+        return min(amount, self.capacity)
+
+    def wait_time(self, cost: float) -> float:
+        return max((cost - self.level) / self.rate, 0.0)
+
+    def take(self, cost: float):
+        self.level -= cost
+
+
+# Admits calls to one deployment at the rate of its tokens-per-minute and requests-per-minute quota, so calls wait here
+# instead of being answered with 429 by the service. Tokens are estimated the way the service counts them against the
+# quota, prompt plus max_tokens for every choice.
+#
+# Waiting calls are admitted by priority, then in arrival order. A call whose expected wait (for the calls ahead of it
+# to be admitted) is longer than the max_wait of its priority, or than the time left until its request's deadline, is
+# refused right away with QuotaExceeded. After a 429 nothing is admitted for the time the service asked for. Sync calls
+# wait on a condition, async ones on their event loop, both in the same line.
+class DeploymentQuota:
+    def __init__(
+        self,
+        deployment: str,
+        tokens_per_minute: int,
+        requests_per_minute: int,
+        max_wait: Dict[int, float],
+    ):
+        self.deployment = deployment
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+        self.max_wait = max_wait
+        self.paused_until = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._waiting: List[Tuple[int, int, float]] = []
+        self._seq = itertools.count()
+        self._changed = threading.Condition()
+        # Events of the async calls that are waiting, with their loops
+        self._wakers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        self.tokens.refill(now)
+        self.requests.refill(now)
+        return now
+
+    def _wait_time(self, now: float, cost: float, requests: int = 1) -> float:
+        return max(
+            self.tokens.wait_time(cost),
+            self.requests.wait_time(requests),
+            self.paused_until - now,
+        )
+
+    def _admit(self, cost: float):
+        self.tokens.take(cost)
+        self.requests.take(1)
+        self.admitted += 1
+
+    # Admits the call right away if nothing is waiting and the quota allows it, without blocking
+    def try_acquire(self, tokens: int) -> bool:
+        with self._changed:
+            now = self._refill()
+            cost = self.tokens.cost(tokens)
+            if self._waiting or self._wait_time(now, cost) > 0:
+                return False
+            self._admit(cost)
+            return True
+
+    # Admits the call, refuses it or puts it in line, in which case its entry is returned. Called with the lock held.
+    def _enqueue(
+        self, started: float, cost: float, priority: int
+    ) -> Optional[Tuple[int, int, float]]:
+        ahead = [c for p, _, c in self._waiting if p <= priority]
+        expected = self._wait_time(started, sum(ahead) + cost, len(ahead) + 1)
+        if expected <= 0 and not ahead:
+            self._admit(cost)
+            return None
+        remaining = deadlines.remaining()
+        if expected > self.max_wait.get(priority, 0) or (
+            remaining is not None and expected > remaining
+        ):
+            self.shed += 1
+            raise QuotaExceeded(self.deployment, expected)
+        entry = (priority, next(self._seq), cost)
+        heapq.heappush(self._waiting, entry)
+        self.queued += 1
+        return entry
+
+    # Admits the waiting call if it's first in line and the quota allows it. Otherwise returns how long to wait before
+    # trying again, None for until another call has been admitted or has left the line. Called with the lock held.
+    def _try_admit(
+        self, entry: Tuple[int, int, float], started: float
+    ) -> Tuple[bool, Optional[float]]:
+        now = self._refill()
+        timeout = None
+        if self._waiting[0] is entry:
+            timeout = self._wait_time(now, entry[2])
+            if timeout <= 0:
+                heapq.heappop(self._waiting)
+                self._admit(entry[2])
+                self.waited += now - started
+                return True, None
+        remaining = deadlines.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise deadlines.DeadlineExceeded("request deadline exceeded")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return False, timeout
+
+    def _leave(self, entry: Tuple[int, int, float]):
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+
+    # Wakes the waiting calls to check whether it's their turn. Called with the lock held.
+    def _notify(self):
+        self._changed.notify_all()
+        for loop, woken in self._wakers:
+            loop.call_soon_threadsafe(woken.set)
+
+    def acquire(self, tokens: int, priority: int = DEFAULT):
+        with self._changed:
+            started = self._refill()
+            entry = self._enqueue(started, self.tokens.cost(tokens), priority)
+            if entry is None:
+                return
+            try:
+                while True:
+                    admitted, timeout = self._try_admit(entry, started)
+                    if admitted:
+                        return
+                    self._changed.wait(timeout)
+            except BaseException:
+                self._leave(entry)
+                raise
+            finally:
+                self._notify()
+
+    # Same as acquire, waiting on the event loop, so that queued requests don't hold threads of the default executor
+    async def aacquire(self, tokens: int, priority: int = DEFAULT):
+        woken = asyncio.Event()
+        waker = (asyncio.get_running_loop(), woken)
+        with self._changed:
+            started = self._refill()
+            entry = self._enqueue(started, self.tokens.cost(tokens), priority)
+            if entry is None:
+                return
+            self._wakers.append(waker)
+        try:
+            while True:
+                with self._changed:
+                    admitted, timeout = self._try_admit(entry, started)
+                    if admitted:
+                        return
+                    woken.clear()
+                try:
+                    await asyncio.wait_for(woken.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._changed:
+                self._leave(entry)
+            raise
+        finally:
+            with self._changed:
+                self._wakers.remove(waker)
+                self._notify()
+
+    def throttle(self, seconds: float):
+        with self._changed:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.throttled += 1
+
+    def stats(self) -> dict:
+        with self._changed:
+            self._refill()
+            return {
+                "tokens_per_minute": self.tokens.rate * 60,
+                "requests_per_minute": self.requests.rate * 60,
+                "tokens_available": int(self.tokens.level),
+                "requests_available": int(self.requests.level),
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed": self.shed,
+                "throttled": self.throttled,
+                "waited": self.waited,
+            }
+
+
+DEPLOYMENT_URL = re.compile(r"/deployments/([^/?]+)/")
+
+
+def estimate_tokens(params: Optional[dict]) -> int:
+    if not params:
+        return 1
+    texts = params.get("prompt") or params.get("input") or ""
+    if isinstance(texts, str):
+        texts = [texts]
+    chars = sum(len(t) for t in texts if isinstance(t, str))
+    chars += sum(len(m.get("content") or "") for m in params.get("messages") or [])
+    choices = max(params.get("n") or 1, params.get("best_of") or 1)
+    completion = params.get("max_tokens") or (0 if "input" in params else 16)
+    return chars // 4 + 1 + choices * completion
+
+
+# Quotas of the deployments that have one, calls to other deployments are not scheduled
+class QuotaScheduler:
+    def __init__(self, quotas: List[DeploymentQuota]):
+        self.quotas = {q.deployment: q for q in quotas}
+
+    def quota_for(self, url: str) -> Optional[DeploymentQuota]:
+        m = DEPLOYMENT_URL.search(url)
+        return self.quotas.get(m.group(1)) if m else None
+
+    def stats(self) -> dict:
+        return {name: q.stats() for name, q in self.quotas.items()}
+
+    # Schedules every call made through the OpenAI SDK, including the ones made by LangChain
+    def install(self):
+        import openai.api_requestor
+        import openai.error
+
+        request = openai.api_requestor.APIRequestor.request
+        arequest = openai.api_requestor.APIRequestor.arequest
+        scheduler = self
+
+        def scheduled_request(self, method, url, params=None, *args, **kwargs):
+            quota = scheduler.quota_for(url)
+            if quota is None:
+                return request(self, method, url, params, *args, **kwargs)
+            quota.acquire(estimate_tokens(params), current_priority.get())
+            try:
+                return request(self, method, url, params, *args, **kwargs)
+            except openai.error.RateLimitError as e:
+                quota.throttle(retry_after(e))
+                raise
+
+        async def scheduled_arequest(self, method, url, params=None, *args, **kwargs):
+            quota = scheduler.quota_for(url)
+            if quota is None:
+                return await arequest(self, method, url, params, *args, **kwargs)
+            await quota.aacquire(estimate_tokens(params), current_priority.get())
+            try:
+                return await arequest(self, method, url, params, *args, **kwargs)
+            except openai.error.RateLimitError as e:
+                quota.throttle(retry_after(e))
+                raise
+
+        openai.api_requestor.APIRequestor.request = scheduled_request
+        openai.api_requestor.APIRequestor.arequest = scheduled_arequest
+
+
+def retry_after(e: "openai.error.OpenAIError", default: float = 10) -> float:
+    try:
+        return float((e.headers or {}).get("retry-after") or default)
+    except ValueError:
+        return default
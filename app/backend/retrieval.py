@@ -0,0 +1,268 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Hashable, List, Optional, Tuple
+from text import nonewlines
+from stages import stage
+from passages import PassageSelector
+from upstream import Hedge
+import metrics
+
+# The Search SDK is imported by whoever builds the clients, see app.search_client
+if TYPE_CHECKING:
+    from azure.search.documents import SearchClient
+    from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+
+def normalize_query(q: str) -> str:
+    return " ".join(q.split()).casefold()
+
+
+def category_filter(overrides: dict) -> Optional[str]:
+    exclude_category = overrides.get("exclude_category") or None
+    return (
+        "category ne '{}'".format(exclude_category.replace("'", "''"))
+        if exclude_category
+        else None
+    )
+
+
+# Bounded LRU cache whose entries also expire after a fixed time-to-live. A single instance is shared by all request
+# threads, so every operation holds the lock only for a dictionary update. Counters are kept for monitoring, and
+# invalidate() drops everything (e.g. after the search index has been refreshed).
+class ResultCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# Single place where the approaches query Cognitive Search. Results are reduced to the fields the approaches use
+# (source page, content and semantic captions) so they can be cached and formatted differently by each approach.
+# The async variants go through async_search_client when one is configured (see asgi.py). With a selector, content is
+# reduced to the passages that best match the query; max_chars then becomes a token budget of about a quarter of it.
+#
+# Searches only return the fields that are used, source page and either content or captions. Results are read one at a
+# time as the client pages through them, and reading stops once max_content_chars of content (or captions) have been
+# collected, that's more than any prompt takes. With a hedge, a search that is slow to answer is sent a second time.
+class Retriever:
+    def __init__(
+        self,
+        search_client: "SearchClient",
+        sourcepage_field: str,
+        content_field: str,
+        cache: Optional[ResultCache] = None,
+        async_search_client: Optional["AsyncSearchClient"] = None,
+        selector: Optional[PassageSelector] = None,
+        max_content_chars: Optional[int] = None,
+        hedge: Optional[Hedge] = None,
+    ):
+        self.search_client = search_client
+        self.async_search_client = async_search_client
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.cache = cache
+        self.selector = selector
+        self.max_content_chars = max_content_chars
+        self.hedge = hedge
+
+    def search(self, q: str, overrides: dict) -> List[dict]:
+        key, kwargs = self._query(q, overrides)
+        if self.cache is not None:
+            docs = self.cache.get(key)
+            if docs is not None:
+                return docs
+
+        with stage("search"):
+            if self.hedge is None:
+                docs = self._fetch(q, kwargs)
+            else:
+                docs = self.hedge.run(lambda: self._fetch(q, kwargs))
+        metrics.record_search(len(docs))
+
+        if self.cache is not None:
+            self.cache.put(key, docs)
+        return docs
+
+    async def asearch(self, q: str, overrides: dict) -> List[dict]:
+        if self.async_search_client is None:
+            return await asyncio.to_thread(self.search, q, overrides)
+
+        key, kwargs = self._query(q, overrides)
+        if self.cache is not None:
+            docs = self.cache.get(key)
+            if docs is not None:
+                return docs
+
+        with stage("search"):
+            if self.hedge is None:
+                docs = await self._afetch(q, kwargs)
+            else:
+                docs = await self.hedge.arun(lambda: self._afetch(q, kwargs))
+        metrics.record_search(len(docs))
+
+        if self.cache is not None:
+            self.cache.put(key, docs)
+        return docs
+
+    def retrieve(
+        self,
+        q: str,
+        overrides: dict,
+        separator: str = ": ",
+        caption_separator: str = " . ",
+        max_chars: Optional[int] = None,
+    ) -> List[str]:
+        docs = self.search(q, overrides)
+        return self.format(q, docs, overrides, separator, caption_separator, max_chars)
+
+    async def aretrieve(
+        self,
+        q: str,
+        overrides: dict,
+        separator: str = ": ",
+        caption_separator: str = " . ",
+        max_chars: Optional[int] = None,
+    ) -> List[str]:
+        docs = await self.asearch(q, overrides)
+        return self.format(q, docs, overrides, separator, caption_separator, max_chars)
+
+    def format(
+        self,
+        q: str,
+        docs: List[dict],
+        overrides: dict,
+        separator: str = ": ",
+        caption_separator: str = " . ",
+        max_chars: Optional[int] = None,
+    ) -> List[str]:
+        if overrides.get("semantic_captions"):
+            return [
+                f"{doc['sourcepage']}{separator}"
+                f"{nonewlines(caption_separator.join(doc['captions']))}"
+                for doc in docs
+            ]
+        return [
+            f"{doc['sourcepage']}{separator}{self.select(q, doc['content'], max_chars)}"
+            for doc in docs
+        ]
+
+    def select(self, q: str, content: str, max_chars: Optional[int] = None) -> str:
+        if self.selector is None:
+            return nonewlines(content[:max_chars])
+        with stage("select"):
+            return nonewlines(
+                self.selector.select(q, content, max_chars // 4 if max_chars else None)
+            )
+
+    def invalidate(self):
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    def _query(self, q: str, overrides: dict) -> Tuple[tuple, dict]:
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        use_semantic_ranker = True if overrides.get("semantic_ranker") else False
+        top = overrides.get("top") or 3
+        filter = category_filter(overrides)
+
+        key = (
+            normalize_query(q),
+            filter,
+            top,
+            use_semantic_ranker,
+            use_semantic_captions,
+        )
+        select = [self.sourcepage_field]
+        if not use_semantic_captions:
+            select.append(self.content_field)
+        if use_semantic_ranker:
+            kwargs = dict(
+                filter=filter,
+                # QueryType.SEMANTIC, without importing the SDK's models
+                query_type="semantic",
+                query_language="de-de",
+                query_speller="lexicon",
+                semantic_configuration_name="default",
+                top=top,
+                query_caption="extractive|highlight-false"
+                if use_semantic_captions
+                else None,
+                select=select,
+            )
+        else:
+            kwargs = dict(filter=filter, top=top, select=select)
+        return key, kwargs
+
+    def _fetch(self, q: str, kwargs: dict) -> List[dict]:
+        docs = []
+        for doc in self.search_client.search(q, **kwargs):
+            if self._collect(docs, doc, kwargs):
+                break
+        return docs
+
+    async def _afetch(self, q: str, kwargs: dict) -> List[dict]:
+        docs = []
+        async for doc in await self.async_search_client.search(q, **kwargs):
+            if self._collect(docs, doc, kwargs):
+                break
+        return docs
+
+    # Adds a search result to docs, returns True when no further results are needed
+    def _collect(self, docs: List[dict], doc: dict, kwargs: dict) -> bool:
+        projected = {
+            "sourcepage": doc[self.sourcepage_field],
+            "content": doc.get(self.content_field) or "",
+            "captions": [c.text for c in doc.get("@search.captions") or []],
+        }
+        docs.append(projected)
+        if len(docs) >= kwargs["top"]:
+            return True
+        if self.max_content_chars is None:
+            return False
+        chars = sum(len(d["content"]) + sum(map(len, d["captions"])) for d in docs)
+        return chars >= self.max_content_chars
@@ -0,0 +1,193 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextvars import copy_context
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+)
+
+
+# Chunks of a streamed response as they are produced, read by any number of request threads. Readers that join late
+# start from the first chunk.
+class ChunkBuffer:
+    def __init__(self):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._changed = threading.Condition()
+
+    def add(self, chunk: dict):
+        with self._changed:
+            self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    def follow(self) -> Iterator[dict]:
+        i = 0
+        while True:
+            with self._changed:
+                while i == len(self.chunks) and not self.done:
+                    self._changed.wait()
+                chunks = self.chunks[i:]
+                done, error = self.done, self.error
+            yield from chunks
+            i += len(chunks)
+            if done and i == len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+# Same as ChunkBuffer for readers on an event loop
+class AsyncChunkBuffer:
+    def __init__(self):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._changed = asyncio.Event()
+
+    def add(self, chunk: dict):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[dict]:
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+# Coalesces identical requests that arrive while one of them is still being answered onto a single execution, whose
+# response (or error) every one of them receives. Responses are shared, callers must not modify them. Nothing is kept
+# once an execution has finished, that's what the caches are for.
+#
+# Streams and async executions run in their own thread or task, so they complete for the remaining requests even if the
+# client that started them goes away. They run in the context of the request that started them, and so within its
+# deadline.
+class SingleFlight:
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self._flights: Dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Hashable, start: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight
+            flight = self._flights[key] = start()
+            self.executions += 1
+            return flight
+
+    def _leave(self, key: Hashable):
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def run(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        started = []
+
+        def start() -> Future:
+            started.append(True)
+            return Future()
+
+        future = self._join(("run", key), start)
+        if started:
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._leave(("run", key))
+        return future.result()
+
+    async def arun(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        def start() -> asyncio.Future:
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._leave(("arun", key)))
+            return task
+
+        return await asyncio.shield(self._join(("arun", key), start))
+
+    def stream(
+        self, key: Hashable, func: Callable[[], Iterator[dict]]
+    ) -> Iterator[dict]:
+        def produce(buffer: ChunkBuffer):
+            try:
+                for chunk in func():
+                    buffer.add(chunk)
+            except Exception as e:
+                self._leave(("stream", key))
+                buffer.finish(e)
+            else:
+                self._leave(("stream", key))
+                buffer.finish()
+
+        def start() -> ChunkBuffer:
+            buffer = ChunkBuffer()
+            threading.Thread(
+                target=copy_context().run, args=(produce, buffer), daemon=True
+            ).start()
+            return buffer
+
+        return self._join(("stream", key), start).follow()
+
+    def astream(
+        self, key: Hashable, func: Callable[[], AsyncIterator[dict]]
+    ) -> AsyncIterator[dict]:
+        async def produce(buffer: AsyncChunkBuffer):
+            try:
+                async for chunk in func():
+                    buffer.add(chunk)
+            except Exception as e:
+                self._leave(("astream", key))
+                buffer.finish(e)
+            else:
+                self._leave(("astream", key))
+                buffer.finish()
+
+        def start() -> AsyncChunkBuffer:
+            buffer = AsyncChunkBuffer()
+            # The event loop only keeps a weak reference to the task
+            buffer.task = asyncio.ensure_future(produce(buffer))
+            return buffer
+
+        return self._join(("astream", key), start).follow()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,47 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import deadlines
+
+# Observers are called with the name and duration in seconds of every pipeline stage (embed, search, query_rewrite,
+# completion, agent and the agent's agent_llm and agent_tool steps), e.g. by the benchmark to break down request
+# latency. Without observers timing a stage costs next to nothing. No stage starts once the request's deadline has passed.
+Observer = Callable[[str, float], None]
+observers: List[Observer] = []
+
+# While the profiler is running (see profiler.py), the stages each thread is in as (tag, name), for requests that have
+# a profiling tag. Tasks of the ASGI app share their thread, so entries are removed by identity rather than popped.
+profiling: Optional[Dict[int, List[Tuple[str, str]]]] = None
+current_tag: ContextVar[Optional[str]] = ContextVar("current_tag", default=None)
+
+
+def observe(name: str, seconds: float):
+    for observer in observers:
+        observer(name, seconds)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    deadlines.check()
+    stacks, entry = profiling, None
+    if stacks is not None and current_tag.get() is not None:
+        entry = (current_tag.get(), name)
+        stack = stacks.setdefault(threading.get_ident(), [])
+        stack.append(entry)
+    try:
+        if not observers:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            observe(name, time.perf_counter() - start)
+    finally:
+        if entry is not None:
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i] is entry:
+                    del stack[i]
+                    break
@@ -0,0 +1,143 @@
+import builtins
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# Times the first import of every module while installed, to see what startup is spent on. A module's total time
+# includes the modules it imports in turn, its self time doesn't. Only installed while the owner module (app.py) is
+# being imported, later imports (e.g. of approaches loaded on first use, see LazyApproaches) aren't timed. If importing
+# the owner fails, Python drops it from sys.modules and the timer uninstalls itself on the next import.
+class ImportTimer:
+    def __init__(self):
+        self.modules: Dict[str, List[float]] = {}
+        self._import = None
+        self._owner = None
+        self._local = threading.local()
+
+    def install(self, owner: str):
+        self._owner = owner
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            if builtins.__import__ == self._timed_import:
+                builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._import or builtins.__import__
+        if self._owner not in sys.modules:
+            self.uninstall()
+        if self._import is None:
+            return original(name, globals, locals, fromlist, level)
+        if level or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # Time spent in nested imports, subtracted from the self time of this one
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += total
+            if name in sys.modules:
+                self.modules.setdefault(name, [total, total - nested])
+
+    # Self time summed by top-level package, e.g. everything under langchain
+    def by_package(self) -> Dict[str, float]:
+        packages: Dict[str, float] = {}
+        for name, (_, self_time) in self.modules.items():
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0.0) + self_time
+        return dict(sorted(packages.items(), key=lambda p: -p[1]))
+
+    def slowest(self, n: int = 20) -> List[Tuple[str, float, float]]:
+        ranked = sorted(self.modules.items(), key=lambda m: -m[1][0])
+        return [(name, total, self_time) for name, (total, self_time) in ranked[:n]]
+
+
+# Time from the start of the import of app.py to each mark, e.g. imports, clients, approaches and ready
+class StartupReport:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self._last = self.started
+        self.imports = ImportTimer()
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self) -> dict:
+        return {
+            "seconds": self._last - self.started,
+            "phases": dict(self.phases),
+            "packages": self.imports.by_package(),
+            "modules": [
+                {"module": name, "seconds": total, "self_seconds": self_time}
+                for name, total, self_time in self.imports.slowest()
+            ],
+        }
+
+    def log(self):
+        phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases)
+        packages = ", ".join(
+            f"{name} {seconds:.2f}s"
+            for name, seconds in list(self.imports.by_package().items())[:5]
+        )
+        logging.info(
+            "Started in %.2fs (%s), slowest imports: %s",
+            self._last - self.started,
+            phases,
+            packages,
+        )
+
+
+# Runs named steps that prepare the process for its first requests (loading approaches, building prompts, opening
+# connections) on a background thread, ready is set once all of them have run. A step that fails is logged and
+# reported, it doesn't keep the process from becoming ready, the first request that needs it will do the work (and
+# report the error) again.
+class WarmUp:
+    def __init__(self, steps: List[Tuple[str, Callable[[], None]]]):
+        self.steps = steps
+        self.ready = threading.Event()
+        self.seconds: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        try:
+            for name, step in self.steps:
+                start = time.perf_counter()
+                try:
+                    step()
+                except Exception as e:
+                    logging.warning("Warm-up step %s failed: %s", name, e)
+                    self.errors[name] = str(e)
+                self.seconds[name] = time.perf_counter() - start
+        finally:
+            self.ready.set()
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready.is_set(),
+            "seconds": dict(self.seconds),
+            "errors": dict(self.errors),
+        }
+
+
+report = StartupReport()
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+# The backend modules import each other as top-level modules, the way app.py is run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# app.py configured to run without Azure: a local search index and content directory and an OpenAI key
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    from localsearch import LocalSearchClient
+
+    root = tmp_path_factory.mktemp("app")
+    LocalSearchClient.build(
+        [
+            {
+                "id": "1",
+                "content": "Zahnbehandlungen sind abgedeckt",
+                "sourcepage": "plan.pdf",
+            }
+        ]
+    ).save(str(root / "index"))
+    os.environ.update(
+        LOCAL_SEARCH_INDEX=str(root / "index"),
+        LOCAL_CONTENT_DIR=str(root),
+        OPENAI_API_KEY="test",
+        ADMIN_TOKEN="sécret",
+    )
+    import app
+
+    return app
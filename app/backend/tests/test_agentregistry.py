@@ -0,0 +1,59 @@
+import openai
+from agentregistry import AgentRegistry
+from langchainadapters import handling, request_callback_manager
+
+
+def test_objects_are_built_once_per_key():
+    registry = AgentRegistry()
+    built = []
+
+    def build(name):
+        built.append(name)
+        return object()
+
+    first = registry.get(("agent", "a"), lambda: build("a"))
+    assert registry.get(("agent", "a"), lambda: build("a")) is first
+    assert registry.get(("agent", "b"), lambda: build("b")) is not first
+    assert built == ["a", "b"]
+
+
+def test_least_recently_used_objects_are_dropped():
+    registry = AgentRegistry(max_entries=2)
+    a = registry.get("a", object)
+    registry.get("b", object)
+    registry.get("a", object)
+    registry.get("c", object)
+    assert registry.get("a", object) is a
+    assert registry.get("b", lambda: None) is None
+
+
+def test_llms_are_shared_per_deployment_and_temperature(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "key")
+    registry = AgentRegistry()
+    llm = registry.llm("davinci", 0.3)
+    assert registry.llm("davinci", 0.3) is llm
+    assert registry.llm("davinci", 0.0) is not llm
+    assert registry.llm("chat", 0.3) is not llm
+    assert llm.deployment_name == "davinci"
+    assert llm.temperature == 0.3
+
+
+class Recorder:
+    def __init__(self):
+        self.prompts = []
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.prompts += prompts
+
+
+def test_shared_llms_call_back_the_handler_of_the_current_request(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "key")
+    llm = AgentRegistry().llm("davinci", 0.3)
+    assert llm.callback_manager is request_callback_manager
+    first, second = Recorder(), Recorder()
+    with handling(first):
+        llm.callback_manager.on_llm_start({}, ["first request"])
+    with handling(second):
+        llm.callback_manager.on_llm_start({}, ["second request"])
+    assert first.prompts == ["first request"]
+    assert second.prompts == ["second request"]
@@ -0,0 +1,69 @@
+import numpy as np
+from answercache import HashingEmbedder, SemanticAnswerCache
+
+
+def cache(threshold: float = 0.95, max_entries: int = 10) -> SemanticAnswerCache:
+    return SemanticAnswerCache(HashingEmbedder(), threshold, max_entries)
+
+
+def test_similar_questions_above_the_threshold_hit():
+    c = cache(threshold=0.8)
+    c.put(c.embed("What is included in my health plan?"), "ask", {"answer": "a"})
+    assert c.get(c.embed("what is included in my health plan"), "ask") == {
+        "answer": "a"
+    }
+    assert c.get(c.embed("How do I file an expense report?"), "ask") is None
+    assert (c.hits, c.misses) == (1, 1)
+
+
+def test_less_similar_questions_miss_under_a_stricter_threshold():
+    question, paraphrase = (
+        "What is included in my health plan?",
+        "What does my plan include?",
+    )
+    for threshold, expected in [(0.3, {"answer": "a"}), (0.95, None)]:
+        c = cache(threshold)
+        c.put(c.embed(question), "ask", {"answer": "a"})
+        assert c.get(c.embed(paraphrase), "ask") == expected
+
+
+def test_entries_only_match_within_their_scope():
+    c = cache()
+    vector = c.embed("What is included in my health plan?")
+    c.put(vector, 'rtr:{"top": 3}', {"answer": "three"})
+    c.put(vector, 'rtr:{"top": 5}', {"answer": "five"})
+    assert c.get(vector, 'rtr:{"top": 5}') == {"answer": "five"}
+    assert c.get(vector, 'rtr:{"top": 3}') == {"answer": "three"}
+    assert c.get(vector, 'rrr:{"top": 3}') is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    c = cache(max_entries=3)
+    vectors = c.embed_many(["alpha", "bravo", "charlie", "delta"])
+    for i, vector in enumerate(vectors[:3]):
+        c.put(vector, "ask", {"answer": i})
+    assert c.get(vectors[0], "ask") == {"answer": 0}
+    c.put(vectors[3], "ask", {"answer": 3})
+    assert c.get(vectors[1], "ask") is None
+    assert c.get(vectors[0], "ask") == {"answer": 0}
+    assert c.get(vectors[3], "ask") == {"answer": 3}
+    assert c.stats()["size"] == 3
+    assert c.evictions == 1
+
+
+def test_invalidate_drops_every_entry():
+    c = cache()
+    vector = c.embed("What is included in my health plan?")
+    c.put(vector, "ask", {"answer": "a"})
+    c.invalidate()
+    assert c.get(vector, "ask") is None
+    assert c.stats()["size"] == 0
+    c.put(vector, "ask", {"answer": "b"})
+    assert c.get(vector, "ask") == {"answer": "b"}
+
+
+def test_embeddings_are_normalized():
+    c = cache()
+    vectors = c.embed_many(["What is included in my health plan?", ""])
+    assert np.isclose(np.linalg.norm(vectors[0]), 1)
+    assert not vectors[1].any()
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+
+
+def test_admin_tokens_with_non_ascii_characters(app_module):
+    assert app_module.is_admin({"Authorization": "Bearer sécret"})
+    assert not app_module.is_admin({"Authorization": "Bearer sécrét"})
+    assert app_module.profile_requested({"X-Profile": "sécret"})
+    assert not app_module.profile_requested({"X-Profile": "nö"})
+    assert not app_module.profile_requested({})
+
+
+HEAVY_MODULES = [
+    "openai",
+    "azure.identity",
+    "azure.search.documents",
+    "azure.storage.blob",
+    "numpy",
+    "tiktoken",
+    "langchain",
+    "approaches.chatreadretrieveread",
+]
+
+
+# In a fresh interpreter, other tests may have imported them already
+def test_heavy_modules_are_imported_on_first_use(app_module):
+    code = (
+        "import sys, app; "
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules]); "
+        "app.ask_approaches['rrr']; app.chat_approaches['rrr']; "
+        "print(sorted(m for m in ('langchain', 'openai', 'approaches.chatreadretrieveread') "
+        "if m in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.splitlines()
+    assert out == [
+        "[]",
+        "['approaches.chatreadretrieveread', 'langchain', 'openai']",
+    ]
+
+
+def test_a_failed_import_leaves_the_import_timer_uninstalled(app_module):
+    code = (
+        "import builtins, sys; original = builtins.__import__\n"
+        "try:\n"
+        "    import app\n"
+        "except ValueError:\n"
+        "    pass\n"
+        "import json\n"
+        "print(builtins.__import__ is original)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env={**os.environ, "SEARCH_CACHE_SIZE": "not a number"},
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    assert out == ["True"]
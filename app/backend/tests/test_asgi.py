@@ -0,0 +1,40 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import openai
+
+
+class SlowCredential:
+    def get_token(self, scope):
+        time.sleep(0.2)
+        return SimpleNamespace(token="token", expires_on=int(time.time()) + 3600)
+
+
+def test_token_refreshes_leave_the_event_loop_serving(app_module, monkeypatch):
+    import asgi
+
+    app_module.configure_openai()
+    monkeypatch.setattr(app_module, "OPENAI_API_KEY", None)
+    monkeypatch.setattr(openai, "api_type", "azure_ad")
+    monkeypatch.setattr(openai, "api_key", openai.api_key)
+    monkeypatch.setattr(app_module, "azure_credential", SlowCredential())
+    monkeypatch.setattr(app_module, "openai_token", None)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        await asyncio.sleep(0)
+        await asgi.aensure_openai_token()
+        ticker.cancel()
+        return ticks
+
+    assert asyncio.run(run()) >= 5
+    assert openai.api_key == "token"
+    assert not app_module.openai_token_stale()
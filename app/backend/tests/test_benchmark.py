@@ -0,0 +1,38 @@
+from benchmark import regressions, summarize
+
+
+def scenario(latencies: list, errors: int = 0, stages: dict = None) -> dict:
+    return {
+        "scenarios": {
+            "ask:rtr": {
+                "errors": errors,
+                "latency": summarize(latencies, 1.0),
+                "stages": {
+                    name: summarize(values, 1.0)
+                    for name, values in (stages or {}).items()
+                },
+            }
+        }
+    }
+
+
+BASELINE = scenario([0.5] * 20, stages={"search": [0.1] * 20, "completion": [0.3] * 20})
+
+
+def test_equal_runs_pass():
+    assert regressions(BASELINE, BASELINE, 0.1) == []
+
+
+def test_slower_p95_latencies_fail():
+    run = scenario([0.6] * 20, stages={"search": [0.1] * 20, "completion": [0.3] * 20})
+    assert regressions(run, BASELINE, 0.1) == [
+        "ask:rtr request: p95 600.0ms, baseline 500.0ms"
+    ]
+
+
+def test_runs_with_more_errors_fail_even_when_fast():
+    run = scenario([], errors=20, stages={"search": [0.001] * 20})
+    assert regressions(run, BASELINE, 0.1) == [
+        "ask:rtr: 20 errors, baseline 0",
+        "ask:rtr completion: didn't run, baseline n=20",
+    ]
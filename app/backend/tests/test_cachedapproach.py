@@ -0,0 +1,55 @@
+import asyncio
+from typing import List
+import stages
+from answercache import HashingEmbedder, SemanticAnswerCache
+from approaches.approach import Approach
+from approaches.cachedapproach import CachedApproach
+
+
+class Echo(Approach):
+    def run(self, q: str, overrides: dict) -> dict:
+        return {"answer": q}
+
+
+class ChunkedEmbedder(HashingEmbedder):
+    def __init__(self, failing: str = None):
+        super().__init__()
+        self.calls: List[int] = []
+        self.failing = failing
+
+    def __call__(self, texts):
+        self.calls.append(len(texts))
+        if self.failing in texts:
+            raise RuntimeError("embedding failed")
+        return super().__call__(texts)
+
+
+def test_batch_is_embedded_in_chunks():
+    embedder = ChunkedEmbedder()
+    approach = CachedApproach("rtr", Echo(), SemanticAnswerCache(embedder))
+    questions = [f"question {i}" for i in range(40)]
+    responses = list(approach.run_batch(questions, {}))
+    assert [r["answer"] for r in responses] == questions
+    assert embedder.calls == [16, 16, 8]
+
+
+def test_questions_whose_embedding_failed_bypass_the_cache():
+    embedder = ChunkedEmbedder(failing="question 20")
+    cache = SemanticAnswerCache(embedder)
+    approach = CachedApproach("rtr", Echo(), cache)
+    questions = [f"question {i}" for i in range(40)]
+    responses = list(approach.run_batch(questions, {}))
+    assert [r["answer"] for r in responses] == questions
+    assert approach.run("question 0", {}) == {"answer": "question 0"}
+    assert cache.hits == 1
+
+
+def test_embeddings_are_timed_as_a_stage(monkeypatch):
+    timed = []
+    monkeypatch.setattr(stages, "observers", [lambda name, _: timed.append(name)])
+    approach = CachedApproach("rtr", Echo(), SemanticAnswerCache(HashingEmbedder()))
+    approach.run("question", {})
+    asyncio.run(approach.arun("question", {}))
+    list(approach.run_stream("question", {}))
+    list(approach.run_batch(["question", "other question"], {}))
+    assert timed == ["embed"] * 4
@@ -0,0 +1,153 @@
+import threading
+import time
+from types import SimpleNamespace
+import openai
+import pytest
+import deadlines
+from approaches.chatreadretrieveread import (
+    ChatReadRetrieveReadApproach,
+    speculative_executor,
+)
+from tokenbudget import PromptBudget
+
+
+# Four characters per token, without loading a tokenizer
+class CharCounter:
+    def count(self, text: str) -> int:
+        return len(text) // 4 + 1
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return text[: max_tokens * 4]
+
+
+class FakeRetriever:
+    def __init__(self):
+        self.queries = []
+
+    def retrieve(self, q, overrides):
+        self.queries.append(q)
+        return [f"results for {q}"]
+
+
+def rewriting_to(monkeypatch, rewritten: str):
+    monkeypatch.setattr(
+        openai.Completion,
+        "create",
+        lambda **kwargs: SimpleNamespace(choices=[SimpleNamespace(text=rewritten)]),
+    )
+
+
+def approach(retriever, **kwargs) -> ChatReadRetrieveReadApproach:
+    return ChatReadRetrieveReadApproach(
+        None,
+        "chat",
+        "davinci",
+        "sourcepage",
+        "content",
+        retriever,
+        PromptBudget(CharCounter()),
+        **kwargs,
+    )
+
+
+HISTORY = [{"user": "dental plan", "bot": "..."}, {"user": "what does it cover"}]
+
+
+def test_speculative_results_are_reported_with_the_query_searched(monkeypatch):
+    rewriting_to(monkeypatch, "what does the dental plan cover")
+    retriever = FakeRetriever()
+    # Shares 3 of 7 words
+    chat = approach(retriever, speculative_overlap=0.4)
+    q, results = chat.rewrite_and_retrieve(HISTORY, {})
+    assert (q, results) == ("what does it cover", ["results for what does it cover"])
+    assert chat.rewrites["speculative_used"] == 1
+
+
+def test_discarded_speculative_results_are_replaced(monkeypatch):
+    rewriting_to(monkeypatch, "dental coverage")
+    retriever = FakeRetriever()
+    chat = approach(retriever, speculative_overlap=0.5)
+    q, results = chat.rewrite_and_retrieve(HISTORY, {})
+    assert (q, results) == ("dental coverage", ["results for dental coverage"])
+    assert chat.rewrites["speculative_discarded"] == 1
+
+
+class SlowRetriever(FakeRetriever):
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.outcomes = []
+
+    def retrieve(self, q, overrides):
+        if q == "what does it cover":
+            self.started.set()
+            self.release.wait(5)
+            try:
+                # Where the search would make its next upstream call
+                deadlines.check()
+                self.outcomes.append("searched")
+            except deadlines.Cancelled:
+                self.outcomes.append("cancelled")
+                raise
+        return super().retrieve(q, overrides)
+
+
+def test_discarded_speculative_searches_are_cancelled(monkeypatch):
+    retriever = SlowRetriever()
+
+    def create(**kwargs):
+        # The speculative search is under way by the time the query has been rewritten
+        assert retriever.started.wait(5)
+        return SimpleNamespace(choices=[SimpleNamespace(text="dental coverage")])
+
+    monkeypatch.setattr(openai.Completion, "create", create)
+    chat = approach(retriever, speculative_overlap=0.5)
+    assert chat.rewrite_and_retrieve(HISTORY, {})[0] == "dental coverage"
+    retriever.release.set()
+    for _ in range(500):
+        if retriever.outcomes:
+            break
+        time.sleep(0.01)
+    assert retriever.outcomes == ["cancelled"]
+
+
+def test_discarded_speculative_searches_give_up_their_slot(monkeypatch):
+    rewriting_to(monkeypatch, "dental coverage")
+    retriever = FakeRetriever()
+    chat = approach(retriever, speculative_overlap=0.5)
+    blockers = threading.Event()
+    busy = [
+        speculative_executor.submit(blockers.wait, 5)
+        for _ in range(speculative_executor._max_workers)
+    ]
+    try:
+        chat.rewrite_and_retrieve(HISTORY, {})
+    finally:
+        blockers.set()
+        for future in busy:
+            future.result()
+    speculative_executor.submit(lambda: None).result()
+    assert retriever.queries == ["dental coverage"]
+
+
+def test_first_questions_are_rewritten_unless_skipping_is_asked_for(monkeypatch):
+    rewriting_to(monkeypatch, "dental plan coverage")
+    retriever = FakeRetriever()
+    first = [{"user": "que cubre el plan dental"}]
+    chat = approach(retriever)
+    assert chat.rewrite_and_retrieve(first, {})[0] == "dental plan coverage"
+    skipping = approach(retriever, rewrite_first_turn=False)
+    assert skipping.rewrite_and_retrieve(first, {})[0] == "que cubre el plan dental"
+    assert (chat.rewrites["completed"], skipping.rewrites["skipped"]) == (1, 1)
+
+
+def test_failed_rewrites_are_not_counted_as_completed(monkeypatch):
+    def create(**kwargs):
+        raise openai.error.Timeout("timed out")
+
+    monkeypatch.setattr(openai.Completion, "create", create)
+    chat = approach(FakeRetriever())
+    with pytest.raises(openai.error.Timeout):
+        chat.rewrite_and_retrieve(HISTORY, {})
+    assert chat.rewrites["completed"] == 0
@@ -0,0 +1,101 @@
+import pytest
+from contentstore import (
+    ContentNotFound,
+    ContentStore,
+    DiskCache,
+    LocalContentSource,
+    content_disposition,
+)
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def store(tmp_path) -> ContentStore:
+    (tmp_path / "files").mkdir()
+    (tmp_path / "files" / "plan.pdf").write_bytes(DATA)
+    return ContentStore(
+        LocalContentSource(str(tmp_path / "files"), chunk_size=100),
+        DiskCache(str(tmp_path / "cache"), max_bytes=1 << 20),
+        chunk_size=100,
+    )
+
+
+def get(store: ContentStore, **headers):
+    status, response_headers, body = store.respond(
+        "plan.pdf", {k.replace("_", "-"): v for k, v in headers.items()}
+    )
+    return status, response_headers, b"".join(body)
+
+
+def test_whole_files_are_served_with_their_etag(store):
+    status, headers, body = get(store)
+    assert (status, body) == (200, DATA)
+    assert headers["Content-Type"] == "application/pdf"
+    assert headers["Content-Length"] == str(len(DATA))
+    assert headers["ETag"].startswith('"')
+
+
+def test_matching_etags_are_answered_with_not_modified(store):
+    etag = get(store)[1]["ETag"]
+    assert get(store, If_None_Match=etag)[0::2] == (304, b"")
+    assert get(store, If_None_Match=f'"other", {etag}')[0] == 304
+    assert get(store, If_None_Match='"other"')[0] == 200
+
+
+def test_ranges_are_served_in_part(store):
+    status, headers, body = get(store, Range="bytes=100-349")
+    assert (status, body) == (206, DATA[100:350])
+    assert headers["Content-Range"] == f"bytes 100-349/{len(DATA)}"
+    assert headers["Content-Length"] == "250"
+    assert get(store, Range="bytes=-10")[2] == DATA[-10:]
+    assert get(store, Range="bytes=1000-")[2] == DATA[1000:]
+
+
+def test_ranges_beyond_the_end_are_not_satisfiable(store):
+    status, headers, body = get(store, Range=f"bytes={len(DATA)}-")
+    assert (status, body) == (416, b"")
+    assert headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+def test_multiple_ranges_are_served_whole(store):
+    status, headers, body = get(store, Range="bytes=0-9, 20-29")
+    assert (status, body) == (200, DATA)
+    assert "Content-Range" not in headers
+    assert get(store, Range=f"bytes=0-9, {len(DATA)}-")[0::2] == (200, DATA)
+
+
+def test_ranges_of_changed_files_are_served_whole(store):
+    etag = get(store)[1]["ETag"]
+    assert get(store, Range="bytes=0-9", If_Range=etag)[0] == 206
+    assert get(store, Range="bytes=0-9", If_Range='"old"')[0::2] == (200, DATA)
+
+
+def test_files_are_read_from_the_cache_once_downloaded(store):
+    get(store)
+    get(store, Range="bytes=10-19")
+    stats = store.stats()
+    assert stats["files"]["files"] == 1
+    assert (stats["files"]["misses"], stats["files"]["hits"]) == (1, 2)
+    assert stats["infos"]["hits"] == 1
+
+
+def test_missing_files_are_not_found(store):
+    with pytest.raises(ContentNotFound):
+        store.respond("missing.pdf", {})
+    with pytest.raises(ContentNotFound):
+        store.respond("../files/plan.pdf", {})
+
+
+def test_file_names_are_quoted():
+    assert content_disposition("plan.pdf") == 'inline; filename="plan.pdf"'
+    assert (
+        content_disposition('benefits "2023", v2.pdf')
+        == 'inline; filename="benefits \\"2023\\", v2.pdf"'
+    )
+
+
+def test_non_ascii_file_names_are_encoded():
+    assert content_disposition("Résumé.pdf") == (
+        "inline; filename=\"Resume.pdf\"; filename*=UTF-8''R%C3%A9sum%C3%A9.pdf"
+    )
@@ -0,0 +1,42 @@
+import threading
+import time
+import pytest
+from approaches.approach import Approach
+from approaches.lazyapproaches import ApproachLoadError, LazyApproaches
+
+
+def test_approaches_are_built_once_on_first_use():
+    built = []
+    approaches = LazyApproaches({"a": lambda: built.append("a") or Approach()})
+    assert built == []
+    assert approaches["a"] is approaches["a"]
+    assert built == ["a"]
+    assert approaches.get("b") is None
+
+
+def test_a_slow_approach_does_not_block_the_others():
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return Approach()
+
+    approaches = LazyApproaches({"slow": slow, "fast": Approach})
+    loading = threading.Thread(target=lambda: approaches["slow"])
+    loading.start()
+    try:
+        start = time.perf_counter()
+        approaches["fast"]
+        assert time.perf_counter() - start < 1
+    finally:
+        release.set()
+        loading.join()
+
+
+def test_factory_errors_are_not_unknown_approaches():
+    def broken():
+        return {}["missing"]
+
+    approaches = LazyApproaches({"broken": broken}).wrapped(lambda name, impl: impl)
+    with pytest.raises(ApproachLoadError):
+        approaches.get("broken")
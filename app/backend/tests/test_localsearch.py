@@ -0,0 +1,79 @@
+import pytest
+from localsearch import LocalSearchClient
+
+DOCS = [
+    {
+        "id": "1",
+        "category": "benefits",
+        "sourcepage": "plan.pdf#page=1",
+        "content": "The dental plan covers cleanings. Vision is extra.",
+    },
+    {
+        "id": "2",
+        "category": "handbook",
+        "sourcepage": "handbook.pdf#page=4",
+        "content": "Dental emergencies are reported to your manager.",
+    },
+    {
+        "id": "3",
+        "category": "o'brien",
+        "sourcepage": "notes.pdf#page=2",
+        "content": "Dental notes.",
+    },
+]
+
+
+@pytest.fixture(scope="module")
+def client() -> LocalSearchClient:
+    return LocalSearchClient.build(DOCS)
+
+
+def ids(results) -> list:
+    return sorted(doc["id"] for doc in results)
+
+
+def test_eq_filters_keep_only_matching_documents(client):
+    assert ids(client.search("dental", filter="category eq 'benefits'")) == ["1"]
+
+
+def test_ne_filters_exclude_matching_documents(client):
+    assert ids(client.search("dental", filter="category ne 'benefits'")) == ["2", "3"]
+
+
+def test_quotes_in_filter_values_are_doubled(client):
+    assert ids(client.search("dental", filter="category eq 'o''brien'")) == ["3"]
+
+
+def test_filters_apply_to_searches_for_everything(client):
+    results = client.search(
+        "*", filter="category ne 'handbook'", include_total_count=True
+    )
+    assert ids(results) == ["1", "3"]
+    assert results.get_count() == 2
+
+
+def test_filters_are_combined_with_the_query(client):
+    assert ids(client.search("vision", filter="category eq 'handbook'")) == []
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        "category eq benefits",
+        "category gt 'benefits'",
+        "missing eq 'x'",
+        "category eq 'a' and id eq '1'",
+    ],
+)
+def test_unsupported_filters_are_refused(client, filter):
+    with pytest.raises(ValueError):
+        client.search("dental", filter=filter)
+
+
+def test_filtered_results_survive_saving_and_loading(client, tmp_path):
+    client.save(str(tmp_path / "index.json.gz"))
+    loaded = LocalSearchClient.load(str(tmp_path / "index.json.gz"))
+    results = loaded.search(
+        "dental", filter="category eq 'benefits'", select=["sourcepage"]
+    )
+    assert [doc["sourcepage"] for doc in results] == ["plan.pdf#page=1"]
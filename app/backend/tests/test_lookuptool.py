@@ -0,0 +1,66 @@
+import os
+from lookuptool import CsvLookupStore
+
+
+def write(filename, text: str, mode: str = "w"):
+    with open(filename, mode, encoding="utf-8", newline="") as f:
+        f.write(text)
+    # Every write is a change, even within the file system's timestamp resolution
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def store(filename) -> CsvLookupStore:
+    return CsvLookupStore(str(filename), "name", check_interval=0)
+
+
+def test_the_last_row_is_read_without_a_trailing_newline(tmp_path):
+    filename = tmp_path / "people.csv"
+    write(filename, "name,title\nalice,eng\nbob,pm")
+    assert store(filename).lookup("bob") == "name:bob\ntitle:pm"
+
+
+def test_appended_rows_are_added(tmp_path):
+    filename = tmp_path / "people.csv"
+    write(filename, "name,title\nbob,pm\n")
+    s = store(filename)
+    table = s.table
+    write(filename, "alice,eng\nbob,lead\ncarol,o", "a")
+    assert s.lookup("alice") == "name:alice\ntitle:eng"
+    assert s.lookup("bob") == "name:bob\ntitle:lead"
+    # The line being written is left for the next reload
+    assert s.lookup("carol") == ""
+    assert s.table.rows is table.rows
+    write(filename, "ps\n", "a")
+    assert s.lookup("carol") == "name:carol\ntitle:ops"
+    assert s.table.keys == ["alice", "bob", "carol"]
+
+
+def test_edits_before_the_old_end_reload_the_whole_file(tmp_path):
+    filename = tmp_path / "people.csv"
+    rows = "".join(f"user{i},staff\n" for i in range(100))
+    write(filename, f"name,title\nalice,eng\n{rows}")
+    s = store(filename)
+    # Same length, far from the old end, with a row appended
+    write(filename, f"name,title\nalice,mgr\n{rows}carol,ops\n")
+    assert s.lookup("alice") == "name:alice\ntitle:mgr"
+    assert s.lookup("carol") == "name:carol\ntitle:ops"
+
+
+def test_rows_appended_to_a_last_line_without_newline_reload_the_whole_file(tmp_path):
+    filename = tmp_path / "people.csv"
+    write(filename, "name,title\nbob,p")
+    s = store(filename)
+    write(filename, "m\ncarol,ops\n", "a")
+    assert s.lookup("bob") == "name:bob\ntitle:pm"
+    assert s.table.keys == ["bob", "carol"]
+
+
+def test_a_missing_file_keeps_the_rows_last_loaded(tmp_path):
+    filename = tmp_path / "people.csv"
+    write(filename, "name,title\nbob,pm\n")
+    s = store(filename)
+    os.replace(filename, tmp_path / "old.csv")
+    assert s.lookup("bob") == "name:bob\ntitle:pm"
+    write(filename, "name,title\nbob,lead\n")
+    assert s.lookup("bob") == "name:bob\ntitle:lead"
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import openai.api_requestor
+import openai.error
+import pytest
+import metrics
+from metrics import Registry
+
+
+def run_in_thread(func):
+    t = threading.Thread(target=func)
+    t.start()
+    t.join()
+
+
+def test_shards_of_finished_threads_are_merged_once():
+    registry = Registry()
+    counter = registry.counter("calls", "Calls", ("endpoint",))
+    for _ in range(3):
+        run_in_thread(lambda: counter.inc("ask"))
+    counter.inc("ask", amount=2)
+    assert registry.merged_by_metric()[counter] == {("ask",): [5]}
+    # Folded into the retired shard by the first scrape, not counted again
+    assert registry.merged_by_metric()[counter] == {("ask",): [5]}
+    run_in_thread(lambda: counter.inc("chat"))
+    assert registry.merged_by_metric()[counter] == {("ask",): [5], ("chat",): [1]}
+
+
+def test_gauges_are_summed_over_threads():
+    registry = Registry()
+    gauge = registry.gauge("in_flight", "In flight")
+    gauge.inc()
+    run_in_thread(gauge.dec)
+    assert "in_flight 0" in registry.render().splitlines()
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("latency", "Latency", (), (0.1, 1, 10))
+    for value in (0.05, 0.1, 0.5, 5, 50):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'latency_bucket{le="0.1"} 2',
+        'latency_bucket{le="1.0"} 3',
+        'latency_bucket{le="10.0"} 4',
+        'latency_bucket{le="+Inf"} 5',
+        "latency_sum 55.65",
+        "latency_count 5",
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = registry.counter("errors", "Errors", ("error",))
+    counter.inc('bad "quote"\\\nnext')
+    assert 'errors{error="bad \\"quote\\"\\\\\\nnext"} 1' in registry.render()
+
+
+def test_collectors_are_read_when_rendered():
+    registry = Registry()
+    hits = [3]
+    registry.collect(
+        "cache_hits", "Hits", "counter", ("cache",), lambda: [(("answers",), hits[0])]
+    )
+    hits[0] = 4
+    assert 'cache_hits{cache="answers"} 4' in registry.render()
+
+
+URL = "/openai/deployments/chat/completions"
+
+
+def response(usage=None):
+    return SimpleNamespace(data={"usage": usage} if usage else {}), False, "key"
+
+
+def recorded(labels):
+    merged = metrics.registry.merged_by_metric()
+    return {
+        k: v
+        for metric in (metrics.openai_tokens, metrics.openai_errors)
+        for k, v in merged.get(metric, {}).items()
+        if k[:2] == labels
+    }
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    results = []
+
+    def request(self, method, url, *args, **kwargs):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def arequest(self, method, url, *args, **kwargs):
+        return request(self, method, url)
+
+    monkeypatch.setattr(openai.api_requestor.APIRequestor, "request", request)
+    monkeypatch.setattr(openai.api_requestor.APIRequestor, "arequest", arequest)
+    metrics.install_openai_hooks()
+    return results
+
+
+def test_openai_hooks_record_tokens_and_errors(hooks):
+    labels = ("ask", "test_openai_hooks")
+    hooks += [
+        response({"prompt_tokens": 100, "completion_tokens": 20}),
+        response(),
+        openai.error.RateLimitError("slow down"),
+    ]
+    requestor = openai.api_requestor.APIRequestor(key="key")
+    token = metrics.current_labels.set(labels)
+    try:
+        requestor.request("post", URL)
+        asyncio.run(requestor.arequest("post", URL))
+        with pytest.raises(openai.error.RateLimitError):
+            requestor.request("post", URL)
+    finally:
+        metrics.current_labels.reset(token)
+    series = recorded(labels)
+    assert series[(*labels, "chat", "prompt")][-2:] == [100, 1]
+    assert series[(*labels, "chat", "completion")][-2:] == [20, 1]
+    assert series[(*labels, "chat", "RateLimitError")] == [1]
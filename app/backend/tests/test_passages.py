@@ -0,0 +1,65 @@
+from passages import PassageSelector
+
+
+# One token per word
+class WordCounter:
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return " ".join(text.split()[:max_tokens])
+
+
+SENTENCES = [
+    "The plan covers annual eye exams.",
+    "Dental cleanings are covered twice a year.",
+    "Employees may enroll during open enrollment.",
+    "Hearing aids are not covered by the plan.",
+    "Claims must be filed within ninety days.",
+    "Prescription drugs have a separate deductible.",
+]
+CONTENT = " ".join(SENTENCES)
+
+
+def selector(**kwargs) -> PassageSelector:
+    # Sentences of 6 to 8 words, one passage each
+    return PassageSelector(WordCounter(), passage_tokens=8, **kwargs)
+
+
+def test_content_within_the_budget_is_unchanged():
+    assert selector().select("dental", CONTENT, max_tokens=100) == CONTENT
+
+
+def test_passages_matching_the_query_are_kept_in_document_order():
+    selected = selector().select("are dental cleanings covered", CONTENT, 16)
+    assert selected == "Dental cleanings are covered twice a year. … " + SENTENCES[3]
+
+
+def test_rarer_query_words_weigh_more():
+    # "covered" is in two passages, "deductible" in one
+    selected = selector().select("covered deductible", CONTENT, 7)
+    assert selected == SENTENCES[5]
+
+
+def test_selection_stays_within_the_budget():
+    s = selector()
+    for max_tokens in range(7, 40):
+        selected = s.select("plan covered claims", CONTENT, max_tokens)
+        assert WordCounter().count(selected.replace("…", "")) <= max_tokens
+
+
+def test_leading_passages_are_kept_without_matching_words():
+    selected = selector().select("parking", CONTENT, 15)
+    assert selected == " ".join(SENTENCES[:2])
+
+
+def test_a_passage_larger_than_the_budget_is_truncated():
+    selected = selector().select("deductible", CONTENT, 3)
+    assert selected == "Prescription drugs have"
+
+
+def test_passages_of_a_document_are_split_once():
+    s = selector()
+    s.select("dental", CONTENT, 10)
+    s.select("claims", CONTENT, 10)
+    assert s.passages.cache_info().misses == 1
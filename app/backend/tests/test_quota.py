@@ -0,0 +1,150 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+import pytest
+import deadlines
+from quota import BATCH, DEFAULT, INTERACTIVE, DeploymentQuota, QuotaExceeded
+
+MAX_WAIT = {INTERACTIVE: 5, DEFAULT: 5, BATCH: 5}
+
+
+def quota(requests_per_minute: int = 300, max_wait=MAX_WAIT) -> DeploymentQuota:
+    return DeploymentQuota("chat", 1_000_000, requests_per_minute, max_wait)
+
+
+def waiting(q: DeploymentQuota, n: int):
+    while q.stats()["waiting"] < n:
+        time.sleep(0.005)
+
+
+def test_calls_within_the_quota_are_admitted_right_away():
+    q = quota()
+    assert q.try_acquire(100)
+    q.acquire(100)
+    assert q.stats()["admitted"] == 2
+    assert q.stats()["queued"] == 0
+
+
+def test_waiting_calls_are_admitted_by_priority_then_arrival():
+    # 5 requests a second, the bucket refills one of them every 0.2s
+    q = quota()
+    q.requests.level = 0
+    admitted = []
+
+    def call(name: str, p: int):
+        q.acquire(10, p)
+        admitted.append(name)
+
+    calls = [
+        ("batch", BATCH),
+        ("default", DEFAULT),
+        ("interactive 1", INTERACTIVE),
+        ("interactive 2", INTERACTIVE),
+    ]
+    threads = []
+    for name, p in calls:
+        threads.append(threading.Thread(target=call, args=(name, p)))
+        threads[-1].start()
+        waiting(q, len(threads))
+    for t in threads:
+        t.join(5)
+    assert admitted == ["interactive 1", "interactive 2", "default", "batch"]
+    assert q.stats()["queued"] == 4
+
+
+def test_try_acquire_doesnt_jump_the_queue():
+    q = quota()
+    q.requests.level = 0
+    t = threading.Thread(target=q.acquire, args=(10,))
+    t.start()
+    waiting(q, 1)
+    q.requests.level = q.requests.capacity
+    assert not q.try_acquire(10)
+    t.join(5)
+
+
+def test_calls_that_would_wait_too_long_are_shed():
+    q = quota(requests_per_minute=60, max_wait={INTERACTIVE: 5, BATCH: 0.5})
+    q.requests.level = 0
+    with pytest.raises(QuotaExceeded) as e:
+        q.acquire(10, BATCH)
+    assert 0 < e.value.retry_after <= 1
+    with deadlines.deadline(0.5):
+        with pytest.raises(QuotaExceeded):
+            q.acquire(10, INTERACTIVE)
+    assert q.stats()["shed"] == 2
+
+
+def test_nothing_is_admitted_while_throttled():
+    q = quota(max_wait={DEFAULT: 0})
+    q.throttle(30)
+    assert not q.try_acquire(10)
+    with pytest.raises(QuotaExceeded):
+        q.acquire(10)
+    assert q.stats()["throttled"] == 1
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def test_async_calls_wait_on_the_event_loop():
+    q = quota()
+    q.requests.level = 0
+    executor = RecordingExecutor()
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(executor)
+        await asyncio.gather(*(q.aacquire(10) for _ in range(3)))
+
+    asyncio.run(run())
+    assert q.stats()["admitted"] == 3
+    assert q.stats()["queued"] == 3
+    assert executor.submitted == 0
+
+
+def test_async_and_sync_calls_share_the_line():
+    q = quota()
+    q.requests.level = 0
+    admitted = []
+
+    def call():
+        q.acquire(10, BATCH)
+        admitted.append("sync")
+
+    async def run():
+        t = threading.Thread(target=call)
+        t.start()
+        while q.stats()["waiting"] < 1:
+            await asyncio.sleep(0.005)
+        await q.aacquire(10, INTERACTIVE)
+        admitted.append("async")
+        await asyncio.to_thread(t.join, 5)
+
+    asyncio.run(run())
+    assert admitted == ["async", "sync"]
+
+
+def test_async_calls_leave_the_line_at_the_deadline():
+    q = quota()
+    q.requests.level = 0
+
+    async def call():
+        with deadlines.deadline(0.3):
+            await q.aacquire(10)
+
+    async def throttle():
+        await asyncio.sleep(0.05)
+        q.throttle(30)
+
+    async def run():
+        await asyncio.gather(call(), throttle())
+
+    with pytest.raises(deadlines.DeadlineExceeded):
+        asyncio.run(run())
+    assert q.stats()["waiting"] == 0
@@ -0,0 +1,50 @@
+import threading
+from approaches.approach import RequestContext
+from approaches.readdecomposeask import QUERY_SEPARATOR, ReadDecomposeAsk
+
+
+# Answers each query once all the queries it expects have started, so they only finish if they run concurrently
+class FakeRetriever:
+    def __init__(self, concurrent: int = 1):
+        self.queries = []
+        self.barrier = threading.Barrier(concurrent, timeout=5)
+        self.lock = threading.Lock()
+
+    def retrieve(self, q, overrides, separator=":", max_chars=None):
+        with self.lock:
+            self.queries.append(q)
+        self.barrier.wait()
+        return [f"doc{separator} {q}"]
+
+
+def approach(retriever) -> ReadDecomposeAsk:
+    return ReadDecomposeAsk(None, "davinci", "sourcepage", "content", retriever)
+
+
+def test_combined_searches_run_concurrently():
+    retriever = FakeRetriever(concurrent=2)
+    context = RequestContext({})
+    observation = approach(retriever).search(
+        f"Nicholas Ray {QUERY_SEPARATOR} Elia Kazan", context
+    )
+    assert observation == "doc: Nicholas Ray\ndoc: Elia Kazan"
+    assert sorted(retriever.queries) == ["Elia Kazan", "Nicholas Ray"]
+
+
+def test_queries_answered_earlier_in_the_run_are_reused():
+    retriever = FakeRetriever()
+    rda = approach(retriever)
+    context = RequestContext({})
+    rda.search("Nicholas Ray", context)
+    observation = rda.search(
+        f"nicholas  ray {QUERY_SEPARATOR} Nicholas Ray {QUERY_SEPARATOR} Elia Kazan",
+        context,
+    )
+    assert observation == "doc: Nicholas Ray\ndoc: Nicholas Ray\ndoc: Elia Kazan"
+    assert retriever.queries == ["Nicholas Ray", "Elia Kazan"]
+
+
+def test_single_semicolons_are_part_of_the_query():
+    retriever = FakeRetriever()
+    approach(retriever).search("Arthur's Magazine; 1844", RequestContext({}))
+    assert retriever.queries == ["Arthur's Magazine; 1844"]
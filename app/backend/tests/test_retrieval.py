@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+import retrieval
+from retrieval import ResultCache
+
+
+def clock(monkeypatch) -> SimpleNamespace:
+    now = SimpleNamespace(t=1000.0)
+    monkeypatch.setattr(retrieval, "time", SimpleNamespace(monotonic=lambda: now.t))
+    return now
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    now = clock(monkeypatch)
+    cache = ResultCache(max_entries=10, ttl=60)
+    cache.put("q", ["results"])
+    now.t += 59
+    assert cache.get("q") == ["results"]
+    now.t += 2
+    assert cache.get("q") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    clock(monkeypatch)
+    cache = ResultCache(max_entries=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Using a makes b the least recently used
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_putting_an_entry_again_renews_it(monkeypatch):
+    now = clock(monkeypatch)
+    cache = ResultCache(max_entries=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    now.t += 30
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b")) == (10, None)
+    now.t += 45
+    assert cache.get("a") == 10
+
+
+def test_a_cache_without_entries_keeps_nothing():
+    cache = ResultCache(max_entries=0)
+    cache.put("q", ["results"])
+    assert cache.get("q") is None
+    assert cache.stats()["misses"] == 1
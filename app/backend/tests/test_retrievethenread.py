@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+import openai
+from approaches.retrievethenread import RetrieveThenReadApproach
+from metrics import current_labels
+
+
+class FakeRetriever:
+    def __init__(self):
+        self.labels = []
+
+    def retrieve(self, q, overrides):
+        self.labels.append(current_labels.get())
+        return [f"{q}.pdf: about {q}"]
+
+
+def approach(retriever) -> RetrieveThenReadApproach:
+    return RetrieveThenReadApproach(None, "davinci", "sourcepage", "content", retriever)
+
+
+def test_batch_answers_each_question_with_its_choice(monkeypatch):
+    def create(prompt, **kwargs):
+        # Out of order, and the second prompt's choice was filtered
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(index=2, text="answer c"),
+                SimpleNamespace(index=0, text="answer a"),
+            ]
+        )
+
+    monkeypatch.setattr(openai.Completion, "create", create)
+    responses = list(approach(FakeRetriever()).run_batch(["a", "b", "c"], {}))
+    assert [r.get("answer") for r in responses] == ["answer a", None, "answer c"]
+    assert "error" in responses[1]
+
+
+def test_batch_searches_run_in_the_request_context(monkeypatch):
+    monkeypatch.setattr(
+        openai.Completion,
+        "create",
+        lambda prompt, **kwargs: SimpleNamespace(
+            choices=[SimpleNamespace(index=i, text="") for i in range(len(prompt))]
+        ),
+    )
+    retriever = FakeRetriever()
+    token = current_labels.set(("ask_batch", "rtr"))
+    try:
+        list(approach(retriever).run_batch(["a", "b"], {}))
+    finally:
+        current_labels.reset(token)
+    assert retriever.labels == [("ask_batch", "rtr")] * 2
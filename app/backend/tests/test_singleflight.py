@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+import pytest
+from singleflight import SingleFlight
+
+
+def test_concurrent_runs_share_one_execution():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(True)
+        started.set()
+        release.wait(5)
+        return {"answer": 42}
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(flights.run("q", func)))
+    first.start()
+    assert started.wait(5)
+    others = [
+        threading.Thread(target=lambda: results.append(flights.run("q", func)))
+        for _ in range(3)
+    ]
+    for t in others:
+        t.start()
+    # The others have joined the flight once it counts them
+    while flights.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for t in [first] + others:
+        t.join(5)
+    assert results == [{"answer": 42}] * 4
+    assert len(calls) == 1
+    assert flights.stats() == {"in_flight": 0, "executions": 1, "coalesced": 3}
+
+
+def test_errors_are_shared_and_not_kept():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flights.run("q", fail)
+    assert flights.run("q", lambda: "ok") == "ok"
+    assert flights.stats()["executions"] == 2
+
+
+def test_different_keys_run_separately():
+    flights = SingleFlight()
+    assert flights.run("a", lambda: 1) == 1
+    assert flights.run("b", lambda: 2) == 2
+    assert flights.stats()["coalesced"] == 0
+
+
+def test_streams_are_followed_from_the_start():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def chunks():
+        yield {"n": 1}
+        release.wait(5)
+        yield {"n": 2}
+
+    first = flights.stream("q", chunks)
+    assert next(first) == {"n": 1}
+    second = flights.stream("q", chunks)
+    release.set()
+    assert list(first) == [{"n": 2}]
+    assert list(second) == [{"n": 1}, {"n": 2}]
+    assert flights.stats()["executions"] == 1
+
+
+def test_async_runs_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    async def func():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def run():
+        return await asyncio.gather(*(flights.arun("q", func) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["answer"] * 3
+    assert len(calls) == 1
+    assert flights.stats()["in_flight"] == 0
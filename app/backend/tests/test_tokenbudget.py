@@ -0,0 +1,80 @@
+from tokenbudget import PromptBudget, TokenCounter
+
+
+# One token per character, so no tiktoken encoding has to be downloaded
+class CharEncoding:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text: str, disallowed_special=()):
+        self.encoded.append(text)
+        return [ord(c) for c in text]
+
+    def decode(self, tokens):
+        return "".join(map(chr, tokens))
+
+
+def counter() -> TokenCounter:
+    c = TokenCounter()
+    c._encoding = CharEncoding()
+    return c
+
+
+def test_counts_are_memoized_per_text():
+    c = counter()
+    assert c.count("hello") == 5
+    assert c.count("hello") == 5
+    assert c.count("hello world") == 11
+    assert c.encoding.encoded == ["hello", "hello world"]
+
+
+def test_truncate_keeps_the_first_tokens():
+    c = counter()
+    assert c.truncate("hello world", 5) == "hello"
+    assert c.truncate("hello", 5) == "hello"
+
+
+def test_history_keeps_the_newest_turns_that_fit():
+    budget = PromptBudget(counter())
+    turns = ["aaaa", "bbbb", "cccc"]
+    assert budget.history(turns, 8) == (["bbbb", "cccc"], 8)
+    assert budget.history(turns, 7) == (["cccc"], 4)
+    assert budget.history(turns, 12) == (turns, 12)
+
+
+def test_history_always_keeps_the_newest_turn():
+    budget = PromptBudget(counter())
+    assert budget.history(["aaaa", "bbbbbbbbbb"], 5) == (["bbbbbbbbbb"], 10)
+
+
+def test_sources_are_kept_in_rank_order_and_the_last_one_truncated():
+    budget = PromptBudget(counter())
+    sources = ["first", "second", "third"]
+    # Every source costs one more token for the newline joining it
+    assert budget.sources(sources, 13) == (["first", "second"], 13)
+    assert budget.sources(sources, 16) == (["first", "second", "th"], 16)
+    assert budget.sources(sources, 14) == (["first", "second"], 13)
+    assert budget.sources(sources, 100) == (sources, 19)
+
+
+def test_fit_leaves_room_for_the_completion_and_the_history():
+    budget = PromptBudget(
+        counter(), context_window=100, completion_tokens=40, history_tokens=20
+    )
+    fixed = "x" * 10
+    sources = ["s" * 20, "t" * 20, "u" * 20]
+    turns = ["a" * 10, "b" * 10, "c" * 10]
+    content, history = budget.fit(fixed, sources, turns)
+    # 50 tokens after the completion and fixed prompt, 20 of which the history wants
+    assert content == "s" * 20 + "\n" + "t" * 8
+    assert history == "b" * 10 + "c" * 10
+    assert len(content) + 1 + len(history) + len(fixed) <= 100 - 40
+
+
+def test_fit_gives_the_history_what_the_sources_leave():
+    budget = PromptBudget(
+        counter(), context_window=100, completion_tokens=40, history_tokens=20
+    )
+    content, history = budget.fit("x" * 10, ["s" * 10], ["a" * 10, "b" * 10])
+    assert content == "s" * 10
+    assert history == "a" * 10 + "b" * 10
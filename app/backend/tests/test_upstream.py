@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import requests
+import deadlines
+import upstream
+from upstream import (
+    CircuitBreaker,
+    CircuitBreakers,
+    CircuitOpen,
+    Hedge,
+    UpstreamAdapter,
+    upstream_trace_config,
+)
+
+URL = "https://search.example.net/indexes/docs/search"
+
+
+def adapter(monkeypatch, send) -> UpstreamAdapter:
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, "send", send)
+    return UpstreamAdapter(CircuitBreakers(failure_threshold=2, reset_after=30))
+
+
+def prepared() -> requests.PreparedRequest:
+    return requests.Request("GET", URL).prepare()
+
+
+def state(a: UpstreamAdapter) -> str:
+    return a.breakers.get("search.example.net").stats()["state"]
+
+
+def test_timeouts_shortened_by_the_deadline_leave_the_breaker_closed(monkeypatch):
+    def send(self, request, timeout=None, **kwargs):
+        assert timeout <= 0.05
+        time.sleep(timeout)
+        raise requests.exceptions.ReadTimeout()
+
+    a = adapter(monkeypatch, send)
+    for _ in range(5):
+        with pytest.raises(deadlines.DeadlineExceeded):
+            with deadlines.deadline(0.05):
+                a.send(prepared(), timeout=10)
+    assert state(a) == "closed"
+
+
+def test_errors_after_the_deadline_leave_the_breaker_closed(monkeypatch):
+    def send(self, request, timeout=None, **kwargs):
+        time.sleep(0.02)
+        raise requests.exceptions.ConnectionError()
+
+    a = adapter(monkeypatch, send)
+    for _ in range(5):
+        with pytest.raises(deadlines.DeadlineExceeded):
+            with deadlines.deadline(0.01):
+                a.send(prepared(), timeout=10)
+    assert state(a) == "closed"
+
+
+def test_upstream_timeouts_open_the_breaker(monkeypatch):
+    def send(self, request, timeout=None, **kwargs):
+        raise requests.exceptions.ReadTimeout()
+
+    a = adapter(monkeypatch, send)
+    for _ in range(2):
+        with deadlines.deadline(60):
+            with pytest.raises(requests.exceptions.ReadTimeout):
+                a.send(prepared(), timeout=1)
+    assert state(a) == "open"
+
+
+def test_cancelled_async_calls_leave_the_breaker_closed():
+    breakers = CircuitBreakers(failure_threshold=1)
+    on_request_exception = upstream_trace_config(breakers).on_request_exception[0]
+    params = SimpleNamespace(
+        url=SimpleNamespace(host="search.example.net"),
+        exception=asyncio.CancelledError(),
+    )
+    asyncio.run(on_request_exception(None, None, params))
+    assert breakers.get("search.example.net").stats()["state"] == "closed"
+
+    params.exception = ConnectionResetError()
+    asyncio.run(on_request_exception(None, None, params))
+    assert breakers.get("search.example.net").stats()["state"] == "open"
+
+
+def test_abandoned_calls_leave_the_breaker_closed(monkeypatch):
+    def send(self, request, timeout=None, **kwargs):
+        cancel.set()
+        raise requests.exceptions.ConnectionError()
+
+    a = adapter(monkeypatch, send)
+    for _ in range(5):
+        cancel = threading.Event()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            deadlines.cancellable(cancel, a.send, prepared(), 10)
+    assert state(a) == "closed"
+    with pytest.raises(deadlines.Cancelled):
+        deadlines.cancellable(cancel, a.send, prepared(), 10)
+
+
+def clock(monkeypatch) -> SimpleNamespace:
+    now = SimpleNamespace(t=1000.0)
+    monkeypatch.setattr(upstream, "time", SimpleNamespace(monotonic=lambda: now.t))
+    return now
+
+
+def test_breakers_open_after_consecutive_failures(monkeypatch):
+    clock(monkeypatch)
+    breaker = CircuitBreaker("search", failure_threshold=3, reset_after=30)
+    breaker.record(False)
+    breaker.record(False)
+    # A success in between starts the count again
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.stats()["state"] == "closed"
+    breaker.record(False)
+    assert breaker.stats()["state"] == "open"
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    assert breaker.stats() == {
+        "state": "open",
+        "failures": 3,
+        "opened": 1,
+        "rejected": 1,
+    }
+
+
+def test_a_successful_trial_call_closes_the_breaker(monkeypatch):
+    now = clock(monkeypatch)
+    breaker = CircuitBreaker("search", failure_threshold=1, reset_after=30)
+    breaker.record(False)
+    now.t += 29
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    now.t += 1
+    breaker.before()
+    assert breaker.stats()["state"] == "half-open"
+    # Only one trial call at a time
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    breaker.record(True)
+    assert breaker.stats()["state"] == "closed"
+    breaker.before()
+
+
+def test_a_failed_trial_call_reopens_the_breaker(monkeypatch):
+    now = clock(monkeypatch)
+    breaker = CircuitBreaker("search", failure_threshold=5, reset_after=30)
+    for _ in range(5):
+        breaker.record(False)
+    now.t += 30
+    breaker.before()
+    breaker.record(False)
+    assert breaker.stats()["state"] == "open"
+    assert breaker.stats()["opened"] == 2
+    now.t += 29
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    now.t += 1
+    breaker.before()
+    assert breaker.stats()["state"] == "half-open"
+
+
+def test_hedges_count_from_when_the_first_attempt_starts():
+    hedge = Hedge(after=0.1, max_workers=2)
+    release = threading.Event()
+    busy = [hedge._executor.submit(release.wait, 5) for _ in range(2)]
+
+    def search():
+        time.sleep(0.05)
+        return "results"
+
+    result = []
+    caller = threading.Thread(target=lambda: result.append(hedge.run(search)))
+    caller.start()
+    # Longer than `after`, spent waiting for a worker
+    time.sleep(0.3)
+    release.set()
+    caller.join(5)
+    for future in busy:
+        future.result()
+    assert result == ["results"]
+    assert hedge.stats()["hedged"] == 0
+
+
+def test_slow_attempts_are_hedged():
+    hedge = Hedge(after=0.05, max_workers=2)
+    calls = []
+
+    def search():
+        calls.append(True)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    assert hedge.run(search) == "fast"
+    assert hedge.stats()["hedges_won"] == 1
@@ -0,0 +1,92 @@
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+# Counts tokens with the model's tokenizer. Counts are memoized per text, so chat turns that are sent again with every
+# request of a conversation are only tokenized once. The encoding (and tiktoken) is loaded on first use.
+class TokenCounter:
+    def __init__(self, encoding_name: str = "cl100k_base", cache_size: int = 4096):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._lock = threading.Lock()
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    @property
+    def encoding(self) -> "tiktoken.Encoding":
+        if self._encoding is None:
+            with self._lock:
+                if self._encoding is None:
+                    import tiktoken
+
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def _count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
+
+
+# Splits a model's context window between the fixed part of a prompt, the retrieved sources, the chat history and the
+# completion. The newest chat turn is always kept; older turns get up to history_tokens, and sources whatever is left
+# beyond what the history needs. Sources are kept in rank order, the last one that fits partially is truncated.
+class PromptBudget:
+    def __init__(
+        self,
+        counter: TokenCounter,
+        context_window: int = 4096,
+        completion_tokens: int = 1024,
+        history_tokens: int = 1000,
+    ):
+        self.counter = counter
+        self.context_window = context_window
+        self.completion_tokens = completion_tokens
+        self.history_tokens = history_tokens
+
+    def history(self, turns: List[str], max_tokens: int) -> Tuple[List[str], int]:
+        kept = []
+        used = 0
+        for turn in reversed(turns):
+            tokens = self.counter.count(turn)
+            if kept and used + tokens > max_tokens:
+                break
+            kept.append(turn)
+            used += tokens
+        kept.reverse()
+        return kept, used
+
+    def sources(self, sources: List[str], max_tokens: int) -> Tuple[List[str], int]:
+        kept = []
+        used = 0
+        for source in sources:
+            tokens = self.counter.count(source) + 1  # joined with newlines
+            if used + tokens > max_tokens:
+                remaining = max_tokens - used - 1
+                if remaining > 0:
+                    kept.append(self.counter.truncate(source, remaining))
+                    used += remaining + 1
+                break
+            kept.append(source)
+            used += tokens
+        return kept, used
+
+    def fit(
+        self, fixed_prompt: str, sources: List[str], turns: List[str]
+    ) -> Tuple[str, str]:
+        available = (
+            self.context_window
+            - self.completion_tokens
+            - self.counter.count(fixed_prompt)
+        )
+        _, wanted_history = self.history(turns, self.history_tokens)
+        kept_sources, used = self.sources(sources, max(available - wanted_history, 0))
+        kept_turns, _ = self.history(turns, min(available - used, self.history_tokens))
+        return "\n".join(kept_sources), "".join(kept_turns)
@@ -0,0 +1,37 @@
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional, Union
+
+# A trace is either the rendered thoughts or a function that renders them, so that the work is only done when someone
+# actually asks for it
+Trace = Union[str, Callable[[], str]]
+
+
+# Keeps the "thoughts" of recent responses so clients can fetch them on demand instead of receiving them with every
+# answer. Bounded to max_entries, the oldest traces are dropped first. Traces live in the memory of the process that
+# produced them, so with several worker processes clients need sticky sessions to fetch them.
+class TraceStore:
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Trace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, trace: Trace) -> str:
+        trace_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[trace_id] = trace
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return trace_id
+
+    def get(self, trace_id: str) -> Optional[str]:
+        with self._lock:
+            trace = self._entries.get(trace_id)
+        if trace is None or isinstance(trace, str):
+            return trace
+        rendered = trace()
+        with self._lock:
+            if trace_id in self._entries:
+                self._entries[trace_id] = rendered
+        return rendered
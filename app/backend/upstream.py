@@ -0,0 +1,307 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from contextvars import copy_context
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+from urllib.parse import urlsplit
+import aiohttp
+import requests
+import deadlines
+
+T = TypeVar("T")
+
+# Responses that say the service is overloaded or failing, as opposed to a bad request
+FAILURE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+# Client of an upstream service built by its factory on first use, so that its SDK (or e.g. the local search index) is
+# only loaded once a process calls the service. Everything else is passed on to the client.
+class LazyClient:
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self.factory()
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes the wrapper doesn't have, its own are all set in __init__
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+# Fails calls to an upstream service fast while it is degraded. After failure_threshold consecutive failures (errors,
+# timeouts or failure statuses) the circuit opens and calls are refused for reset_after seconds. Then a single trial
+# call is let through, which closes the circuit again if it succeeds and reopens it if not.
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_after: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.rejected = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def before(self):
+        if self.opened_at is None:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if not self.trial and time.monotonic() >= self.opened_at + self.reset_after:
+                self.trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpen(f"{self.name} is unavailable, try again later")
+
+    def record(self, success: bool):
+        if success and self.failures == 0 and self.opened_at is None:
+            return
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.trial or self.failures >= self.failure_threshold:
+                    if self.opened_at is None or self.trial:
+                        self.opened += 1
+                    self.opened_at = time.monotonic()
+            self.trial = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": "closed"
+                if self.opened_at is None
+                else "half-open"
+                if self.trial
+                else "open",
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+
+# One breaker per upstream host, created on first use
+class CircuitBreakers:
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    host,
+                    CircuitBreaker(host, self.failure_threshold, self.reset_after),
+                )
+        return breaker
+
+    def stats(self) -> dict:
+        return {host: b.stats() for host, b in list(self._breakers.items())}
+
+
+# Failures caused by our own request deadline rather than by the upstream service: anything once the deadline has
+# passed or the call was abandoned (see deadlines.cancellable), and timeouts that the deadline made shorter than the
+# client's own. They don't count against the breaker,
+# otherwise a few impatient requests would cut the service off for everyone.
+def deadline_caused(e: BaseException, shortened: bool = False) -> bool:
+    if isinstance(
+        e,
+        (
+            CircuitOpen,
+            deadlines.DeadlineExceeded,
+            deadlines.Cancelled,
+            asyncio.CancelledError,
+        ),
+    ):
+        return True
+    if deadlines.cancelled():
+        return True
+    remaining = deadlines.remaining()
+    if remaining is not None and remaining <= 0:
+        return True
+    return shortened and isinstance(
+        e, (requests.exceptions.Timeout, asyncio.TimeoutError)
+    )
+
+
+def shorten(timeout, remaining: float):
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+# Transport adapter of the requests session shared by the OpenAI, Search and Storage clients (see app.py), so every
+# synchronous upstream call, including the ones LangChain makes, is bounded by the request deadline and goes through
+# the breaker of its host.
+class UpstreamAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, breakers: Optional[CircuitBreakers] = None, **kwargs):
+        self.breakers = breakers
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        deadlines.check()
+        remaining = deadlines.remaining()
+        shortened = False
+        if remaining is not None:
+            own, timeout = timeout, shorten(timeout, remaining)
+            shortened = timeout != own
+        if self.breakers is None:
+            return super().send(request, timeout=timeout, **kwargs)
+
+        breaker = self.breakers.get(urlsplit(request.url).hostname)
+        breaker.before()
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+        except Exception as e:
+            if not deadline_caused(e, shortened):
+                breaker.record(False)
+            raise
+        breaker.record(response.status_code not in FAILURE_STATUSES)
+        return response
+
+
+# Same for the aiohttp session of the ASGI app. aiohttp has no per-request hook for timeouts, the deadline is enforced
+# around the awaits instead (see deadlines.awithin).
+def upstream_trace_config(breakers: Optional[CircuitBreakers]) -> aiohttp.TraceConfig:
+    async def on_request_start(session, context, params):
+        deadlines.check()
+        if breakers is not None:
+            breakers.get(params.url.host).before()
+
+    async def on_request_end(session, context, params):
+        if breakers is not None:
+            breakers.get(params.url.host).record(
+                params.response.status not in FAILURE_STATUSES
+            )
+
+    async def on_request_exception(session, context, params):
+        # Cancelled by deadlines.awithin when the deadline passes, or by the client going away
+        if breakers is not None and not deadline_caused(params.exception):
+            breakers.get(params.url.host).record(False)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+# Sends a duplicate of a call that hasn't completed after `after` seconds and returns whichever result comes first,
+# which cuts the tail latency caused by the occasional slow request at the cost of a few extra ones. Only for
+# idempotent calls such as searches. The duplicate isn't sent when less than `after` seconds of the deadline remain.
+# Calls run on a pool of their own, and `after` counts from when the first attempt starts running there: time spent
+# waiting for a worker doesn't make a call look slow, so a saturated pool isn't sent hedges on top.
+class Hedge:
+    def __init__(self, after: float, max_workers: int = 16):
+        self.after = after
+        self.calls = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="hedge"
+        )
+
+    def run(self, func: Callable[[], T]) -> T:
+        self._count(calls=1)
+        started = threading.Event()
+
+        def attempt() -> T:
+            started.set()
+            return func()
+
+        first = self._executor.submit(copy_context().run, attempt)
+        if not started.wait(deadlines.remaining()):
+            first.cancel()
+            deadlines.check()
+        done, _ = wait([first], timeout=self.after)
+        if done or not self._worth_it():
+            try:
+                return first.result(timeout=deadlines.remaining())
+            except TimeoutError:
+                raise deadlines.DeadlineExceeded("request deadline exceeded")
+
+        self._count(hedged=1)
+        second = self._executor.submit(copy_context().run, func)
+        pending = {first, second}
+        while True:
+            done, pending = wait(
+                pending, timeout=deadlines.remaining(), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                deadlines.check()
+            for future in done:
+                if future.exception() is None:
+                    self._count(hedges_won=future is second)
+                    return future.result()
+            if not pending:
+                return first.result()
+
+    async def arun(self, func: Callable[[], Awaitable[T]]) -> T:
+        self._count(calls=1)
+        first = asyncio.ensure_future(func())
+        done, _ = await asyncio.wait({first}, timeout=self.after)
+        if done or not self._worth_it():
+            return await deadlines.awithin(first)
+
+        self._count(hedged=1)
+        second = asyncio.ensure_future(func())
+        pending = {first, second}
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadlines.remaining(), return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    deadlines.check()
+                for task in done:
+                    if task.exception() is None:
+                        self._count(hedges_won=task is second)
+                        return task.result()
+                if not pending:
+                    return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _count(self, calls: int = 0, hedged: int = 0, hedges_won: int = 0):
+        with self._lock:
+            self.calls += calls
+            self.hedged += hedged
+            self.hedges_won += hedges_won
+
+    def _worth_it(self) -> bool:
+        remaining = deadlines.remaining()
+        return remaining is None or remaining > self.after
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "after": self.after,
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedges_won": self.hedges_won,
+            }
@@ -1,4 +1,4 @@
-import { AskRequest, AskResponse, ChatRequest } from "./models";
+import { AskRequest, AskResponse, ChatRequest, ThoughtsResponse } from "./models";
 
 export async function askApi(options: AskRequest): Promise<AskResponse> {
     const response = await fetch("/ask", {
@@ -61,6 +61,121 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
     return parsedResponse;
 }
 
+// Streaming variants: the backend answers with newline delimited JSON, data_points and thoughts first and then the
+// answer in chunks. onUpdate is called with the merged response so far every time new data arrives.
+export async function askStreamApi(options: AskRequest, onUpdate: (response: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/ask", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: JSON.stringify({
+            question: options.question,
+            approach: options.approach,
+            stream: true,
+            overrides: {
+                semantic_ranker: options.overrides?.semanticRanker,
+                semantic_captions: options.overrides?.semanticCaptions,
+                top: options.overrides?.top,
+                temperature: options.overrides?.temperature,
+                prompt_template: options.overrides?.promptTemplate,
+                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+                exclude_category: options.overrides?.excludeCategory
+            }
+        })
+    });
+
+    return readStreamedResponse(response, onUpdate);
+}
+
+export async function chatStreamApi(options: ChatRequest, onUpdate: (response: AskResponse) => void): Promise<AskResponse> {
+    const response = await fetch("/chat", {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json"
+        },
+        body: JSON.stringify({
+            history: options.history,
+            approach: options.approach,
+            stream: true,
+            overrides: {
+                semantic_ranker: options.overrides?.semanticRanker,
+                semantic_captions: options.overrides?.semanticCaptions,
+                top: options.overrides?.top,
+                temperature: options.overrides?.temperature,
+                prompt_template: options.overrides?.promptTemplate,
+                prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+                prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+                exclude_category: options.overrides?.excludeCategory,
+                suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+            }
+        })
+    });
+
+    return readStreamedResponse(response, onUpdate);
+}
+
+async function readStreamedResponse(response: Response, onUpdate: (response: AskResponse) => void): Promise<AskResponse> {
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: AskResponse = await response.json();
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    const result: AskResponse = { answer: "", thoughts: null, data_points: [] };
+    const mergeLine = (line: string) => {
+        if (!line.trim()) {
+            return;
+        }
+        const chunk: Partial<AskResponse> = JSON.parse(line);
+        if (chunk.error) {
+            throw Error(chunk.error);
+        }
+        if (chunk.data_points !== undefined) {
+            result.data_points = chunk.data_points;
+        }
+        if (chunk.thoughts !== undefined) {
+            result.thoughts = chunk.thoughts;
+        }
+        if (chunk.trace_id !== undefined) {
+            result.trace_id = chunk.trace_id;
+        }
+        if (chunk.answer !== undefined) {
+            result.answer += chunk.answer;
+        }
+    };
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop() || "";
+        lines.forEach(mergeLine);
+        onUpdate({ ...result });
+    }
+    mergeLine(buffer + decoder.decode());
+
+    return result;
+}
+
+// Thoughts are not sent with the answer, the backend keeps them under the response's trace_id until they are asked for
+export async function thoughtsApi(traceId: string): Promise<string> {
+    const response = await fetch(`/thoughts/${traceId}`);
+
+    const parsedResponse: ThoughtsResponse = await response.json();
+    if (response.status > 299 || !response.ok) {
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    return parsedResponse.thoughts;
+}
+
 export function getCitationFilePath(citation: string): string {
     return `/content/${citation}`;
 }
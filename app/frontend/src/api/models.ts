@@ -25,10 +25,16 @@ export type AskRequest = {
 export type AskResponse = {
     answer: string;
     thoughts: string | null;
+    trace_id?: string;
     data_points: string[];
     error?: string;
 };
 
+export type ThoughtsResponse = {
+    thoughts: string;
+    error?: string;
+};
+
 export type ChatTurn = {
     user: string;
     bot?: string;
@@ -1,10 +1,11 @@
+import { useEffect, useState } from "react";
 import { Pivot, PivotItem } from "@fluentui/react";
 import DOMPurify from "dompurify";
 
 import styles from "./AnalysisPanel.module.css";
 
 import { SupportingContent } from "../SupportingContent";
-import { AskResponse } from "../../api";
+import { AskResponse, thoughtsApi } from "../../api";
 import { AnalysisPanelTabs } from "./AnalysisPanelTabs";
 
 interface Props {
@@ -19,11 +20,32 @@ interface Props {
 const pivotItemDisabledStyle = { disabled: true, style: { color: "grey" } };
 
 export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeight, className, onActiveTabChanged }: Props) => {
-    const isDisabledThoughtProcessTab: boolean = !answer.thoughts;
+    const [fetchedThoughts, setFetchedThoughts] = useState<string | null>(null);
+
+    const isDisabledThoughtProcessTab: boolean = !answer.thoughts && !answer.trace_id;
     const isDisabledSupportingContentTab: boolean = !answer.data_points.length;
     const isDisabledCitationTab: boolean = !activeCitation;
 
-    const sanitizedThoughts = DOMPurify.sanitize(answer.thoughts!);
+    useEffect(() => {
+        setFetchedThoughts(null);
+    }, [answer.trace_id]);
+
+    // Only fetch the thoughts once the tab is actually opened
+    useEffect(() => {
+        if (activeTab !== AnalysisPanelTabs.ThoughtProcessTab || answer.thoughts || !answer.trace_id || fetchedThoughts !== null) {
+            return;
+        }
+        let cancelled = false;
+        thoughtsApi(answer.trace_id)
+            .then(t => !cancelled && setFetchedThoughts(t))
+            .catch(e => !cancelled && setFetchedThoughts(`<span style='color:red'>${String(e)}</span>`));
+        return () => {
+            cancelled = true;
+        };
+    }, [activeTab, answer.thoughts, answer.trace_id, fetchedThoughts]);
+
+    const thoughts = answer.thoughts || fetchedThoughts;
+    const sanitizedThoughts = thoughts !== null ? DOMPurify.sanitize(thoughts) : "Loading...";
 
     return (
         <Pivot
@@ -4,7 +4,7 @@ import { SparkleFilled } from "@fluentui/react-icons";
 
 import styles from "./Chat.module.css";
 
-import { chatApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
+import { chatStreamApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -26,6 +26,7 @@ const Chat = () => {
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
+    const [isStreaming, setIsStreaming] = useState<boolean>(false);
     const [error, setError] = useState<unknown>();
 
     const [activeCitation, setActiveCitation] = useState<string>();
@@ -56,12 +57,17 @@ const Chat = () => {
                     suggestFollowupQuestions: useSuggestFollowupQuestions
                 }
             };
-            const result = await chatApi(request);
+            const result = await chatStreamApi(request, partial => {
+                setIsStreaming(true);
+                setAnswers([...answers, [question, partial]]);
+            });
             setAnswers([...answers, [question, result]]);
         } catch (e) {
+            setAnswers(answers);
             setError(e);
         } finally {
             setIsLoading(false);
+            setIsStreaming(false);
         }
     };
 
@@ -157,7 +163,7 @@ const Chat = () => {
                                     </div>
                                 </div>
                             ))}
-                            {isLoading && (
+                            {isLoading && !isStreaming && (
                                 <>
                                     <UserChatMessage message={lastQuestionRef.current} />
                                     <div className={styles.chatMessageGptMinWidth}>
@@ -3,7 +3,7 @@ import { Checkbox, ChoiceGroup, IChoiceGroupOption, Panel, DefaultButton, Spinne
 
 import styles from "./OneShot.module.css";
 
-import { askApi, Approaches, AskResponse, AskRequest } from "../../api";
+import { askStreamApi, Approaches, AskResponse, AskRequest } from "../../api";
 import { Answer, AnswerError } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -24,6 +24,7 @@ const OneShot = () => {
     const lastQuestionRef = useRef<string>("");
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
+    const [isStreaming, setIsStreaming] = useState<boolean>(false);
     const [error, setError] = useState<unknown>();
     const [answer, setAnswer] = useState<AskResponse>();
 
@@ -35,6 +36,7 @@ const OneShot = () => {
 
         error && setError(undefined);
         setIsLoading(true);
+        setAnswer(undefined);
         setActiveCitation(undefined);
         setActiveAnalysisPanelTab(undefined);
 
@@ -52,12 +54,16 @@ const OneShot = () => {
                     semanticCaptions: useSemanticCaptions
                 }
             };
-            const result = await askApi(request);
+            const result = await askStreamApi(request, partial => {
+                setIsStreaming(true);
+                setAnswer(partial);
+            });
             setAnswer(result);
         } catch (e) {
             setError(e);
         } finally {
             setIsLoading(false);
+            setIsStreaming(false);
         }
     };
 
@@ -139,9 +145,9 @@ const OneShot = () => {
                 </div>
             </div>
             <div className={styles.oneshotBottomSection}>
-                {isLoading && <Spinner label="Generating answer" />}
+                {isLoading && !isStreaming && <Spinner label="Generating answer" />}
                 {!lastQuestionRef.current && <ExampleList onExampleClicked={onExampleClicked} />}
-                {!isLoading && answer && !error && (
+                {(!isLoading || isStreaming) && answer && !error && (
                     <div className={styles.oneshotAnswerContainer}>
                         <Answer
                             answer={answer}
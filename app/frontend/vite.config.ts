@@ -12,7 +12,8 @@ export default defineConfig({
     server: {
         proxy: {
             "/ask": "http://backend:8000",
-            "/chat": "http://backend:8000"
+            "/chat": "http://backend:8000",
+            "/thoughts": "http://backend:8000"
         }
     }
 });